@@ -1,9 +1,11 @@
 import pickle
 import os
 import datetime
-from sp_data.data_utils import SPbinaryData
+from sp_data.data_utils import SPbinaryData, get_data_folder, check_compatibility
+from sp_data.columnar_partitions import convert_all_partitions
 from train_scripts.cv_train_cs_predictors import train_cs_predictors, test_seqs_w_pretrained_mdl, train_sp_type_predictor,\
-    test_w_precomputed_sptypes
+    test_w_precomputed_sptypes, test_quantized_mdl, export_script_mdl, export_onnx_and_check, \
+    distill_cs_predictor, predict_fasta_stream
 import argparse
 import logging
 
@@ -46,6 +48,10 @@ def parse_arguments():
     parser.add_argument("--train_cs_predictor", default=False, action="store_true", help="Train a CS predictor like TSignal"
                          " (alternatively, can also train a binary SP type classifier)")
     parser.add_argument("--batch_size", default=32, type=int, help="Training batch size")
+    parser.add_argument("--length_buckets", default=False, action="store_true", help="Batch sequences of similar "
+                        "lengths (shuffled buckets for training, sorted batches for evaluation).")
+    parser.add_argument("--max_tokens", default=0, type=int, help="Maximum number of padded residues of a "
+                        "length-bucketed batch, instead of a fixed --batch_size (implies --length_buckets).")
     parser.add_argument("--run_name", default="some_run", type=str, help="Name your run. This will be used as a prefix for all saved files: logs, models, etc.")
     parser.add_argument("--epochs", default=-1, type=int, help="By default, model uses tolerence based stopping criteria. "
                            "Set this for a fixed number of epochs training.")
@@ -66,12 +72,68 @@ def parse_arguments():
     parser.add_argument("--deployment_model", default=False, action="store_true", help="If training a final (deployment) model,"
                                    "the training fold will be [0,1,2] and the model is only validated (not tested at then end)")
     parser.add_argument("--test_seqs", default="", type=str, help="filename of the binary containing sequences that will be tested. File needs to be in sp_data/ folder")
+    parser.add_argument("--stream_fasta", default="", type=str, help="Path of a (plain or gzipped) FASTA file that is "
+                        "tested with --test_mdl (a --tune_bert model) in streaming mode: records are batched while the "
+                        "file is read and the predictions are written to --stream_out as they are computed.")
+    parser.add_argument("--stream_out", default="predictions.tsv", type=str, help="Output file of --stream_fasta.")
+    parser.add_argument("--stream_batch_size", default=64, type=int, help="Batch size of --stream_fasta.")
+    parser.add_argument("--stream_window", default=70, type=int, help="Number of N-terminal residues of each "
+                        "--stream_fasta record that are tested.")
+    parser.add_argument("--stream_og", default="EUKARYA", type=str, help="Organism group of the --stream_fasta "
+                        "sequences.")
     parser.add_argument("--test_mdl", default="", type=str, help="filename of model that will be tested on test_seqs file")
     parser.add_argument("--lr_scheduler_swa", default="none", type=str, help="when using swa, one option is to cycle the learning rate after n training steps (instead of after each epoch)."
                                      "")
     parser.add_argument("--lr_sched_warmup", default=0, type=int)
     parser.add_argument("--ff_d", default=4096, type=int, help='Expanding dimension')
-    parser.add_argument("--test_beam", default=False, action="store_true")
+    parser.add_argument("--test_beam", default=False, action="store_true", help="Also test the best model with beam "
+                        "search (when training) or use beam search for --test_seqs.")
+    parser.add_argument("--beam_width", default=3, type=int, help="Number of beams kept for each sequence by beam search.")
+    parser.add_argument("--ensemble_mdls", default=[], nargs="+", type=str, help="Filenames of other models (e.g. "
+                        "the models of the other folds) that are used together with --test_mdl as an ensemble when "
+                        "testing --test_seqs. Files need to be in sp_data/ folder")
+    parser.add_argument("--ensemble_aggregation", default="avg", type=str, choices=["avg", "max"], help="avg: average "
+                        "the label probabilities of the ensemble models; max: each sequence follows the model that is "
+                        "the most confident in its first label.")
+    parser.add_argument("--precision", default="fp32", type=str, choices=["fp32", "fp16", "bf16"], help="Compute "
+                        "the forward passes (training, validation and testing) in autocast regions of the given "
+                        "precision; fp16 training also uses loss scaling. bf16 requires torch>=1.10.")
+    parser.add_argument("--fp32_modules", default=["generator", "LayerNorm"], nargs="+", type=str, help="Names "
+                        "(attribute or class names) of the modules that are kept in fp32 when --precision is not fp32.")
+    parser.add_argument("--quantize", default="none", type=str, choices=["none", "int8"], help="int8: dynamic int8 "
+                        "quantization of the linear layers of ProtBERT and of the decoder when testing --test_mdl "
+                        "(CPU inference only).")
+    parser.add_argument("--test_quantized", default=False, action="store_true", help="Compare the int8 quantized "
+                        "--test_mdl against the fp32 model (SP-type MCC, CS F1, speed and size) on the fold not in "
+                        "--train_folds and save the quantized model as <test_mdl>_int8_best_eval.pth.")
+    parser.add_argument("--export_script_mdl", default="", type=str, help="Export --test_mdl (a --tune_bert "
+                        "--train_only_decoder model) as a self-contained TorchScript predictor with this file name "
+                        "(tokenization, ProtBERT, decoder and post-processing; loadable with only torch) and check its "
+                        "predictions against the original model on --test_seqs (default test_seqs.bin).")
+    parser.add_argument("--export_onnx_mdl", default="", type=str, help="Export --test_mdl (a --tune_bert "
+                        "--train_only_decoder model) as the ONNX graphs <prefix>_encoder.onnx (ProtBERT + decoder "
+                        "memory) and <prefix>_decoder_step.onnx (one cached decoder step), with this prefix (in "
+                        "sp_data/), and compare their onnxruntime predictions against PyTorch on --test_seqs (default "
+                        "test_seqs.bin).")
+    parser.add_argument("--onnx_mdl", default="", type=str, help="Prefix of the ONNX graphs exported with "
+                        "--export_onnx_mdl; when given, --test_seqs are greedily decoded with onnxruntime on the CPU.")
+    parser.add_argument("--onnx_threads", default=0, type=int, help="onnxruntime intra-op threads (0: onnxruntime's "
+                        "default).")
+    parser.add_argument("--convert_partitions", default=False, action="store_true", help="Convert the pickled "
+                        "sp6_partitioned_data_* partitions of the data folder to the columnar memory-mapped format "
+                        "(read instead of the pickles from then on).")
+    parser.add_argument("--precompute_embeddings", default=False, action="store_true", help="Precompute the "
+                        "ProtBERT embeddings of the sp6_partitioned_data_* partitions (resumes an interrupted run).")
+    parser.add_argument("--precompute_max_tokens", default=8192, type=int, help="Maximum number of padded residues "
+                        "of a --precompute_embeddings ProtBERT batch.")
+    parser.add_argument("--precompute_fp16", default=False, action="store_true", help="Store the "
+                        "--precompute_embeddings embeddings as float16.")
+    parser.add_argument("--emb_cache_dir", default="", type=str, help="Directory of a persistent cache of the ProtBERT "
+                        "embeddings used when decoding with a tuned ProtBERT (keyed by sequence and ProtBERT weights, "
+                        "so it is invalidated when the weights change). Empty (default): no caching.")
+    parser.add_argument("--emb_cache_max_gb", default=10., type=float, help="Size cap of the --emb_cache_dir disk store.")
+    parser.add_argument("--emb_cache_mem_entries", default=20000, type=int, help="Number of sequence embeddings of "
+                        "the --emb_cache_dir cache that are also kept in memory.")
     parser.add_argument("--wd", default=0., type=float)
     parser.add_argument("--glbl_lbl_weight", default=1., type=float)
     parser.add_argument("--glbl_lbl_version", default=1, type=int)
@@ -96,6 +158,28 @@ def parse_arguments():
     parser.add_argument("--tuned_bert_embs", default=False, action="store_true")
     parser.add_argument("--tune_bert", default=False, action="store_true", help="Tune BERT and TSignal together")
     parser.add_argument("--frozen_epochs", default=3, type=int)
+    parser.add_argument("--cache_frozen_outputs", default=False, action="store_true", help="With --tune_bert, "
+                        "compute the ProtBERT outputs of the training/validation sequences only once during the "
+                        "--frozen_epochs and reuse them until the encoder is un-frozen (the frozen ProtBERT then runs "
+                        "without dropout).")
+    parser.add_argument("--lora_rank", default=0, type=int, help="With --tune_bert, tune low-rank adapters of the "
+                        "ProtBERT attention/feed-forward projections instead of all ProtBERT weights (0: full tuning). "
+                        "Only the adapters are saved, and ensembles of such models share one ProtBERT forward pass.")
+    parser.add_argument("--lora_alpha", default=16., type=float, help="Scaling of the --lora_rank adapters.")
+    parser.add_argument("--lora_dropout", default=0.05, type=float, help="Dropout on the --lora_rank adapter inputs.")
+    parser.add_argument("--lora_lr", default=0.0001, type=float, help="Learning rate of the --lora_rank adapters.")
+    parser.add_argument("--tune_top_bert_layers", default=0, type=int, help="With --tune_bert, only tune the top K "
+                        "ProtBERT layers (and TSignal): the embeddings and bottom layers are permanently frozen and the "
+                        "hidden states they output are cached in --lower_layer_cache_dir (0: tune all layers).")
+    parser.add_argument("--lower_layer_cache_dir", default="sp_data/protbert_lower_layer_cache/", type=str,
+                        help="Directory of the memory-mapped fp16 store of --tune_top_bert_layers.")
+    parser.add_argument("--frozen_cache_dir", default="", type=str, help="Directory of a memory-mapped store for "
+                        "--cache_frozen_outputs (default: keep the outputs in memory).")
+    parser.add_argument("--tensor_batches", default=False, action="store_true", help="With --tune_bert, pre-encode "
+                        "the training sequences/labels once and build the ProtBERT inputs and padded targets of each "
+                        "batch in the DataLoader workers (not used with --augment_trimmed_seqs).")
+    parser.add_argument("--pin_memory", default=False, action="store_true", help="Pin the --tensor_batches batches "
+                        "(asynchronous host to GPU copies).")
     parser.add_argument("--frozen_pe_epochs", default=-1, type=int)
     parser.add_argument("--no_bert_pe_training", default=False, action="store_true")
     parser.add_argument("--extended_sublbls", default=False, action="store_true")
@@ -103,6 +187,20 @@ def parse_arguments():
     parser.add_argument("--train_on_subset", default=1., type=float)
     parser.add_argument("--train_only_decoder", default=False, action="store_true")
     parser.add_argument("--remove_bert_layers", default=0, type=int)
+    parser.add_argument("--pack_length", default=0, type=int, help="When > 0, the ProtBERT forward passes (training, "
+                        "greedy decoding) pack several short sequences into rows of at most this many tokens, with a "
+                        "block-diagonal attention mask and per-sequence position ids (0: one sequence per row).")
+    parser.add_argument("--distill_teacher_mdl", default="", type=str, help="Trained --tune_bert model (in sp_data/) "
+                        "to distill into a student with --student_bert_layers ProtBERT layers and the same TSignal "
+                        "head. The student is saved as <run_name>_best_eval.pth (usable with --test_mdl).")
+    parser.add_argument("--student_bert_layers", default=6, type=int, help="Number of ProtBERT layers of the "
+                        "distilled student (initialized with evenly spaced teacher layers).")
+    parser.add_argument("--distill_temperature", default=2., type=float, help="Softmax temperature of the label "
+                        "distribution distillation loss.")
+    parser.add_argument("--distill_kd_weight", default=1., type=float, help="Weight of the KL divergence between the "
+                        "teacher's and the student's label distributions.")
+    parser.add_argument("--distill_hidden_weight", default=1., type=float, help="Weight of the MSE between the "
+                        "teacher's and the student's ProtBERT outputs.")
     parser.add_argument("--augment_trimmed_seqs", default=False, action="store_true")
     parser.add_argument("--saliency_map_save_fn", default="save.bin", type=str)
     parser.add_argument("--compute_saliency", default=False, action="store_true")
@@ -135,6 +233,18 @@ def parse_arguments():
     parser.add_argument("--use_extra_oh", default=False,action="store_true")
     parser.add_argument("--use_aa_len", default=200, type=int, help="When training binary classifiers (not for TSignal).")
     parser.add_argument("--data", default="mammal", type=str, help="When training binary classifiers (not for TSignal).")
+    parser.add_argument("--no_kv_cache", default=False, action="store_true", help="Greedy decoding re-runs the full "
+                        "decoder over all predicted labels at every step, instead of caching the keys/values of the "
+                        "previous labels and of the memory (predictions are the same; caching is faster).")
+    parser.add_argument("--cs_only_decoding", default=False, action="store_true", help="Stop decoding a sequence once "
+                        "its SP type and cleavage site are known (a non-SP label is predicted) and fill the remaining "
+                        "labels with that label. Used when testing (evaluate/--test_seqs).")
+    parser.add_argument("--structured_cs_decoding", default=False, action="store_true", help="When testing, score all "
+                        "(SP type, cleavage site) label hypotheses X^k Y^(n-k) in one batched teacher-forced decoder "
+                        "pass and keep the most likely one, instead of decoding the labels one by one.")
+    parser.add_argument("--report_greedy_agreement", default=False, action="store_true", help="With "
+                        "--structured_cs_decoding, also run greedy decoding and report how often both predict the same "
+                        "SP type and CS.")
 
     return parser.parse_args()
 
@@ -229,15 +339,49 @@ if __name__ == "__main__":
     date_now = str(datetime.datetime.now()).split(".")[0].replace("-", "").replace(":", "").replace(" ", "")
     logging.getLogger('some_logger')
     args = parse_arguments()
+    if args.precompute_embeddings:
+        check_compatibility(tune_bert=False, max_tokens=args.precompute_max_tokens, fp16=args.precompute_fp16)
+    if args.convert_partitions:
+        convert_all_partitions(get_data_folder())
     if args.test_mdl and args.test_sptype_preds != "none":
         test_w_precomputed_sptypes(args)
-    if args.test_seqs:
-        test_seqs_w_pretrained_mdl(args.test_mdl, args.test_seqs, tune_bert=args.tune_bert, saliency_map_save_fn=args.saliency_map_save_fn,hook_layer=args.hook_layer, compute_saliency=args.compute_saliency)
+    if args.test_mdl and args.test_quantized:
+        logging.basicConfig(filename=args.run_name + ".log", level=logging.INFO)
+        test_quantized_mdl(args)
+    if args.test_mdl and args.export_script_mdl:
+        logging.basicConfig(filename=args.run_name + ".log", level=logging.INFO)
+        export_script_mdl(args.test_mdl, args.export_script_mdl, test_file=args.test_seqs or "test_seqs.bin")
+    if args.test_mdl and args.export_onnx_mdl:
+        logging.basicConfig(filename=args.run_name + ".log", level=logging.INFO)
+        export_onnx_and_check(args.test_mdl, args.export_onnx_mdl, test_file=args.test_seqs or "test_seqs.bin",
+                              onnx_threads=args.onnx_threads)
+    if args.stream_fasta:
+        logging.basicConfig(filename=args.run_name + ".log", level=logging.INFO)
+        predict_fasta_stream(args.test_mdl, args.stream_fasta, args.stream_out, batch_size=args.stream_batch_size,
+                             window=args.stream_window, og=args.stream_og, use_kv_cache=not args.no_kv_cache,
+                             cs_only=args.cs_only_decoding, precision=args.precision, fp32_modules=args.fp32_modules,
+                             pack_length=args.pack_length)
+    elif args.test_seqs:
+        test_seqs_w_pretrained_mdl(args.test_mdl, args.test_seqs, tune_bert=args.tune_bert, saliency_map_save_fn=args.saliency_map_save_fn,hook_layer=args.hook_layer, compute_saliency=args.compute_saliency,
+                                   use_kv_cache=not args.no_kv_cache, cs_only=args.cs_only_decoding,
+                                   use_structured_cs=args.structured_cs_decoding,
+                                   report_greedy_agreement=args.report_greedy_agreement,
+                                   use_beam_search=args.test_beam, beam_width=args.beam_width,
+                                   ensemble_mdls=args.ensemble_mdls, ensemble_aggregation=args.ensemble_aggregation,
+                                   emb_cache_dir=args.emb_cache_dir, emb_cache_max_gb=args.emb_cache_max_gb,
+                                   emb_cache_mem_entries=args.emb_cache_mem_entries, quantize=args.quantize,
+                                   precision=args.precision, fp32_modules=args.fp32_modules,
+                                   onnx_mdl=args.onnx_mdl, onnx_threads=args.onnx_threads,
+                                   pack_length=args.pack_length)
     elif args.train_sp_type_predictor:
         logging.basicConfig(filename=args.run_name + ".log", level=logging.INFO)
 
         args2 = parse_arguments()
         train_sp_type_predictor(args2)
+    elif args.distill_teacher_mdl:
+        logging.basicConfig(filename=args.run_name + ".log", level=logging.INFO)
+        args.train_folds = [int(tf) for tf in args.train_folds]
+        distill_cs_predictor(args)
     elif args.train_cs_predictor:
         args2 = parse_arguments()
         if not os.path.exists("param_groups_by_id_cs.bin"):
@@ -11,6 +11,7 @@ from sklearn.metrics import matthews_corrcoef as compute_mcc
 import os
 import pickle
 from Bio import SeqIO
+from sp_data.seq_index import get_seq_index
 import numpy as np
 
 def clean_sec_sp2_preds(seq, preds):
@@ -535,20 +536,13 @@ def extract_seq_group_for_predicted_aa_lbls(filename="run_wo_lg_info.bin", test_
     tested_seqs = set(seq2preds.keys())
     seq2id = {}
     life_grp, seqs, true_lbls, pred_lbls = [], [], [], []
-    info_dictionary = {}
-    for t in ['train','test']:
-        for tf in [0, 1,2]:
-            file = get_data_folder()+"sp6_partitioned_data_{}_{}.bin".format(t,tf)
-            for seq, data in pickle.load(open(file, "rb")).items():
-                info_dictionary[seq] = ["|".join([data[-2],data[-1]]), data[-3]]
-
-    for seq_record in SeqIO.parse(get_data_folder() + "sp6_data/train_set.fasta", "fasta"):
-        seq, lbls = seq_record.seq[:len(seq_record.seq) // 2], seq_record.seq[len(seq_record.seq) // 2:]
-        if seq in tested_seqs and str(seq) not in seqs:
-            life_grp.append(info_dictionary[str(seq)][0])
-            seqs.append(str(seq))
-            true_lbls.append(info_dictionary[str(seq)][1])
-            pred_lbls.append(seq2preds[str(seq)])
+    # (unique sequences, in the order of the raw fasta)
+    for seq, row in get_seq_index(get_data_folder()).items():
+        if seq in tested_seqs:
+            life_grp.append("|".join([row["og"], row["sp_type"]]))
+            seqs.append(seq)
+            true_lbls.append(row["lbls"])
+            pred_lbls.append(seq2preds[seq])
             # life_grp.append("|".join(str(seq_record.id).split("|")[1:-1]))
             # seqs.append(seq)
             # true_lbls.append(lbls)
@@ -2906,13 +2900,7 @@ def plot_comparative_performance_sp1_mdls(result_folders=("previous_results/only
     exit(1)
 
 def create_random_split_fold_data():
-    all_data = []
-    for p in [0, 1, 2]:
-        for t in ["train", "test"]:
-            data = pickle.load(open("../sp_data/sp6_partitioned_data_{}_{}.bin".format(t, p), "rb"))
-            extract_data = [[k, v[1], v[2], v[3]] for k,v in data.items()]
-            print("sp_data/sp6_partitioned_data_{}_{}.bin".format(t, p), len(extract_data))
-            all_data.extend(extract_data)
+    all_data = [[seq, row["lbls"], row["og"], row["sp_type"]] for seq, row in get_seq_index("../sp_data/").items()]
     indices = random.sample(list(range(len(all_data))), len(all_data))
     indices_per_fold = [[], [], []]
     no_of_dp_per_fold = len(indices) // 3
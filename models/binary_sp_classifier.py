@@ -3,6 +3,7 @@ import pickle
 import torch.nn.functional as F
 import torch
 import torch.nn as nn
+from sp_data.seq_index import get_seq_index
 
 
 def get_data_folder():
@@ -270,14 +271,7 @@ class CNN4(nn.Module):
         return self.dense(x)
 
     def form_lg_dict(self):
-        folder = get_data_folder()
-        seq2og = {}
-        for tr_f in [0,1,2]:
-            for t in ['train','test']:
-                data = pickle.load(open(folder+"sp6_partitioned_data_sublbls_{}_{}.bin".format(t,tr_f),"rb"))
-                current_seq2og = {seq: v[-2] for seq, v in data.items()}
-                seq2og.update(current_seq2og)
-        self.seq2og = seq2og
+        self.seq2og = {seq: row["og"] for seq, row in get_seq_index(get_data_folder()).items()}
 
 
 
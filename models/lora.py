@@ -0,0 +1,137 @@
+import math
+from functools import reduce
+
+import torch
+import torch.nn as nn
+
+# the linear projections of each ProtBERT layer that get low-rank adapters
+LORA_TARGETS = ("attention.self.query", "attention.self.key", "attention.self.value", "attention.output.dense",
+                "intermediate.dense", "output.dense")
+
+
+class LoRALinear(nn.Module):
+    def __init__(self, base, rank=8, alpha=16., dropout=0.):
+        """
+        Frozen nn.Linear <base> with a trainable low-rank update: base(x) + alpha / rank * B(A(x)), where B is
+        initialized to 0 (the adapted model starts as the base model).
+
+        :param nn.Linear base: the adapted projection
+        :param int rank: rank of the update
+        :param float alpha: scaling of the update
+        :param float dropout: dropout on the adapter inputs
+        """
+        super().__init__()
+        self.base = base
+        for param in self.base.parameters():
+            param.requires_grad = False
+        self.lora_A = nn.Parameter(torch.zeros(rank, base.in_features, device=base.weight.device))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank, device=base.weight.device))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scaling = alpha / rank
+        self.lora_dropout = nn.Dropout(dropout)
+        # ([N, rank, in_features], [N, out_features, rank]) adapters of N models applied to N consecutive blocks of the
+        # batch (see SharedLoRAEncoder)
+        self.stacked_adapters = None
+
+    def forward(self, x):
+        out = self.base(x)
+        if self.stacked_adapters is not None:
+            lora_A, lora_B = self.stacked_adapters
+            x_ = x.reshape(lora_A.shape[0], -1, x.shape[-1])
+            update = torch.bmm(torch.bmm(x_, lora_A.transpose(1, 2)), lora_B.transpose(1, 2))
+            return out + update.reshape(out.shape) * self.scaling
+        return out + self.lora_dropout(x) @ self.lora_A.t() @ self.lora_B.t() * self.scaling
+
+
+def add_lora_adapters(bert_model, rank=8, alpha=16., dropout=0., targets=LORA_TARGETS):
+    """
+    Freezes all ProtBERT parameters and replaces the <targets> projections of every layer by LoRALinear adapters
+    (the only ProtBERT parameters that are tuned). The model is modified in-place.
+
+    :param BertModel bert_model: ProtBERT model
+    :return BertModel: the adapted model
+    """
+    for param in bert_model.parameters():
+        param.requires_grad = False
+    for layer in bert_model.encoder.layer:
+        for target in targets:
+            parent_name, attr = target.rsplit(".", 1)
+            parent = reduce(getattr, parent_name.split("."), layer)
+            setattr(parent, attr, LoRALinear(getattr(parent, attr), rank=rank, alpha=alpha, dropout=dropout))
+    return bert_model
+
+
+def lora_state_dict(bert_model):
+    """ the adapter parameters of <bert_model> (the only ones that differ from the base ProtBERT) """
+    return {n: p.detach().cpu() for n, p in bert_model.state_dict().items() if "lora_" in n}
+
+
+def get_lora_layer_inds(lora_config):
+    """
+    :param dict lora_config: lora_config of a LoRA-tuned ProtBertClassifier
+    :return list: indices of the base ProtBERT layers the model keeps (the first "no_layers" layers, unless given as
+            "layer_inds", e.g. for distilled students)
+    """
+    return lora_config.get("layer_inds", list(range(lora_config["no_layers"])))
+
+
+def is_lora_base_model(bert_model, lora_config):
+    """
+    :return bool: true if <bert_model> is still the (unquantized) base ProtBERT with the layers of <lora_config> and
+            its adapters, i.e. if it can be saved as adapters only
+    """
+    return len(bert_model.encoder.layer) == len(get_lora_layer_inds(lora_config)) and \
+           not any(isinstance(m, torch.nn.quantized.dynamic.Linear) for m in bert_model.modules())
+
+
+def get_lora_modules(bert_model):
+    return [m for m in bert_model.modules() if isinstance(m, LoRALinear)]
+
+
+class SharedLoRAEncoder:
+    def __init__(self, models):
+        """
+        ProtBERT forward pass of N ProtBertClassifiers that were LoRA-tuned from the same base model (e.g. the models
+        of the different cross-validation folds): the batch is repeated N times and run once through the base model of
+        the first classifier, each LoRALinear applying the adapters of model i to the i-th block of the batch.
+
+        :param list models: LoRA-tuned ProtBertClassifiers (use SharedLoRAEncoder.can_share to check if they are
+                compatible)
+        """
+        self.bert_model = models[0].ProtBertBFD
+        self.no_models = len(models)
+        all_lora_modules = [get_lora_modules(m.ProtBertBFD) for m in models]
+        self.stacked_adapters = [(torch.stack([lms[i].lora_A.detach() for lms in all_lora_modules]),
+                                  torch.stack([lms[i].lora_B.detach() for lms in all_lora_modules]))
+                                 for i in range(len(all_lora_modules[0]))]
+
+    @staticmethod
+    def can_share(models):
+        """
+        :param list models: ProtBertClassifiers
+        :return bool: true if all models are LoRA-tuned with the same adapter shapes, from the same base weights
+        """
+        if any(getattr(m, "lora_config", None) is None for m in models):
+            return False
+        def base_params(m):
+            return [p for n, p in m.ProtBertBFD.named_parameters() if "lora_" not in n]
+        def adapter_shapes(m):
+            return [p.shape for n, p in m.ProtBertBFD.named_parameters() if "lora_" in n]
+        return all(adapter_shapes(m) == adapter_shapes(models[0]) and len(base_params(m)) == len(base_params(models[0]))
+                   and all(torch.equal(p, p0) for p, p0 in zip(base_params(m), base_params(models[0])))
+                   for m in models[1:])
+
+    def __call__(self, input_ids, attention_mask):
+        """
+        :return torch.tensor: ProtBERT last layer outputs of each model [N, batch_size, max_no_tokens, 1024]
+        """
+        lora_modules = get_lora_modules(self.bert_model)
+        for module, adapters in zip(lora_modules, self.stacked_adapters):
+            module.stacked_adapters = adapters
+        try:
+            outputs = self.bert_model(input_ids=input_ids.repeat(self.no_models, 1),
+                                      attention_mask=attention_mask.repeat(self.no_models, 1))[0]
+        finally:
+            for module in lora_modules:
+                module.stacked_adapters = None
+        return outputs.reshape(self.no_models, *input_ids.shape, outputs.shape[-1])
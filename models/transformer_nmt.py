@@ -2,7 +2,7 @@ import os
 import pickle
 import numpy as np
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn, Tensor
@@ -11,6 +11,7 @@ from torch.nn.modules import LayerNorm
 from torch.nn import TransformerEncoder, TransformerEncoderLayer, Transformer, TransformerDecoder, TransformerDecoderLayer
 from torch.utils.data import dataset
 from models.binary_sp_classifier import BinarySPClassifier, CNN3
+from sp_data.columnar_partitions import load_partition, PartitionEmbeddingProvider
 
 
 class TokenEmbedding(nn.Module):
@@ -32,7 +33,11 @@ class TokenEmbedding(nn.Module):
 
     def forward(self, tokens: Tensor):
         token_tensors = []
-        if self.lbl2ind is not None:
+        if self.lbl2ind is not None and isinstance(tokens, Tensor):
+            # label sequences already held in a (padded) tensor, e.g. during greedy decoding; only prepend <BOS>
+            bos = torch.full((tokens.shape[0], 1), self.lbl2ind["BS"], dtype=torch.long, device=tokens.device)
+            return self.embedding(torch.cat([bos, tokens.long()], dim=1)) * math.sqrt(self.emb_size)
+        elif self.lbl2ind is not None:
             max_len = max([len(tk_seq) for tk_seq in tokens])
             for tk_seq in tokens:
                 tk_tensor = [self.lbl2ind["BS"]]
@@ -92,23 +97,20 @@ class InputEmbeddingEncoder(nn.Module):
             self.extra_embs_dec_input = None
 
         self.glbl_lbl_version = glbl_lbl_version
-        seq2emb = {}
         self.og2ind = pickle.load(open("sp6_dicts.bin", "rb"))[1]
         seq2lg = {}
         self.use_lg = og2ind is not None
         if aa2ind is None:
             # if aa2ind is None, train on oh using an InputEmbeddingLayer. A single emb layer having everything (EOS, BOS,
             # CLS, LG) embs should be good
-            for p in partitions:
-                for t in ["test", "train"]:
-                    part_dict = pickle.load(open(self.data_folder + tuned_bert_embs_prefix +
-                                                 "sp6_partitioned_data_{}_{}.bin".format(t, p), "rb"))
-                    if not tuning_bert:
-                        seq2emb.update({seq: emb for seq, (emb, _, _, _) in part_dict.items()})
-                    if og2ind is not None:
-                        seq2lg.update({seq: og2ind[lg] for seq, (_, _, lg, _) in part_dict.items()})
+            partition_fs = [self.data_folder + tuned_bert_embs_prefix + "sp6_partitioned_data_{}_{}.bin".format(t, p)
+                            for p in partitions for t in ["test", "train"]]
+            if og2ind is not None:
+                for partition_f in partition_fs:
+                    seq2lg.update({seq: og2ind[lg] for seq, (_, _, lg, _) in load_partition(partition_f).items()})
             self.seq2lg = seq2lg
-            self.seq2emb = seq2emb
+            # the precomputed embeddings are only read when they are needed
+            self.seq2emb = PartitionEmbeddingProvider(partition_fs) if not tuning_bert else {}
             self.aa2ind = aa2ind
             # we do need the beginning of sequence and end of sequence tokens for the predictions, so we add a linear layer
             # 2x1024 for that. When using global classification, an additional <CLS> token will be added during training,
@@ -158,7 +160,9 @@ class InputEmbeddingEncoder(nn.Module):
         :param str_or_None inp_seq:
         :return torch.tensor: tensor containing the input to TSignal's decoder
         """
-        aa_embedding = torch.tensor(self.seq2emb[strseq_or_inpemb], device=self.device) if inp_seq is None else strseq_or_inpemb
+        # (the embeddings of columnar partitions are fp16)
+        aa_embedding = torch.tensor(self.seq2emb[strseq_or_inpemb], dtype=torch.float32, device=self.device) \
+            if inp_seq is None else strseq_or_inpemb
 
         # uncomment and use if you with to add to input_tensor the {BOS}/{EOS}; it most likely shouldn't affect the
         # final results
@@ -231,7 +235,9 @@ class InputEmbeddingEncoder(nn.Module):
         if inp_seqs is not None:
             tensor_inputs = [self.add_bos_eos_lg_glb_cls_tkns(s, inp_seq=is_) for (s, is_) in zip(seqs, inp_seqs)]
         else:
-            tensor_inputs = [self.add_bos_eos_lg_glb_cls_tkns(s) for s in seqs]
+            # the precomputed embeddings of the batch are gathered together
+            batch_embs = self.seq2emb.get_batch(seqs, device=self.device)
+            tensor_inputs = [self.add_bos_eos_lg_glb_cls_tkns(emb, inp_seq=s) for s, emb in zip(seqs, batch_embs)]
         if inp_seqs is None:
             input_lens = [ti.shape[0] for ti in tensor_inputs]
         else:
@@ -255,20 +261,196 @@ class InputEmbeddingEncoder(nn.Module):
 
     def update(self, partitions=[0,1,2], emb_f_name=None, tuned_bert_embs_prefix=""):
         self.data_folder = get_data_folder()
-        seq2emb = {}
         if emb_f_name is not None:
             self.og2ind = pickle.load(open("sp6_dicts.bin", "rb"))[1]
-            dict_ = pickle.load(open(self.data_folder + emb_f_name, "rb"))
-            seq2emb.update({seq: emb for seq, (emb, _, _, _) in dict_.items()})
+            dict_ = load_partition(self.data_folder + emb_f_name)
             self.seq2lg = {seq: self.og2ind[lg] for seq, (_, _, lg, _) in dict_.items()}
+            partition_fs = [self.data_folder + emb_f_name]
         else:
-            for p in partitions:
-                for t in ["test", "train"]:
-                    part_dict = pickle.load(open(self.data_folder + tuned_bert_embs_prefix +
-                                             "sp6_partitioned_data_sublbls_{}_{}.bin".format(t, p), "rb"))
-                    seq2emb.update({seq: emb for seq, (emb, _, _, _) in part_dict.items()})
-        self.seq2emb = seq2emb
+            partition_fs = [self.data_folder + tuned_bert_embs_prefix + "sp6_partitioned_data_sublbls_{}_{}.bin".format(t, p)
+                            for p in partitions for t in ["test", "train"]]
+        self.seq2emb = PartitionEmbeddingProvider(partition_fs)
+
+
+
+def multi_head_attention_heads(q: Tensor, k: Tensor, v: Tensor, num_heads: int, attn_mask: Optional[Tensor] = None,
+                               key_padding_mask: Optional[Tensor] = None) -> Tensor:
+    """
+    Scaled dot-product attention over <num_heads> heads, for queries/keys/values that have already been projected
+    (the output projection is not applied).
+
+    :param torch.tensor q: projected queries [tgt_len, batch_size, d]
+    :param torch.tensor k: projected keys [src_len, batch_size, d]
+    :param torch.tensor v: projected values [src_len, batch_size, d]
+    :param int num_heads: number of attention heads
+    :param torch.tensor attn_mask: additive float mask [tgt_len, src_len]
+    :param torch.tensor key_padding_mask: boolean mask [batch_size, src_len], true at padded positions
+    :return torch.tensor: concatenated outputs of the heads [tgt_len, batch_size, d]
+    """
+    # (TorchScript compatible, as it is also used by the scripted deployment predictor)
+    tgt_len, batch_size, d = q.size(0), q.size(1), q.size(2)
+    head_dim = d // num_heads
+    q = (q * head_dim ** -0.5).contiguous().view(tgt_len, batch_size * num_heads, head_dim).transpose(0, 1)
+    k = k.contiguous().view(-1, batch_size * num_heads, head_dim).transpose(0, 1)
+    v = v.contiguous().view(-1, batch_size * num_heads, head_dim).transpose(0, 1)
+    attn_weights = torch.bmm(q, k.transpose(1, 2))
+    if attn_mask is not None:
+        attn_weights += attn_mask.unsqueeze(0)
+    if key_padding_mask is not None:
+        attn_weights = attn_weights.view(batch_size, num_heads, tgt_len, -1)
+        attn_weights = attn_weights.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2), float('-inf'))
+        attn_weights = attn_weights.view(batch_size * num_heads, tgt_len, -1)
+    attn_output = torch.bmm(F.softmax(attn_weights, dim=-1), v)
+    return attn_output.transpose(0, 1).contiguous().view(tgt_len, batch_size, d)
+
+
+def cached_multi_head_attention(mha, q, k, v, attn_mask=None, key_padding_mask=None):
+    """
+    Scaled dot-product attention of nn.MultiheadAttention <mha>, for queries/keys/values that have already been
+    projected with its in_proj weights (so that keys and values can be cached between decoding steps).
+
+    :param nn.MultiheadAttention mha: attention module whose heads and output projection are used
+    :param torch.tensor q: projected queries [tgt_len, batch_size, d]
+    :param torch.tensor k: projected keys [src_len, batch_size, d]
+    :param torch.tensor v: projected values [src_len, batch_size, d]
+    :param torch.tensor attn_mask: additive float mask [tgt_len, src_len]
+    :param torch.tensor key_padding_mask: boolean mask [batch_size, src_len], true at padded positions
+    :return torch.tensor: attention output [tgt_len, batch_size, d]
+    """
+    attn_output = multi_head_attention_heads(q, k, v, mha.num_heads, attn_mask=attn_mask,
+                                             key_padding_mask=key_padding_mask)
+    return F.linear(attn_output, mha.out_proj.weight, mha.out_proj.bias)
+
+
+def stacked_linear(x, weight, bias=None):
+    """
+    Applies N linear layers (e.g. the same layer of N models) to their corresponding inputs in one batched matmul.
+
+    :param torch.tensor x: inputs [N, ..., in_features]
+    :param torch.tensor weight: stacked weights [N, out_features, in_features]
+    :param torch.tensor bias: stacked biases [N, out_features]
+    :return torch.tensor: outputs [N, ..., out_features]
+    """
+    out = torch.bmm(x.reshape(x.shape[0], -1, x.shape[-1]), weight.transpose(1, 2))
+    if bias is not None:
+        out = out + bias.unsqueeze(1)
+    return out.reshape(*x.shape[:-1], weight.shape[1])
+
+
+class StackedDecoders:
+    def __init__(self, models):
+        """
+        Incremental decoding (see TransformerModel.decode_step) of N TransformerModels with the same architecture (e.g.
+        the models trained on different cross-validation folds), computed as one batched computation: the decoder
+        parameters of the models are stacked, s.t. each linear layer of a decoding step is a single batched matmul over
+        the N models. The label embeddings/positional encodings are still computed by each model.
 
+        :param list models: TransformerModels (use StackedDecoders.can_stack to check if they are compatible)
+        """
+        self.models = models
+        self.train_only_decoder = models[0].train_only_decoder
+        all_layers = [m.get_decoder_layers() for m in models]
+        self.num_heads = all_layers[0][0][0].self_attn.num_heads
+        self.activation = all_layers[0][0][0].activation
+        self.layers = []
+        for layer_ind in range(len(all_layers[0][0])):
+            params = [dict(layers[layer_ind].named_parameters()) for layers, _ in all_layers]
+            self.layers.append({n: torch.stack([p[n].detach() for p in params]) for n in params[0]})
+        self.eps = all_layers[0][0][0].norm1.eps
+        self.norm = None if all_layers[0][1] is None else \
+            (torch.stack([norm.weight.detach() for _, norm in all_layers]),
+             torch.stack([norm.bias.detach() for _, norm in all_layers]))
+        self.generator = (torch.stack([m.generator.weight.detach() for m in models]),
+                          torch.stack([m.generator.bias.detach() for m in models]))
+
+    @staticmethod
+    def can_stack(models, caches):
+        """
+        :param list models: TransformerModels
+        :param list caches: their caches (see TransformerModel.init_decoder_cache)
+        :return bool: true if the models have the same decoder architecture (parameter shapes) and memory shapes
+        """
+        if any(isinstance(mod, torch.nn.quantized.dynamic.Linear) for m in models for mod in m.modules()):
+            # int8 quantized decoders (see quantize_model) have packed weights that cannot be stacked
+            return False
+        def shapes(m):
+            return [p.shape for p in m.get_decoder_layers()[0].parameters()] + [m.generator.weight.shape] + \
+                   [m.get_decoder_layers()[0][0].self_attn.num_heads, m.train_only_decoder,
+                    m.get_decoder_layers()[1] is None]
+        return all(shapes(m) == shapes(models[0]) for m in models) and \
+            all(c["memory_kv"][0][0].shape == caches[0]["memory_kv"][0][0].shape for c in caches) and \
+            all((c["padding_mask_src"] is None) == (caches[0]["padding_mask_src"] is None) for c in caches)
+
+    def stack_caches(self, caches):
+        """
+        :param list caches: the caches of the N models (see TransformerModel.init_decoder_cache)
+        :return dict: stacked cache used by decode_step (memory keys/values [N, src_len, batch_size, d])
+        """
+        return {"memory_kv": [(torch.stack([c["memory_kv"][l][0] for c in caches]),
+                               torch.stack([c["memory_kv"][l][1] for c in caches]))
+                              for l in range(len(self.layers))],
+                "self_kv": [None] * len(self.layers),
+                "padding_mask_src": None if caches[0]["padding_mask_src"] is None else
+                torch.stack([c["padding_mask_src"] for c in caches]),
+                "inp_seqs": caches[0]["inp_seqs"], "step": 0}
+
+    def layer_norm(self, x, weight, bias):
+        x = F.layer_norm(x, x.shape[-1:], eps=self.eps)
+        return x * weight.view(weight.shape[0], *[1] * (x.dim() - 2), -1) + \
+               bias.view(bias.shape[0], *[1] * (x.dim() - 2), -1)
+
+    def attention(self, q, k, v, attn_mask=None, key_padding_mask=None):
+        # the N models are processed as N * batch_size attention "batch" elements
+        no_models, tgt_len, batch_size, d = q.shape
+        q, k, v = [t.transpose(0, 1).reshape(t.shape[1], no_models * batch_size, d) for t in [q, k, v]]
+        if key_padding_mask is not None:
+            key_padding_mask = key_padding_mask.reshape(no_models * batch_size, -1)
+        attn_output = multi_head_attention_heads(q, k, v, self.num_heads, attn_mask=attn_mask,
+                                                 key_padding_mask=key_padding_mask)
+        return attn_output.reshape(tgt_len, no_models, batch_size, d).transpose(0, 1)
+
+    def decode_step(self, tgt: Tensor, cache: dict):
+        """
+        :param torch.tensor tgt: [batch_size, no_new_tokens] label indices (see TransformerModel.decode_step)
+        :param dict cache: state returned by stack_caches
+        :return (torch.tensor, torch.tensor): generator outputs [N, no_new_tokens, batch_size, ntoken] and the
+                decoder outputs [N, no_new_tokens, batch_size, d] of the new positions
+        """
+        offset = cache["step"]
+        x = torch.stack([m.pos_encoder((m.label_encoder.embedding(tgt.long()) *
+                                        math.sqrt(m.label_encoder.emb_size)).transpose(0, 1), offset=offset)
+                         for m in self.models])
+        no_new_tokens = x.shape[1]
+        attn_mask = torch.triu(torch.full((no_new_tokens, offset + no_new_tokens), float('-inf'), device=x.device),
+                               diagonal=offset + 1) if no_new_tokens > 1 else None
+        d = x.shape[-1]
+        for ind, p in enumerate(self.layers):
+            q, k, v = stacked_linear(x, p["self_attn.in_proj_weight"], p["self_attn.in_proj_bias"]).chunk(3, dim=-1)
+            if cache["self_kv"][ind] is not None:
+                k = torch.cat([cache["self_kv"][ind][0], k], dim=1)
+                v = torch.cat([cache["self_kv"][ind][1], v], dim=1)
+            cache["self_kv"][ind] = (k, v)
+            attn = self.attention(q, k, v, attn_mask=attn_mask)
+            x = self.layer_norm(x + stacked_linear(attn, p["self_attn.out_proj.weight"], p["self_attn.out_proj.bias"]),
+                                p["norm1.weight"], p["norm1.bias"])
+            q = stacked_linear(x, p["multihead_attn.in_proj_weight"][:, :d], p["multihead_attn.in_proj_bias"][:, :d])
+            mem_k, mem_v = cache["memory_kv"][ind]
+            attn = self.attention(q, mem_k, mem_v, key_padding_mask=cache["padding_mask_src"])
+            x = self.layer_norm(x + stacked_linear(attn, p["multihead_attn.out_proj.weight"],
+                                                   p["multihead_attn.out_proj.bias"]),
+                                p["norm2.weight"], p["norm2.bias"])
+            ff = stacked_linear(self.activation(stacked_linear(x, p["linear1.weight"], p["linear1.bias"])),
+                                p["linear2.weight"], p["linear2.bias"])
+            x = self.layer_norm(x + ff, p["norm3.weight"], p["norm3.bias"])
+        if self.norm is not None:
+            x = self.layer_norm(x, *self.norm)
+        cache["step"] = offset + no_new_tokens
+        gen_inp = x
+        if self.train_only_decoder and self.models[0].residue_emb_extra_dims:
+            # the extra residue embeddings only depend on the sequences; compute them once for all models
+            extra = self.models[0].get_extra_tensor(cache["inp_seqs"], x[0], offset=offset)[:, :, d:]
+            gen_inp = torch.cat([x, extra.unsqueeze(0).expand(x.shape[0], -1, -1, -1)], dim=-1)
+        return stacked_linear(gen_inp, *self.generator), x
 
 
 class TransformerModel(nn.Module):
@@ -455,23 +637,24 @@ class TransformerModel(nn.Module):
         padded_src_glbl = torch.nn.utils.rnn.pad_sequence(src_for_glbl_l, batch_first=True)
         return self.glbl_generator(padded_src_glbl)
 
-    def get_extra_tensor(self, inp_seqs, outs):
+    def get_extra_tensor(self, inp_seqs, outs, offset=0):
+        # offset: position of the first output in outs (incremental decoding only passes the newest positions)
         extra_embs = []
         if self.use_blosum:
             for i_s in inp_seqs:
-                inp_extra_emb = i_s + "X" * (outs.shape[0] - len(i_s))
-                if outs.shape[0] < len(inp_extra_emb):
+                inp_extra_emb = i_s + "X" * (offset + outs.shape[0] - len(i_s))
+                if offset + outs.shape[0] < len(inp_extra_emb) or offset:
                     # during inference, not all outs are present at once (so inp_sequence_length > output_sequence_length)
-                    inp_extra_emb = inp_extra_emb[:outs.shape[0]]
+                    inp_extra_emb = inp_extra_emb[offset:offset + outs.shape[0]]
                 extra_emb_tensor = torch.cat([torch.tensor([self.extra_embs_gen_input[r] for r in inp_extra_emb],
                                                            device=self.device, dtype=torch.float32)])
                 extra_embs.append(extra_emb_tensor )
         elif self.use_extra_oh:
             for i_s in inp_seqs:
-                inp_extra_emb = i_s + "X" * (outs.shape[0] - len(i_s))
-                if outs.shape[0] < len(inp_extra_emb):
+                inp_extra_emb = i_s + "X" * (offset + outs.shape[0] - len(i_s))
+                if offset + outs.shape[0] < len(inp_extra_emb) or offset:
                     # during inference, not all outs are present at once
-                    inp_extra_emb = inp_extra_emb[:outs.shape[0]]
+                    inp_extra_emb = inp_extra_emb[offset:offset + outs.shape[0]]
                 extra_emb_tensor = self.make_oh(inp_extra_emb)
                 extra_embs.append(extra_emb_tensor )
         extra_embs = torch.stack(extra_embs).permute(1,0,2)
@@ -500,6 +683,106 @@ class TransformerModel(nn.Module):
             outs = self.get_extra_tensor(inp_seqs, outs)
         return self.generator(outs)
 
+    def get_decoder_layers(self):
+        if self.train_only_decoder:
+            return self.transformer.layers, self.transformer.norm
+        return self.transformer.decoder.layers, self.transformer.decoder.norm
+
+    def init_decoder_cache(self, memory, padding_mask_src=None, inp_seqs=None):
+        """
+        Prepares the state used by decode_step for incremental decoding. The memory is processed in the same way
+        decode/forward_only_decoder process it, and the cross-attention keys/values of each decoder layer are
+        projected only once (here), instead of at every decoding step.
+
+        :param torch.tensor memory: encoder output [seq_len, batch_size, d] or, when <train_only_decoder> is true, the
+                padded input_encoder outputs [batch_size, seq_len, d]
+        :param torch.tensor padding_mask_src: key padding mask of the memory [batch_size, seq_len]
+        :param list inp_seqs: residue sequences (used for the padding mask and the extra residue embeddings when
+                <train_only_decoder> is true)
+        :return dict: decoding cache, updated in-place by decode_step
+        """
+        if self.train_only_decoder:
+            if padding_mask_src is None:
+                _, _, padding_mask_src, _, _ = self.input_encoder(memory, inp_seqs=inp_seqs)
+            no_pos_enc = False if self.add_bert_pe_from_dec_to_bert_out else self.no_pos_enc
+            memory = self.pos_encoder(memory.transpose(0, 1), scale=self.scale_input, no_pos_enc=no_pos_enc,
+                                      add_lg_info=self.add_lg_info)
+        layers, _ = self.get_decoder_layers()
+        memory_kv = []
+        for layer in layers:
+            d = layer.multihead_attn.embed_dim
+            w, b = layer.multihead_attn.in_proj_weight, layer.multihead_attn.in_proj_bias
+            memory_kv.append((F.linear(memory, w[d:2 * d], b[d:2 * d]), F.linear(memory, w[2 * d:], b[2 * d:])))
+        return {"memory_kv": memory_kv, "self_kv": [None] * len(layers), "padding_mask_src": padding_mask_src,
+                "inp_seqs": inp_seqs, "step": 0}
+
+    def decode_step(self, tgt: Tensor, cache: dict):
+        """
+        Incremental counterpart of decode: only the label tokens that were not decoded yet are given, and the
+        self-attention keys/values of all previous positions are read from (and the new ones appended to) <cache>.
+
+        :param torch.tensor tgt: [batch_size, no_new_tokens] label indices (the first call needs to start with <BOS>,
+                as the label_encoder is not used here)
+        :param dict cache: state returned by init_decoder_cache
+        :return (torch.tensor, torch.tensor): generator outputs [no_new_tokens, batch_size, ntoken] and the decoder
+                outputs [no_new_tokens, batch_size, d] of the new positions
+        """
+        offset = cache["step"]
+        x = self.label_encoder.embedding(tgt.long()) * math.sqrt(self.label_encoder.emb_size)
+        x = self.pos_encoder(x.transpose(0, 1), offset=offset)
+        no_new_tokens = x.shape[0]
+        # new tokens may only attend to the previous ones (the cached positions are all in the "past")
+        attn_mask = torch.triu(torch.full((no_new_tokens, offset + no_new_tokens), float('-inf'), device=x.device),
+                               diagonal=offset + 1) if no_new_tokens > 1 else None
+        layers, norm = self.get_decoder_layers()
+        for ind, layer in enumerate(layers):
+            self_attn, cross_attn = layer.self_attn, layer.multihead_attn
+            q, k, v = F.linear(x, self_attn.in_proj_weight, self_attn.in_proj_bias).chunk(3, dim=-1)
+            if cache["self_kv"][ind] is not None:
+                k = torch.cat([cache["self_kv"][ind][0], k], dim=0)
+                v = torch.cat([cache["self_kv"][ind][1], v], dim=0)
+            cache["self_kv"][ind] = (k, v)
+            x = layer.norm1(x + layer.dropout1(cached_multi_head_attention(self_attn, q, k, v, attn_mask=attn_mask)))
+            d = cross_attn.embed_dim
+            q = F.linear(x, cross_attn.in_proj_weight[:d], cross_attn.in_proj_bias[:d])
+            mem_k, mem_v = cache["memory_kv"][ind]
+            x = layer.norm2(x + layer.dropout2(cached_multi_head_attention(cross_attn, q, mem_k, mem_v,
+                                                                           key_padding_mask=cache["padding_mask_src"])))
+            x = layer.norm3(x + layer.dropout3(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
+        if norm is not None:
+            x = norm(x)
+        cache["step"] = offset + no_new_tokens
+        if self.train_only_decoder and self.residue_emb_extra_dims:
+            if cache.get("extra_embs") is not None:
+                # extra residue representations of the new positions, given by the caller (exported decoder steps)
+                return self.generator(torch.cat([x, cache["extra_embs"]], dim=-1)), x
+            return self.generator(self.get_extra_tensor(cache["inp_seqs"], x, offset=offset)), x
+        return self.generator(x), x
+
+    def select_decoder_cache(self, cache, rows, reorder_beams=False):
+        """
+        Keeps only the batch rows <rows> in the decoding cache (e.g. when finished sequences are dropped from the
+        decoded batch, or rows are repeated for multiple hypotheses of the same sequence).
+
+        :param dict cache: state returned by init_decoder_cache
+        :param list rows: indices of the rows (in the current cache) that are kept (list or LongTensor)
+        :param bool reorder_beams: <rows> only reorder the beams of each sequence (beam search). The memory
+                keys/values, padding mask and input sequences are then the same for all beams of a sequence, and only
+                the self-attention state is selected
+        :return dict: the cache, modified in-place
+        """
+        rows_ = rows if isinstance(rows, Tensor) else torch.tensor(rows, device=cache["memory_kv"][0][0].device)
+        cache["self_kv"] = [(kv[0][:, rows_], kv[1][:, rows_]) if kv is not None else None for kv in cache["self_kv"]]
+        if reorder_beams:
+            return cache
+        rows = rows.tolist() if isinstance(rows, Tensor) else rows
+        cache["memory_kv"] = [(k[:, rows_], v[:, rows_]) for k, v in cache["memory_kv"]]
+        if cache["padding_mask_src"] is not None:
+            cache["padding_mask_src"] = cache["padding_mask_src"][rows_.to(cache["padding_mask_src"].device)]
+        if cache["inp_seqs"] is not None:
+            cache["inp_seqs"] = [cache["inp_seqs"][r] for r in rows]
+        return cache
+
     def forward(self, src: Tensor, tgt: list, inp_seqs=None) -> Tensor:
         """
         Args:
@@ -597,13 +880,15 @@ class PositionalEncoding(nn.Module):
         self.pos_enc = torch.nn.Embedding(40000, 1024).to(self.device)
         self.pos_enc.load_state_dict(pe.state_dict())
 
-    def forward(self, x: Tensor, scale=False, no_pos_enc=False, add_lg_info=False) -> Tensor:
+    def forward(self, x: Tensor, scale=False, no_pos_enc=False, add_lg_info=False, offset=0) -> Tensor:
         """
         Args:
             x: Tensor, shape [seq_len, batch_size, embedding_dim]
+            offset: position of the first element of x (used when decoding incrementally, where only the newest
+                label tokens are given)
         """
         if self.linear_pos_enc and not no_pos_enc and self.concat_pos_enc:
-            pe_ = self.pos_enc[:x.size(0)]
+            pe_ = self.pos_enc[offset:offset + x.size(0)]
             # print(pe_, pe_.shape,x.shape,pe_.repeat(1,x.size(1),1).shape)
             # print(.shape)
             # exit(1)
@@ -615,17 +900,17 @@ class PositionalEncoding(nn.Module):
 
             return x
         if self.linear_pos_enc and not no_pos_enc:
-            pos_enc = self.pos_enc(torch.tensor(list(range(x.shape[0]))).to(self.device))
+            pos_enc = self.pos_enc(torch.tensor(list(range(offset, offset + x.shape[0]))).to(self.device))
             pos_enc = pos_enc.repeat(1, x.shape[1]).reshape(x.shape[0], x.shape[1], x.shape[2])
             if scale:
-                x = self.dropout(x * np.sqrt(1024) + self.pe[:x.size(0)] + pos_enc)
+                x = self.dropout(x * np.sqrt(1024) + self.pe[offset:offset + x.size(0)] + pos_enc)
                 return x
             else:
                 return self.dropout(x + pos_enc)# + self.pe[:x.size(0)])
         if no_pos_enc:
             return self.dropout(x)
         if scale:
-            x = self.dropout(x * np.sqrt(1024)+ self.pe[:x.size(0)])
+            x = self.dropout(x * np.sqrt(1024)+ self.pe[offset:offset + x.size(0)])
         else:
             if add_lg_info:
                 pe_ = self.pe[:x.size(0)-1]
@@ -639,7 +924,7 @@ class PositionalEncoding(nn.Module):
 
             else:
                 if self.concat_pos_enc:
-                    pe_ = self.pe[:x.size(0)] #* 0.1
+                    pe_ = self.pe[offset:offset + x.size(0)] #* 0.1
                     # print(pe_, pe_.shape,x.shape,pe_.repeat(1,x.size(1),1).shape)
                     # print(.shape)
                     # exit(1)
@@ -648,7 +933,7 @@ class PositionalEncoding(nn.Module):
                     # print(torch.mean(torch.std(pe_, dim=2)))
                     x = torch.cat([x, pe_.repeat(1,x.size(1),1)],dim=-1)
                 else:
-                    x = self.dropout(x + self.pe[:x.size(0)])
+                    x = self.dropout(x + self.pe[offset:offset + x.size(0)])
 
         return x
 
@@ -0,0 +1,192 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models.tsignal_script import check_exportable
+
+
+class OnnxEncoderGraph(nn.Module):
+    def __init__(self, model):
+        """
+        ProtBERT + the memory preparation of the decoder (input_encoder, positional encoding and the cross-attention
+        key/value projections of TransformerModel.init_decoder_cache), exported as the first ONNX graph.
+
+        :param ProtBertClassifier model: trained (--tune_bert --train_only_decoder) model
+        """
+        super().__init__()
+        self.bert = model.ProtBertBFD
+        self.head = model.classification_head
+        self.no_special_tkns = 2 if model.hparams.special_tokens else 0
+
+    def forward(self, input_ids, attention_mask, seq_lens, ogs):
+        memory_bfd = self.bert(input_ids=input_ids, attention_mask=attention_mask)[0]
+        use_lg = 1 if self.head.input_encoder.use_lg else 0
+        # padded input_encoder outputs: the first len(seq) ProtBERT outputs of each sequence, followed by its organism
+        # group embedding
+        width = input_ids.shape[1] - self.no_special_tkns + use_lg
+        memory = torch.cat([memory_bfd, torch.zeros_like(memory_bfd[:, :1])], dim=1)[:, :width]
+        positions = torch.arange(width, device=input_ids.device).unsqueeze(0)
+        memory = memory * (positions < seq_lens.unsqueeze(1)).unsqueeze(2).type_as(memory)
+        if use_lg:
+            lg_position = (positions == seq_lens.unsqueeze(1)).unsqueeze(2).type_as(memory)
+            memory = memory + lg_position * self.head.input_encoder.lg_embs(ogs).unsqueeze(1)
+        padding_mask = positions >= (seq_lens + use_lg).unsqueeze(1)
+        cache = self.head.init_decoder_cache(memory, padding_mask_src=padding_mask)
+        return (padding_mask,) + tuple(t for kv in cache["memory_kv"] for t in kv)
+
+
+class OnnxDecoderStepGraph(nn.Module):
+    def __init__(self, model):
+        """
+        A single step of TransformerModel.decode_step (one new label for each sequence), exported as the second ONNX
+        graph. The memory and self-attention keys/values are inputs, the updated self-attention keys/values outputs.
+
+        :param ProtBertClassifier model: trained (--tune_bert --train_only_decoder) model
+        """
+        super().__init__()
+        self.head = model.classification_head
+        self.no_layers = len(self.head.get_decoder_layers()[0])
+
+    def forward(self, tgt, extra_embs, padding_mask, *kv):
+        n = self.no_layers
+        cache = {"memory_kv": [(kv[2 * i], kv[2 * i + 1]) for i in range(n)],
+                 "self_kv": [(kv[2 * n + 2 * i], kv[2 * n + 2 * i + 1]) for i in range(n)],
+                 "padding_mask_src": padding_mask, "inp_seqs": None, "step": kv[2 * n].shape[0],
+                 "extra_embs": extra_embs}
+        prob, _ = self.head.decode_step(tgt, cache)
+        return (prob[-1],) + tuple(t for kv_ in cache["self_kv"] for t in kv_)
+
+
+def get_kv_names(prefix, no_layers):
+    return [name.format(prefix, i) for i in range(no_layers) for name in ["{}_k_{}", "{}_v_{}"]]
+
+
+def export_onnx_mdl(model, onnx_prefix, opset_version=12):
+    """
+    Exports the deployment model <model> as the ONNX graphs <onnx_prefix>_encoder.onnx and
+    <onnx_prefix>_decoder_step.onnx (see OnnxEncoderGraph, OnnxDecoderStepGraph), used by OnnxTSignalBackend.
+
+    :param ProtBertClassifier model: trained (--tune_bert --train_only_decoder) model, on the cpu
+    :param str onnx_prefix: path prefix of the exported graphs
+    :param int opset_version: ONNX opset
+    """
+    if torch.cuda.is_available():
+        raise RuntimeError("The ONNX graphs are exported for CPU inference; run the export without visible GPUs "
+                           "(e.g. CUDA_VISIBLE_DEVICES=\"\")")
+    check_exportable(model, "ONNX")
+    model.eval()
+    head = model.classification_head
+    no_layers = len(head.get_decoder_layers()[0])
+    seqs = ["MKKLLLALAVSLAQA", "MSTNPKPQRKTKRNTNRRPQDVKFPGG"]
+    inputs = model.tokenize(seqs)
+    encoder_inputs = (inputs['input_ids'], inputs['attention_mask'],
+                      torch.tensor([len(s) for s in seqs]), torch.zeros(len(seqs), dtype=torch.long))
+    encoder = OnnxEncoderGraph(model)
+    memory_kv_names = get_kv_names("memory", no_layers)
+    dynamic_axes = {"input_ids": {0: "batch", 1: "tokens"}, "attention_mask": {0: "batch", 1: "tokens"},
+                    "seq_lens": {0: "batch"}, "ogs": {0: "batch"}, "padding_mask": {0: "batch", 1: "src_len"}}
+    dynamic_axes.update({name: {0: "src_len", 1: "batch"} for name in memory_kv_names})
+    with torch.no_grad():
+        torch.onnx.export(encoder, encoder_inputs, onnx_prefix + "_encoder.onnx", opset_version=opset_version,
+                          input_names=["input_ids", "attention_mask", "seq_lens", "ogs"],
+                          output_names=["padding_mask"] + memory_kv_names, dynamic_axes=dynamic_axes)
+        encoder_outputs = encoder(*encoder_inputs)
+
+    # the decoder step is traced with 2 cached labels; the number of cached labels is a dynamic axis
+    d = encoder_outputs[1].shape[-1]
+    self_kv = [torch.randn(2, len(seqs), d) for _ in range(2 * no_layers)]
+    decoder_inputs = (torch.zeros(len(seqs), 1, dtype=torch.long),
+                      torch.zeros(1, len(seqs), head.residue_emb_extra_dims)) + tuple(encoder_outputs) + tuple(self_kv)
+    self_kv_names, new_self_kv_names = get_kv_names("self", no_layers), get_kv_names("new_self", no_layers)
+    dynamic_axes = {"tgt": {0: "batch"}, "extra_embs": {1: "batch"}, "padding_mask": {0: "batch", 1: "src_len"},
+                    "logits": {0: "batch"}}
+    dynamic_axes.update({name: {0: "src_len", 1: "batch"} for name in memory_kv_names})
+    dynamic_axes.update({name: {0: "past_len", 1: "batch"} for name in self_kv_names})
+    dynamic_axes.update({name: {0: "new_len", 1: "batch"} for name in new_self_kv_names})
+    with torch.no_grad():
+        torch.onnx.export(OnnxDecoderStepGraph(model), decoder_inputs, onnx_prefix + "_decoder_step.onnx",
+                          opset_version=opset_version,
+                          input_names=["tgt", "extra_embs", "padding_mask"] + memory_kv_names + self_kv_names,
+                          output_names=["logits"] + new_self_kv_names, dynamic_axes=dynamic_axes)
+
+
+class OnnxTSignalBackend:
+    def __init__(self, model, onnx_prefix, intra_op_threads=0):
+        """
+        Inference backend running the exported ONNX graphs (see export_onnx_mdl) with onnxruntime on the CPU. It has
+        the decoding-cache interface of TransformerModel (init_decoder_cache, decode_step, select_decoder_cache), so
+        greedy_decode can use it in place of the PyTorch decoder (see greedy_decode's <backend> argument).
+
+        :param ProtBertClassifier model: the exported model (its tokenizer, organism groups of the tested sequences and
+                extra residue embeddings are used to prepare the graph inputs)
+        :param str onnx_prefix: path prefix of the exported graphs
+        :param int intra_op_threads: onnxruntime intra-op threads (0: onnxruntime's default)
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        self.encoder = ort.InferenceSession(onnx_prefix + "_encoder.onnx", options, providers=["CPUExecutionProvider"])
+        self.decoder = ort.InferenceSession(onnx_prefix + "_decoder_step.onnx", options,
+                                            providers=["CPUExecutionProvider"])
+        # (inputs that are not used by a graph, e.g. extra_embs without extra residue embeddings, are not exported)
+        self.decoder_inputs = set(i.name for i in self.decoder.get_inputs())
+        self.model = model
+        self.head = model.classification_head
+        self.no_layers = len(self.head.get_decoder_layers()[0])
+        self.train_only_decoder = True
+
+    def init_decoder_cache(self, inp_seqs):
+        """
+        Runs the encoder graph on <inp_seqs>
+
+        :param list inp_seqs: amino acid sequences
+        :return dict: decoding cache (numpy arrays), updated in-place by decode_step
+        """
+        inputs = self.model.tokenize(inp_seqs)
+        ogs = [self.head.input_encoder.seq2lg[s] for s in inp_seqs] if self.head.input_encoder.use_lg else \
+            [0] * len(inp_seqs)
+        outputs = self.encoder.run(None, {"input_ids": inputs['input_ids'].cpu().numpy(),
+                                          "attention_mask": inputs['attention_mask'].cpu().numpy(),
+                                          "seq_lens": np.array([len(s) for s in inp_seqs], dtype=np.int64),
+                                          "ogs": np.array(ogs, dtype=np.int64)})
+        batch_size, d = len(inp_seqs), outputs[1].shape[-1]
+        extra_embs = np.zeros((max(len(s) for s in inp_seqs) + 1, batch_size, 0), dtype=np.float32)
+        if self.head.residue_emb_extra_dims:
+            with torch.no_grad():
+                extra_embs = self.head.get_extra_tensor(inp_seqs, torch.zeros(extra_embs.shape, device=self.head.device))
+            extra_embs = extra_embs.float().cpu().numpy()
+        return {"padding_mask_src": outputs[0], "memory_kv": outputs[1:],
+                "self_kv": [np.zeros((0, batch_size, d), dtype=np.float32) for _ in range(2 * self.no_layers)],
+                "extra_embs": extra_embs, "step": 0}
+
+    def decode_step(self, tgt, cache):
+        """
+        :param torch.tensor tgt: [batch_size, no_new_tokens] label indices (see TransformerModel.decode_step)
+        :param dict cache: state returned by init_decoder_cache
+        :return (torch.tensor, None): generator outputs [no_new_tokens, batch_size, ntoken]
+        """
+        tokens, all_logits = tgt.cpu().numpy().astype(np.int64), []
+        for ind in range(tokens.shape[1]):
+            step = cache["step"]
+            feed = {"tgt": tokens[:, ind:ind + 1], "extra_embs": cache["extra_embs"][step:step + 1],
+                    "padding_mask": cache["padding_mask_src"]}
+            feed.update(zip(get_kv_names("memory", self.no_layers), cache["memory_kv"]))
+            feed.update(zip(get_kv_names("self", self.no_layers), cache["self_kv"]))
+            outputs = self.decoder.run(None, {name: value for name, value in feed.items()
+                                              if name in self.decoder_inputs})
+            all_logits.append(outputs[0])
+            cache["self_kv"] = outputs[1:]
+            cache["step"] = step + 1
+        return torch.tensor(np.stack(all_logits), device=tgt.device), None
+
+    def select_decoder_cache(self, cache, rows, reorder_beams=False):
+        """ see TransformerModel.select_decoder_cache """
+        rows = np.array(rows.tolist() if isinstance(rows, torch.Tensor) else rows, dtype=np.int64)
+        cache["self_kv"] = [kv[:, rows] for kv in cache["self_kv"]]
+        if reorder_beams:
+            return cache
+        cache["memory_kv"] = [kv[:, rows] for kv in cache["memory_kv"]]
+        cache["padding_mask_src"] = cache["padding_mask_src"][rows]
+        cache["extra_embs"] = cache["extra_embs"][:, rows]
+        return cache
@@ -0,0 +1,239 @@
+import math
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from models.transformer_nmt import multi_head_attention_heads
+
+
+def check_exportable(model, export_format):
+    """
+    Raises NotImplementedError if <model> is not in the deployment configuration of TSignal (ProtBERT tuned together
+    with a decoder-only TSignal head, --tune_bert --train_only_decoder) supported by the exported predictors.
+
+    :param model: ProtBertClassifier
+    :param str export_format: name of the format (used in the error messages)
+    """
+    head = model.classification_head
+    if not head.train_only_decoder:
+        raise NotImplementedError("Only --train_only_decoder models can be exported to {}".format(export_format))
+    if head.pos_encoder.linear_pos_enc or head.extra_dims_decoder or head.input_encoder.aa2ind is not None or \
+            head.use_glbl_lbls:
+        raise NotImplementedError("Linear pe., extra decoder input embeddings, one-hot inputs and global labels are "
+                                  "not supported by the {} export".format(export_format))
+    if head.residue_emb_extra_dims and not (head.use_extra_oh or head.use_blosum):
+        raise NotImplementedError("Only one-hot/blosum extra generator inputs are supported by the {} "
+                                  "export".format(export_format))
+
+
+class ScriptDecoderLayer(nn.Module):
+    def __init__(self, layer):
+        """
+        TorchScript-compatible, incremental (one label per call, with cached self-attention keys/values) version of a
+        trained post-norm nn.TransformerDecoderLayer (see TransformerModel.decode_step).
+
+        :param nn.TransformerDecoderLayer layer: trained decoder layer; its parameters are copied as buffers
+        """
+        super().__init__()
+        self.num_heads = layer.self_attn.num_heads
+        self.d = layer.self_attn.embed_dim
+        self.eps = layer.norm1.eps
+        self.use_gelu = layer.activation is F.gelu
+        for name, param in layer.named_parameters():
+            self.register_buffer(name.replace(".", "_"), param.detach().clone())
+
+    def memory_kv(self, memory: Tensor) -> Tuple[Tensor, Tensor]:
+        d = self.d
+        return F.linear(memory, self.multihead_attn_in_proj_weight[d:2 * d], self.multihead_attn_in_proj_bias[d:2 * d]), \
+               F.linear(memory, self.multihead_attn_in_proj_weight[2 * d:], self.multihead_attn_in_proj_bias[2 * d:])
+
+    def forward(self, x: Tensor, self_k: Tensor, self_v: Tensor, mem_k: Tensor,
+                mem_v: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        q, k, v = F.linear(x, self.self_attn_in_proj_weight, self.self_attn_in_proj_bias).chunk(3, dim=-1)
+        self_k, self_v = torch.cat([self_k, k], dim=0), torch.cat([self_v, v], dim=0)
+        attn = multi_head_attention_heads(q, self_k, self_v, self.num_heads)
+        x = F.layer_norm(x + F.linear(attn, self.self_attn_out_proj_weight, self.self_attn_out_proj_bias), [self.d],
+                         self.norm1_weight, self.norm1_bias, self.eps)
+        q = F.linear(x, self.multihead_attn_in_proj_weight[:self.d], self.multihead_attn_in_proj_bias[:self.d])
+        attn = multi_head_attention_heads(q, mem_k, mem_v, self.num_heads)
+        x = F.layer_norm(x + F.linear(attn, self.multihead_attn_out_proj_weight, self.multihead_attn_out_proj_bias),
+                         [self.d], self.norm2_weight, self.norm2_bias, self.eps)
+        h = F.linear(x, self.linear1_weight, self.linear1_bias)
+        h = F.gelu(h) if self.use_gelu else F.relu(h)
+        x = F.layer_norm(x + F.linear(h, self.linear2_weight, self.linear2_bias), [self.d], self.norm3_weight,
+                         self.norm3_bias, self.eps)
+        return x, self_k, self_v
+
+
+class TSignalScriptPredictor(nn.Module):
+    def __init__(self, bert, model, lbl2ind, og2ind):
+        """
+        Self-contained ProtBERT + TSignal predictor, meant to be compiled with torch.jit.script and saved as a single
+        artifact (see export_script_mdl in cv_train_cs_predictors). It holds the tokenization tables, the (traced)
+        ProtBERT model, the decoder and the post-processing of the predicted labels, so it can be used with only torch:
+
+            predictor = torch.jit.load("tsignal.pt")
+            with torch.no_grad():
+                lbls, sp_types, css, probs = predictor(["MKK...", ...], ["EUKARYA", ...])
+
+        Only the deployment configuration of TSignal (ProtBERT tuned together with a decoder-only TSignal head, i.e.
+        --tune_bert --train_only_decoder) is supported. Sequences are greedily decoded one at a time.
+
+        :param torch.jit.ScriptModule bert: traced model.ProtBertBFD (input_ids, attention_mask) -> (outputs, pooled)
+        :param ProtBertClassifier model: trained model
+        :param dict lbl2ind: residue label to index dictionary
+        :param dict og2ind: organism group to index dictionary
+        """
+        super().__init__()
+        check_exportable(model, "TorchScript")
+        head = model.classification_head
+        self.bert = bert
+        # tokenization: residue (byte) -> ProtBERT token LUT
+        vocab = model.tokenizer.get_vocab()
+        aa2tkn = torch.full((256,), vocab["[UNK]"], dtype=torch.long)
+        for tkn, ind in vocab.items():
+            if len(tkn) == 1 and ord(tkn) < 256:
+                aa2tkn[ord(tkn)] = ind
+        self.register_buffer("aa2tkn", aa2tkn)
+        self.cls_id, self.sep_id = vocab["[CLS]"], vocab["[SEP]"]
+        self.special_tokens = bool(model.hparams.special_tokens)
+        self.max_length = int(model.hparams.max_length)
+        # residue (byte) -> extra (non-contextual) generator input LUT (see TransformerModel.get_extra_tensor)
+        self.extra_dims = head.residue_emb_extra_dims
+        extra_lut = torch.zeros(256, self.extra_dims)
+        for c in range(256 if self.extra_dims else 0):
+            r = chr(c) if chr(c) in head.aa2ind_extra else "X"
+            if head.use_extra_oh:
+                extra_lut[c, head.aa2ind_extra[r]] = 1
+            else:
+                extra_lut[c] = torch.tensor(head.extra_embs_gen_input[r], dtype=torch.float32)
+        self.register_buffer("extra_lut", extra_lut)
+        # memory preparation (see TransformerModel.init_decoder_cache)
+        self.use_lg = head.input_encoder.use_lg
+        self.register_buffer("lg_embs", head.input_encoder.lg_embs.embedding.weight.detach().clone() * math.sqrt(1024)
+                             if self.use_lg else torch.zeros(1, 1024))
+        self.og2ind: Dict[str, int] = {og: int(ind) for og, ind in og2ind.items()}
+        self.register_buffer("pe", head.pos_encoder.pe.detach().clone())
+        self.concat_pos_enc = head.pos_encoder.concat_pos_enc
+        self.scale_input = bool(head.scale_input)
+        self.memory_no_pos_enc = False if head.add_bert_pe_from_dec_to_bert_out else bool(head.no_pos_enc)
+        self.add_lg_info = head.add_lg_info
+        # decoder
+        layers, norm = head.get_decoder_layers()
+        self.register_buffer("lbl_embs", head.label_encoder.embedding.weight.detach().clone() *
+                             math.sqrt(head.label_encoder.emb_size))
+        self.layers = nn.ModuleList([ScriptDecoderLayer(layer) for layer in layers])
+        self.d = self.layers[0].d
+        self.has_norm = norm is not None
+        self.register_buffer("norm_weight", norm.weight.detach().clone() if self.has_norm else torch.ones(self.d))
+        self.register_buffer("norm_bias", norm.bias.detach().clone() if self.has_norm else torch.zeros(self.d))
+        self.norm_eps = norm.eps if self.has_norm else 1e-5
+        self.register_buffer("generator_weight", head.generator.weight.detach().clone())
+        self.register_buffer("generator_bias", head.generator.bias.detach().clone())
+        # post-processing
+        ind2lbl = {v: k for k, v in lbl2ind.items()}
+        self.ind2lbl: List[str] = [ind2lbl[i] for i in range(len(ind2lbl))]
+        self.bos_ind, self.eos_ind = lbl2ind["BS"], lbl2ind["ES"]
+        self.sp_lbls: List[str] = ['S', 'T', 'L', 'P', 'W']
+
+    def add_pe(self, x: Tensor, offset: int, scale: bool, no_pos_enc: bool, add_lg_info: bool) -> Tensor:
+        """ PositionalEncoding.forward (for a batch of 1 and sine-based pe.) """
+        if no_pos_enc:
+            return x
+        n = x.size(0)
+        if scale:
+            return x * math.sqrt(1024.) + self.pe[offset:offset + n]
+        if add_lg_info:
+            # no pe. for the organism group embedding
+            pe = torch.cat([self.pe[:n - 1], torch.zeros(1, 1, self.pe.size(2), device=x.device)], dim=0)
+        else:
+            pe = self.pe[offset:offset + n]
+        if self.concat_pos_enc:
+            return torch.cat([x, pe], dim=-1)
+        return x + pe
+
+    @torch.jit.export
+    def tokenize(self, seq: str) -> Tensor:
+        codes: List[int] = []
+        for r in seq:
+            codes.append(ord(r))
+        return torch.tensor(codes, dtype=torch.long, device=self.aa2tkn.device).clamp(0, 255)
+
+    def encode(self, seq: str, og: str, codes: Tensor) -> Tensor:
+        tkns = self.aa2tkn[codes]
+        if self.special_tokens:
+            tkns = torch.cat([torch.tensor([self.cls_id], device=tkns.device), tkns[:self.max_length - 2],
+                              torch.tensor([self.sep_id], device=tkns.device)])
+        else:
+            tkns = tkns[:self.max_length]
+        tkns = tkns.unsqueeze(0)
+        memory = self.bert(tkns, torch.ones_like(tkns))[0][0, :len(seq)]
+        if self.use_lg:
+            memory = torch.cat([memory, self.lg_embs[self.og2ind[og]].unsqueeze(0)], dim=0)
+        return self.add_pe(memory.unsqueeze(1), 0, self.scale_input, self.memory_no_pos_enc, self.add_lg_info)
+
+    @torch.jit.export
+    def predict(self, seq: str, og: str) -> Tuple[str, str, int, Tensor]:
+        """
+        :param str seq: amino acid sequence
+        :param str og: organism group (e.g. EUKARYA); only used by models trained with --add_og_info
+        :return (str, str, int, torch.tensor): the predicted labels, the SP label (or NO_SP), the cleavage site
+                (-1 for NO_SP predictions) and the probabilities of the predicted labels [len(seq)]
+        """
+        codes = self.tokenize(seq)
+        memory = self.encode(seq, og, codes)
+        extra = self.extra_lut[codes]
+        mem_k: List[Tensor] = []
+        mem_v: List[Tensor] = []
+        self_k: List[Tensor] = []
+        self_v: List[Tensor] = []
+        for layer in self.layers:
+            k, v = layer.memory_kv(memory)
+            mem_k.append(k)
+            mem_v.append(v)
+            self_k.append(torch.zeros(0, 1, self.d, device=memory.device))
+            self_v.append(torch.zeros(0, 1, self.d, device=memory.device))
+        lbl = self.bos_ind
+        lbls: List[str] = []
+        probs: List[Tensor] = []
+        for step in range(len(seq)):
+            x = self.add_pe(self.lbl_embs[lbl].view(1, 1, -1), step, False, False, False)
+            ind = 0
+            for layer in self.layers:
+                x, k, v = layer(x, self_k[ind], self_v[ind], mem_k[ind], mem_v[ind])
+                self_k[ind] = k
+                self_v[ind] = v
+                ind += 1
+            if self.has_norm:
+                x = F.layer_norm(x, [self.d], self.norm_weight, self.norm_bias, self.norm_eps)
+            x = x[0, 0]
+            if self.extra_dims:
+                x = torch.cat([x, extra[step]])
+            logits = F.linear(x, self.generator_weight, self.generator_bias)
+            logits[self.eos_ind] = float('-inf')
+            prob = torch.softmax(logits, dim=-1)
+            lbl = int(torch.argmax(prob).item())
+            lbls.append(self.ind2lbl[lbl])
+            probs.append(prob[lbl])
+        sp_type, cs = "NO_SP", -1
+        if len(lbls) and lbls[0] in self.sp_lbls:
+            sp_type, cs = lbls[0], 0
+            while cs < len(lbls) and lbls[cs] == lbls[0]:
+                cs += 1
+        return "".join(lbls), sp_type, cs, torch.stack(probs) if len(probs) else torch.zeros(0)
+
+    def forward(self, seqs: List[str], ogs: List[str]) -> Tuple[List[str], List[str], List[int], List[Tensor]]:
+        lbls: List[str] = []
+        sp_types: List[str] = []
+        css: List[int] = []
+        probs: List[Tensor] = []
+        for ind in range(len(seqs)):
+            seq_lbls, sp_type, cs, seq_probs = self.predict(seqs[ind], ogs[ind])
+            lbls.append(seq_lbls)
+            sp_types.append(sp_type)
+            css.append(cs)
+            probs.append(seq_probs)
+        return lbls, sp_types, css, probs
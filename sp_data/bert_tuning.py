@@ -18,6 +18,9 @@ import torch.nn as nn
 from torch import optim
 from torch.utils.data import DataLoader, RandomSampler
 from models.transformer_nmt import TokenEmbedding, PositionalEncoding
+from utils.residue_tokenizer import ResidueTokenizer
+from utils.seq_packing import packed_bert_forward
+from sp_data.columnar_partitions import load_partition
 from torch.nn import TransformerDecoder, TransformerDecoderLayer
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import TestTubeLogger
@@ -48,19 +51,19 @@ def gpu_acc_metric(y_hat, labels):
 
 def extract_seq_lbls(folds=[0, 1], t_set="train", relative_data_path="", use_glbl_lbls=False):
     prefix = "sublbls_" if use_glbl_lbls else ""
-    data = pickle.load(open(relative_data_path + "sp6_partitioned_data_" + prefix + "{}_{}.bin".format(t_set, folds[0]), "rb"))
+    data = load_partition(relative_data_path + "sp6_partitioned_data_" + prefix + "{}_{}.bin".format(t_set, folds[0]))
     seqs = list(data.keys())
     lbls = [data[s][1] for s in seqs]
     glbl_lbls = [data[s][3] for s in seqs]
     sp_types = [data[s][-1] for s in seqs]
-    data = pickle.load(open(relative_data_path + "sp6_partitioned_data_" + prefix + "{}_{}.bin".format(t_set, folds[1]), "rb"))
+    data = load_partition(relative_data_path + "sp6_partitioned_data_" + prefix + "{}_{}.bin".format(t_set, folds[1]))
     keys_2nd_data = list(data.keys())
     seqs.extend(keys_2nd_data)
     lbls.extend(data[s][1] for s in keys_2nd_data)
     glbl_lbls.extend(data[s][3] for s in keys_2nd_data)
     sp_types.extend([data[s][-1] for s in keys_2nd_data])
     if len(folds) == 3:
-        data = pickle.load(open(relative_data_path + "sp6_partitioned_data_" + prefix + "{}_{}.bin".format(t_set, folds[2]), "rb"))
+        data = load_partition(relative_data_path + "sp6_partitioned_data_" + prefix + "{}_{}.bin".format(t_set, folds[2]))
         keys_3rd_data = list(data.keys())
         seqs.extend(keys_3rd_data)
         lbls.extend(data[s][1] for s in keys_3rd_data)
@@ -94,17 +97,17 @@ def create_sp6_training_ds(relative_data_path, folds=[0, 1], use_glbl_lbls=False
 
 
 def create_sp6_tuning_dataset(relative_data_path, folds=[0, 1]):
-    data = pickle.load(open(relative_data_path + "sp6_partitioned_data_train_{}.bin".format(folds[0]), "rb"))
+    data = load_partition(relative_data_path + "sp6_partitioned_data_train_{}.bin".format(folds[0]))
     seqs = list(data.keys())
     lbls = [data[s][1] for s in seqs]
     sp_types = [data[s][-1] for s in seqs]
-    data = pickle.load(open(relative_data_path + "sp6_partitioned_data_train_{}.bin".format(folds[1]), "rb"))
+    data = load_partition(relative_data_path + "sp6_partitioned_data_train_{}.bin".format(folds[1]))
     keys_2nd_data = list(data.keys())
     seqs.extend(keys_2nd_data)
     lbls.extend(data[s][1] for s in keys_2nd_data)
     sp_types.extend([data[s][-1] for s in keys_2nd_data])
     if len(folds) == 3:
-        data = pickle.load(open(relative_data_path + "sp6_partitioned_data_train_{}.bin".format(folds[2]), "rb"))
+        data = load_partition(relative_data_path + "sp6_partitioned_data_train_{}.bin".format(folds[2]))
         keys_3rd_data = list(data.keys())
         seqs.extend(keys_3rd_data)
         lbls.extend(data[s][1] for s in keys_3rd_data)
@@ -542,10 +545,74 @@ class ProtBertClassifier(pl.LightningModule):
         self.train_BFD= True
         if self._frozen:
             log.info(f"\n-- Encoder model fine-tuning")
+            # (the embeddings and bottom layers of partially tuned models, see set_lower_layer_cache, and the base weights
+            # of LoRA-tuned models stay frozen)
+            lower_layer_cache = getattr(self, "lower_layer_cache", None)
+            permanently_frozen = set(id(p) for p in lower_layer_cache.frozen_modules.parameters()) \
+                if lower_layer_cache is not None else set()
+            if getattr(self, "lora_config", None) is not None:
+                permanently_frozen.update(id(p) for n, p in self.ProtBertBFD.named_parameters() if "lora_" not in n)
             for name, param in self.ProtBertBFD.named_parameters():
-                if "position_embeddings" not in name or not no_bert_pe_training:
+                if ("position_embeddings" not in name or not no_bert_pe_training) and id(param) not in permanently_frozen:
                     param.requires_grad = True
             self._frozen = False
+        if getattr(self, "frozen_output_cache", None) is not None:
+            # the cached outputs of the frozen encoder are outdated as soon as it is tuned
+            self.frozen_output_cache.clear()
+            self.frozen_output_cache = None
+
+    def tokenize(self, seqs):
+        """
+        Tokenizes the amino acid sequences <seqs> directly into padded tensors on the model's device (see
+        ResidueTokenizer); the returned dictionary can be given to forward (along with targets/sequences)
+        """
+        return self.get_residue_tokenizer()(seqs, device=self.device)
+
+    def get_residue_tokenizer(self):
+        if getattr(self, "residue_tokenizer", None) is None:
+            # (also for models saved before the residue tokenizer was added)
+            self.residue_tokenizer = ResidueTokenizer(self.tokenizer.get_vocab(), self.hparams.special_tokens,
+                                                      self.hparams.max_length)
+        return self.residue_tokenizer
+
+    def bert_forward(self, input_ids, attention_mask):
+        """
+        ProtBERT last layer outputs [batch_size, max_no_tokens, 1024]. When the model's pack_length is set (> 0), several
+        short sequences are packed into each ProtBERT row (see packed_bert_forward); the padded positions of the
+        outputs are then zeros. While the encoder is frozen, the outputs are read from the model's frozen_output_cache
+        (see FrozenEncoderOutputCache), if any, and only computed (in eval mode, without dropout) for the sequences that
+        are not cached yet
+        """
+        if self._frozen and getattr(self, "frozen_output_cache", None) is not None:
+            return self.frozen_output_cache(self.compute_frozen_bert_outputs, input_ids, attention_mask)
+        return self.compute_bert_outputs(input_ids, attention_mask)
+
+    def compute_frozen_bert_outputs(self, input_ids, attention_mask):
+        # cached outputs are replayed in every frozen epoch, so they are the deterministic (dropout-free) ones rather
+        # than a single dropout sample
+        was_training = self.ProtBertBFD.training
+        self.ProtBertBFD.eval()
+        try:
+            return self.compute_bert_outputs(input_ids, attention_mask)
+        finally:
+            self.ProtBertBFD.train(was_training)
+
+    def compute_bert_outputs(self, input_ids, attention_mask):
+        if getattr(self, "lower_layer_cache", None) is not None:
+            return self.lower_layer_cache.forward_top_layers(self.ProtBertBFD, input_ids, attention_mask)
+        if getattr(self, "pack_length", 0):
+            return packed_bert_forward(self.ProtBertBFD, input_ids, attention_mask, pack_length=self.pack_length)
+        return self.ProtBertBFD(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    def set_lower_layer_cache(self, lower_layer_cache) -> None:
+        """
+        Partial fine-tuning: permanently freezes the embeddings and bottom layers of ProtBERT whose outputs
+        <lower_layer_cache> (LowerLayerActivationCache) holds; bert_forward then only runs the top layers on the cached
+        activations.
+        """
+        for param in lower_layer_cache.frozen_modules.parameters():
+            param.requires_grad = False
+        self.lower_layer_cache = lower_layer_cache
 
     def freeze_encoder(self) -> None:
         """ freezes the encoder layer. """
@@ -637,7 +704,7 @@ class ProtBertClassifier(pl.LightningModule):
         Returns:
             Dictionary with model outputs (e.g: logits)
         """
-        input_ids = torch.tensor(input_ids, device=self.device)
+        input_ids = torch.as_tensor(input_ids, device=self.device)
         inp_seqs = []
         if sequences is not None:
             inp_seqs = [s.replace(" ", "") for s in sequences]
@@ -645,9 +712,8 @@ class ProtBertClassifier(pl.LightningModule):
             for inp in input_ids:
                 inp_seqs.append("".join([self.aaind2lblvocab[i_] for i_ in inp.detach().cpu().numpy()]).replace("[PAD]", ""))
         batch_size, seq_dim = input_ids.shape[0], input_ids.shape[1]
-        attention_mask = torch.tensor(attention_mask, device=self.device)
-        word_embeddings = self.ProtBertBFD(input_ids,
-                                           attention_mask)[0]
+        attention_mask = torch.as_tensor(attention_mask, device=self.device)
+        word_embeddings = self.bert_forward(input_ids, attention_mask)
         if return_embeddings:
             return word_embeddings
         if self.extract_emb:
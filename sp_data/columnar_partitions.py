@@ -0,0 +1,192 @@
+import os
+import json
+import pickle
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+
+
+def get_columnar_dir(partition_f):
+    """ directory of the columnar version of the pickled partition <partition_f> (e.g. sp6_partitioned_data_train_0.bin) """
+    return (partition_f[:-len(".bin")] if partition_f.endswith(".bin") else partition_f) + "_columnar/"
+
+
+def convert_partition(partition_f):
+    """
+    Converts the pickled partition dictionary <partition_f> (sequence -> [embedding, labels, organism group, SP type])
+    to the columnar format read by ColumnarPartition:
+        seq_offsets.i64/lbl_offsets.i64 ([N + 1] offsets index), seqs.u8/lbls.u8 (uint8 encoded sequences/labels),
+        og.u8/sp_type.u8 (categorical organism group/SP type columns, with their categories in meta.json) and, for
+        partitions with precomputed residue embeddings, emb_offsets.i64/embs.f16 (fp16 [no_residues, emb_dim] block)
+    meta.json is written last, s.t. a partially converted directory is never read.
+
+    :param str partition_f: path of the pickled partition
+    :return str: the columnar directory
+    """
+    data = pickle.load(open(partition_f, "rb"))
+    columnar_dir = get_columnar_dir(partition_f)
+    os.makedirs(columnar_dir, exist_ok=True)
+    if os.path.exists(os.path.join(columnar_dir, "meta.json")):
+        os.remove(os.path.join(columnar_dir, "meta.json"))
+    seqs, values = list(data.keys()), list(data.values())
+    og_categories = sorted(set(v[2] for v in values))
+    sp_type_categories = sorted(set(v[3] for v in values))
+    for name, column in [("seq", seqs), ("lbl", [v[1] for v in values])]:
+        encoded = [c.encode("latin-1") for c in column]
+        np.cumsum([0] + [len(c) for c in encoded], dtype=np.int64).tofile(os.path.join(columnar_dir, name + "_offsets.i64"))
+        with open(os.path.join(columnar_dir, name + "s.u8"), "wb") as f:
+            f.write(b"".join(encoded))
+    np.array([og_categories.index(v[2]) for v in values], dtype=np.uint8).tofile(os.path.join(columnar_dir, "og.u8"))
+    np.array([sp_type_categories.index(v[3]) for v in values], dtype=np.uint8).tofile(
+        os.path.join(columnar_dir, "sp_type.u8"))
+    # "dummy" embeddings (an int/single value) are kept for the partitions used when tuning ProtBERT
+    first_emb = values[0][0] if values else 1
+    first_emb = first_emb.detach().cpu().numpy() if hasattr(first_emb, "detach") else np.asarray(first_emb)
+    emb_dim, dummy_emb = (first_emb.shape[-1], None) if first_emb.ndim == 2 else (0, first_emb.ravel()[0].item())
+    if emb_dim:
+        emb_offsets = [0]
+        with open(os.path.join(columnar_dir, "embs.f16"), "wb") as f:
+            for v in values:
+                emb = v[0].detach().cpu().numpy() if hasattr(v[0], "detach") else np.asarray(v[0])
+                f.write(emb.astype(np.float16).tobytes())
+                emb_offsets.append(emb_offsets[-1] + emb.shape[0])
+        np.array(emb_offsets, dtype=np.int64).tofile(os.path.join(columnar_dir, "emb_offsets.i64"))
+    json.dump({"no_seqs": len(seqs), "og_categories": og_categories, "sp_type_categories": sp_type_categories,
+               "emb_dim": emb_dim, "dummy_emb": dummy_emb, "source_mtime": os.path.getmtime(partition_f)},
+              open(os.path.join(columnar_dir, "meta.json"), "w"))
+    return columnar_dir
+
+
+def convert_all_partitions(data_folder):
+    """ converts all pickled sp6_partitioned_data_* partitions (any prefix/sublbls version) of <data_folder> """
+    for f in sorted(os.listdir(data_folder)):
+        if "sp6_partitioned_data_" in f and f.endswith(".bin"):
+            print("Converting {} to the columnar format".format(f))
+            convert_partition(os.path.join(data_folder, f))
+
+
+def load_partition(partition_f):
+    """
+    :param str partition_f: path of a pickled partition
+    :return: its ColumnarPartition if it was converted (and the pickle was not modified since), else the unpickled
+            dictionary
+    """
+    meta_f = os.path.join(get_columnar_dir(partition_f), "meta.json")
+    if os.path.exists(meta_f) and (not os.path.exists(partition_f) or
+                                   os.path.getmtime(partition_f) <= json.load(open(meta_f))["source_mtime"]):
+        return ColumnarPartition(get_columnar_dir(partition_f))
+    return pickle.load(open(partition_f, "rb"))
+
+
+class ColumnarPartition(Mapping):
+    def __init__(self, columnar_dir):
+        """
+        Read-only view of a partition converted by convert_partition, with the interface of the pickled dictionaries
+        (sequence -> [embedding, labels, organism group, SP type]). Opening it only reads the offsets index and the
+        uint8 columns; the residue embeddings are fp16 memory-mapped views that are read when they are used.
+
+        :param str columnar_dir: directory written by convert_partition
+        """
+        meta = json.load(open(os.path.join(columnar_dir, "meta.json")))
+        self.og_categories, self.sp_type_categories = meta["og_categories"], meta["sp_type_categories"]
+        self.dummy_emb = meta["dummy_emb"]
+        self.seq_offsets = np.fromfile(os.path.join(columnar_dir, "seq_offsets.i64"), dtype=np.int64)
+        self.lbl_offsets = np.fromfile(os.path.join(columnar_dir, "lbl_offsets.i64"), dtype=np.int64)
+        self.seqs = open(os.path.join(columnar_dir, "seqs.u8"), "rb").read()
+        self.lbls = open(os.path.join(columnar_dir, "lbls.u8"), "rb").read()
+        self.ogs = np.fromfile(os.path.join(columnar_dir, "og.u8"), dtype=np.uint8)
+        self.sp_types = np.fromfile(os.path.join(columnar_dir, "sp_type.u8"), dtype=np.uint8)
+        self.embs, self.emb_offsets = None, None
+        if meta["emb_dim"]:
+            self.emb_offsets = np.fromfile(os.path.join(columnar_dir, "emb_offsets.i64"), dtype=np.int64)
+            self.embs = np.memmap(os.path.join(columnar_dir, "embs.f16"), dtype=np.float16, mode="r",
+                                  shape=(self.emb_offsets[-1], meta["emb_dim"]))
+        self.seq2ind = None
+
+    def __len__(self):
+        return len(self.seq_offsets) - 1
+
+    def seq(self, ind):
+        return self.seqs[self.seq_offsets[ind]:self.seq_offsets[ind + 1]].decode("latin-1")
+
+    def lbl(self, ind):
+        return self.lbls[self.lbl_offsets[ind]:self.lbl_offsets[ind + 1]].decode("latin-1")
+
+    def og(self, ind):
+        return self.og_categories[self.ogs[ind]]
+
+    def sp_type(self, ind):
+        return self.sp_type_categories[self.sp_types[ind]]
+
+    def emb(self, ind):
+        if self.embs is None:
+            return self.dummy_emb
+        return self.embs[self.emb_offsets[ind]:self.emb_offsets[ind + 1]]
+
+    def value(self, ind):
+        return [self.emb(ind), self.lbl(ind), self.og(ind), self.sp_type(ind)]
+
+    def __iter__(self):
+        return (self.seq(ind) for ind in range(len(self)))
+
+    def __getitem__(self, seq):
+        if self.seq2ind is None:
+            self.seq2ind = {s: ind for ind, s in enumerate(self)}
+        return self.value(self.seq2ind[seq])
+
+    def items(self):
+        return ((self.seq(ind), self.value(ind)) for ind in range(len(self)))
+
+    def values(self):
+        return (self.value(ind) for ind in range(len(self)))
+
+
+class PartitionEmbeddingProvider:
+    def __init__(self, partition_fs):
+        """
+        Sequence -> precomputed residue embeddings lookup over the partitions <partition_fs> (the later partitions take
+        precedence for sequences found in several of them). The partitions are only opened on the first lookup; for
+        columnar partitions (see convert_partition) the embeddings are memory-mapped, s.t. only the rows of the
+        looked-up sequences are read. Only the file names are pickled, so models saved with a provider hold no data.
+
+        :param list partition_fs: paths of the (pickled or converted) partitions
+        """
+        self.partition_fs = list(partition_fs)
+        self.partitions, self.seq2partition = None, None
+
+    def __getstate__(self):
+        return {"partition_fs": self.partition_fs, "partitions": None, "seq2partition": None}
+
+    def open(self):
+        self.partitions = [load_partition(f) for f in self.partition_fs]
+        self.seq2partition = {}
+        for ind, partition in enumerate(self.partitions):
+            self.seq2partition.update({seq: ind for seq in partition})
+
+    def __len__(self):
+        if self.partitions is None:
+            self.open()
+        return len(self.seq2partition)
+
+    def __contains__(self, seq):
+        if self.partitions is None:
+            self.open()
+        return seq in self.seq2partition
+
+    def __getitem__(self, seq):
+        if self.partitions is None:
+            self.open()
+        return self.partitions[self.seq2partition[seq]][seq][0]
+
+    def get_batch(self, seqs, device="cpu"):
+        """
+        :param list seqs: amino acid sequences
+        :param device: device of the returned tensor
+        :return torch.tensor: their embeddings, zero-padded to the longest one [batch_size, max_len, emb_dim] (fp32)
+        """
+        embs = [self[s] for s in seqs]
+        padded = np.zeros((len(seqs), max(len(e) for e in embs), embs[0].shape[-1]), dtype=np.float32)
+        for ind, emb in enumerate(embs):
+            padded[ind, :len(emb)] = emb
+        return torch.from_numpy(padded).to(device)
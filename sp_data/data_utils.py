@@ -2,7 +2,7 @@ from tqdm import tqdm
 import re
 import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import random
 import pickle
 import pandas as pd
@@ -10,6 +10,9 @@ import os
 from Bio import SeqIO
 from sp_data.bert_tuning import ProtBertClassifier, parse_arguments_and_retrieve_logger
 from sp_data.sp6_data.read_extract_sp6_data import extract_raw_data
+from sp_data.columnar_partitions import load_partition
+from sp_data.seq_index import get_seq_index
+from sp_data.embedding_precomputation import has_precomputed_embeddings, precompute_partition_embeddings
 
 def create_binary_test_file_from_fasta(data_path):
     if data_path[-3:] == "bin": # if it's already a binary, don't do anything
@@ -26,12 +29,17 @@ def create_binary_test_file_from_fasta(data_path):
     print("Created binary file for test set at {}.".format(data_path.replace(".fasta", ".bin")))
     return data_path.split("/")[-1].replace(".fasta", ".bin")
 
-def check_compatibility(tune_bert=True):
-    data = pickle.load(open(get_data_folder()+"sp6_partitioned_data_train_0.bin", "rb"))
+def check_compatibility(tune_bert=True, max_tokens=8192, fp16=False):
     # if the embeddings are "dummy" embeddings (used for compatibility in the dataloader, when assuming the ProtBERT
     # model is tuning with TSignal, therefore not needing precomputed embeddings) AND the run is in fact NOT tuning
-    # the BERT model, then precompute bert embeddings
-    if (type(list(data.values())[0][0]) == int or len(list(data.values())[0][0]) == 1) and not tune_bert:
+    # the BERT model, then precompute bert embeddings. Every partition is checked, s.t. a run interrupted after the
+    # first partitions were rewritten is resumed (from its shards, see precompute_partition_embeddings)
+    if tune_bert:
+        return
+    partition_fs = [get_data_folder() + "sp6_partitioned_data_{}_{}.bin".format(tr_or_tst, tr_f)
+                    for tr_or_tst in ['train', 'test'] for tr_f in [0, 1, 2]]
+    missing_partition_fs = [f for f in partition_fs if not has_precomputed_embeddings(load_partition(f))]
+    if missing_partition_fs:
 
         print("The current binary files sp6_partitioned_data_<train/test>_<fold>.bin are not containing precomputed BERT"
               " embeddings but the run does not tune bert (i.e. embeddings will be precomputed for efficiency). Will "
@@ -42,30 +50,8 @@ def check_compatibility(tune_bert=True):
         model = ProtBertClassifier(hparams)
         device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         model.to(device)
-        dict_w_precomputed_embs = {}
-        # used for batching
-        seqs, lbls, glbl_lbls, og = [], [], [], []
-        for tr_or_tst in ['train','test']:
-            for tr_f in [0,1,2]:
-                data = pickle.load(open("sp_data/sp6_partitioned_data_{}_{}.bin".format(tr_or_tst, tr_f), "rb"))
-                for ind, (k,v) in tqdm(enumerate(data.items()), "computing for {} set fold {}".format(tr_or_tst,tr_f), total=len(data.items())):
-                    seqs.append(" ".join([k_ for k_ in k]))
-                    lbls.append(v[1])
-                    og.append(v[2])
-                    glbl_lbls.append(v[3])
-                    # gather 20 sequences, then compute embeddings and save in the new dictionary
-                    if len(seqs) > 49:
-                        embeddings = model.extract_embeddnings({"seq":seqs})
-                        for emb,s,l,gl,o in zip(embeddings, seqs, lbls, glbl_lbls,og):
-                            dict_w_precomputed_embs[s.replace(" ","")] = (emb[:len(s.replace(" ",""))], l,o,gl)
-                        seqs, lbls, glbl_lbls, og = [], [], [], []
-                # compute the leftover sequences
-                if len(seqs) != 0:
-                    for emb, s, l, gl, o in zip(embeddings, seqs, lbls, glbl_lbls, og):
-                        dict_w_precomputed_embs[s.replace(" ", "")] = (emb[:len(s.replace(" ",""))], l, o, gl)
-                    seqs, lbls, glbl_lbls, og = [], [], [], []
-                pickle.dump(dict_w_precomputed_embs, open("sp_data/sp6_partitioned_data_{}_{}.bin".format(tr_or_tst, tr_f), "wb"))
-                dict_w_precomputed_embs = {}
+        for partition_f in missing_partition_fs:
+            precompute_partition_embeddings(model, partition_f, max_tokens=max_tokens, fp16=fp16)
 
 class SPCSpredictionData:
     def __init__(self, lbl2ind=None, form_sp_reg_data=False, simplified=True, very_simplified=True, extended_sublbls=False, tune_bert=True):
@@ -368,7 +354,7 @@ class SPCSpredictionData:
         unique_aas = set()
         for p in parts:
             for t in ["train", "test"]:
-                part_dict = pickle.load(open(self.data_folder + "sp6_partitioned_data_{}_{}.bin".format(t, p), "rb"))
+                part_dict = load_partition(self.data_folder + "sp6_partitioned_data_{}_{}.bin".format(t, p))
                 for seq, (_, lbls, _, _) in part_dict.items():
                     all_unique_lbls.update(lbls)
                     unique_aas.update(seq)
@@ -390,7 +376,7 @@ class SPCSpredictionData:
         all_unique_global_inds = set()
         for p in parts:
             for t in ["train", "test"]:
-                part_dict = pickle.load(open(self.data_folder + "sp6_partitioned_data_{}_{}.bin".format(t, p), "rb"))
+                part_dict = load_partition(self.data_folder + "sp6_partitioned_data_{}_{}.bin".format(t, p))
                 for (_, _, lg, glb_ind) in part_dict.values():
                     all_unique_lgs.add(lg)
                     all_unique_global_inds.add(glb_ind)
@@ -415,6 +401,8 @@ class CSPredsDataset(Dataset):
         self.glbl_lbl_2ind =glbl_lbl_2ind
         self.data_folder = data_folder
         self.lipbobox_predictions = lipbobox_predictions
+        # padded arrays of the sequences/labels (see pre_encode)
+        self.seq_codes, self.seq_lens, self.lbl_codes, self.lbl_lens = None, None, None, None
         if partitions is not None:
             # when using partitions, the sp6 data partition files will be used in train/testing
             for p in partitions:
@@ -423,7 +411,7 @@ class CSPredsDataset(Dataset):
                     # exit(1)
                     d_file = random_folds_prefix + tuned_bert_embs_prefix + "sp6_partitioned_data_sublbls_"+extended_pref+"{}_{}.bin".format(s, p) if form_sp_reg_data else \
                         random_folds_prefix + tuned_bert_embs_prefix + "sp6_partitioned_data_"+extended_pref+"{}_{}.bin".format(s, p)
-                    data_dict = pickle.load(open(data_folder + d_file, "rb"))
+                    data_dict = load_partition(data_folder + d_file)
                     if train_on_subset != 1. and s == 'train':
                         self.extract_subset(data_dict, train_on_subset, lbl2inds, glbl_lbl_2ind)
                     else:
@@ -435,7 +423,7 @@ class CSPredsDataset(Dataset):
                             self.glbl_lbl.append(vals_[3])
         else:
             # parameter for a specific test
-            data_dict = pickle.load(open(data_folder + test_f_name, "rb"))
+            data_dict = load_partition(data_folder + test_f_name)
             for seq_, vals_ in data_dict.items():
                 self.seqs.append(seq_)
                 if vals_[1][0] != "#":
@@ -489,20 +477,38 @@ class CSPredsDataset(Dataset):
 
     def __getitem__(self, item):
         return {"seq": self.seqs[item], "lbl": self.lbls[item], "lg": self.life_grp[item],
-                "glbl_lbl": self.glbl_lbl[item]}
+                "glbl_lbl": self.glbl_lbl[item], "ind": item}
+
+    def pre_encode(self):
+        """
+        Encodes all sequences (uint8 residue codes) and labels (label indices padded with PD) once into padded arrays,
+        along with their lengths, s.t. TensorCollate builds the batch tensors by indexing these arrays.
+        """
+        if any(type(l) == str for l in self.lbls):
+            raise ValueError("Only datasets with (integer encoded) residue labels can be pre-encoded")
+        self.seq_lens = np.array([len(s) for s in self.seqs], dtype=np.int64)
+        self.seq_codes = np.zeros((len(self.seqs), self.seq_lens.max()), dtype=np.uint8)
+        for ind, s in enumerate(self.seqs):
+            self.seq_codes[ind, :len(s)] = np.frombuffer(s.encode("latin-1", errors="replace"), dtype=np.uint8)
+        self.lbl_lens = np.array([len(l) for l in self.lbls], dtype=np.int64)
+        self.lbl_codes = np.full((len(self.lbls), self.lbl_lens.max()), self.lbl2inds["PD"], dtype=np.int64)
+        for ind, l in enumerate(self.lbls):
+            self.lbl_codes[ind, :len(l)] = l
 
     def add_test_seqs(self):
         for p in self.partitions:
             for s in ['test']:
                 d_file = "sp6_partitioned_data_sublbls_" + self.extended_pref + "{}_{}.bin".format(s, p) \
                     if self.form_sp_reg_data else "sp6_partitioned_data_" + self.extended_pref + "{}_{}.bin".format(s, p)
-                data_dict = pickle.load(open(self.data_folder + d_file, "rb"))
+                data_dict = load_partition(self.data_folder + d_file)
                 for seq_, vals_ in data_dict.items():
                     self.seqs.append(seq_)
                     self.lbls.append(self.transorm_seq(vals_[1], vals_[3])
                                      if self.lipbobox_predictions else [self.lbl2inds[l] for l in vals_[1]])
                     self.life_grp.append(vals_[2])
                     self.glbl_lbl.append(vals_[3])
+        if self.seq_codes is not None:
+            self.pre_encode()
 
     def extract_subset(self, data_dict, train_on_subset, lbl2inds, glbl_lbl_2ind):
         lg_and_sptyp2_inds = {}
@@ -710,6 +716,129 @@ def collate_fn(batch):
     return src_batch, tgt_batch, life_grp, glbl_lbl
 
 
+class LengthBucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size=32, max_tokens=0, shuffle=True):
+        """
+        Batches of sequences of similar lengths (less padding for ProtBERT and the decoder). The sequences are sorted by
+        length and split into consecutive batches. When <shuffle> is true (training), the order of the sequences of
+        equal lengths and the order of the batches are shuffled every epoch; otherwise (evaluation) the batches are
+        deterministic.
+
+        :param list lengths: length of each sequence of the dataset
+        :param int batch_size: number of sequences of a batch (when <max_tokens> is 0)
+        :param int max_tokens: maximum number of padded residues of a batch (number of sequences times the longest
+                sequence of the batch), used instead of <batch_size> when positive
+        :param bool shuffle: shuffle the sequences/batches every epoch
+        """
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+
+    def get_batches(self, order):
+        if not self.max_tokens:
+            return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        batches, batch = [], []
+        for ind in order:
+            # sequences are sorted by increasing length, so the current one is the longest of the batch
+            if batch and (len(batch) + 1) * self.lengths[ind] > self.max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(ind)
+        return batches + [batch] if batch else batches
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.lengths))
+            order = order[np.argsort(self.lengths[order], kind="stable")]
+        else:
+            order = np.argsort(self.lengths, kind="stable")
+        batches = self.get_batches(order.tolist())
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.get_batches(np.argsort(self.lengths, kind="stable").tolist()))
+
+
+def get_cs_dataset_loader(dataset, batch_size, shuffle, collate=collate_fn, length_buckets=False, max_tokens=0,
+                          pin_memory=False):
+    """
+    :param CSPredsDataset dataset: the dataset
+    :param bool length_buckets: batch sequences of similar lengths (see LengthBucketBatchSampler); also used when
+            <max_tokens> is positive
+    :param int max_tokens: maximum number of padded residues of a length-bucketed batch (0: <batch_size> sequences)
+    :return DataLoader: the DataLoader of <dataset>
+    """
+    if length_buckets or max_tokens > 0:
+        batch_sampler = LengthBucketBatchSampler([len(s) for s in dataset.seqs], batch_size=batch_size,
+                                                 max_tokens=max_tokens, shuffle=shuffle)
+        return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=4, collate_fn=collate,
+                          pin_memory=pin_memory)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=4, collate_fn=collate,
+                      pin_memory=pin_memory)
+
+
+class TensorBatch:
+    def __init__(self, seqs, lbls, life_grp, glbl_lbl, tensors):
+        """
+        Batch of TensorCollate. It unpacks as the batches of collate_fn (seqs, lbls, life_grp, glbl_lbl), while
+        <tensors> holds the ready-to-use batch tensors. It is not a sequence, s.t. DataLoader(..., pin_memory=True)
+        uses its pin_memory method (and keeps the tensors).
+
+        :param dict tensors: input_ids, token_type_ids, attention_mask (ProtBERT inputs), labels (label indices padded
+                with PD, the decoder inputs; <BOS> is prepended by the label embedding), targets (labels followed by ES
+                and padded with PD, as padd_add_eos_tkn), target_mask (true at the non-padded targets) and seq_lengths
+        """
+        self.seqs, self.lbls, self.life_grp, self.glbl_lbl = seqs, lbls, life_grp, glbl_lbl
+        self.tensors = tensors
+
+    def __iter__(self):
+        return iter((self.seqs, self.lbls, self.life_grp, self.glbl_lbl))
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def pin_memory(self):
+        self.tensors = {k: t.pin_memory() for k, t in self.tensors.items()}
+        return self
+
+    def to(self, device):
+        """ :return dict: the batch tensors on <device> (non-blocking copies for pinned batches) """
+        return {k: t.to(device, non_blocking=True) for k, t in self.tensors.items()}
+
+
+class TensorCollate:
+    def __init__(self, dataset, tokenizer, lbl2ind):
+        """
+        collate_fn replacement building the batch tensors from the pre-encoded arrays of <dataset> (the work runs in
+        the DataLoader workers instead of the training loop).
+
+        :param CSPredsDataset dataset: the (pre-encoded, see CSPredsDataset.pre_encode) dataset of the DataLoader
+        :param ResidueTokenizer tokenizer: tokenizer of the tuned ProtBERT model (ProtBertClassifier.get_residue_tokenizer)
+        :param dict lbl2ind: label -> index dictionary
+        """
+        if dataset.seq_codes is None:
+            dataset.pre_encode()
+        self.dataset = dataset
+        self.tokenizer = tokenizer
+        self.es_ind, self.pd_ind = lbl2ind["ES"], lbl2ind["PD"]
+
+    def __call__(self, batch):
+        inds = np.array([sample["ind"] for sample in batch])
+        seq_lens, lbl_lens = self.dataset.seq_lens[inds], self.dataset.lbl_lens[inds]
+        tensors = self.tokenizer.encode_codes(self.dataset.seq_codes[inds, :seq_lens.max()], seq_lens)
+        labels = self.dataset.lbl_codes[inds, :lbl_lens.max()]
+        targets = np.full((len(inds), labels.shape[1] + 1), self.pd_ind, dtype=np.int64)
+        targets[:, :-1] = labels
+        targets[np.arange(len(inds)), lbl_lens] = self.es_ind
+        tensors.update({"labels": torch.from_numpy(labels), "targets": torch.from_numpy(targets),
+                        "target_mask": torch.from_numpy(np.arange(targets.shape[1])[None, :] <= lbl_lens[:, None]),
+                        "seq_lengths": torch.from_numpy(seq_lens)})
+        return TensorBatch(*collate_fn(batch), tensors)
+
+
 class BinarySPDataset(Dataset):
     def __init__(self, data_file_path, use_aa_len=70):
         data = pickle.load(open(data_file_path, "rb"))
@@ -750,11 +879,8 @@ def get_sp_type_loss_weights():
     data_folder = get_data_folder()
     sptye2count = {'NO_SP': 0, 'SP': 0, 'TATLIPO': 0, 'LIPO': 0, 'TAT': 0, 'PILIN': 0}
 
-    for tr_f in [0, 1, 2]:
-        for set in ["train", "test"]:
-            data = pickle.load(open(data_folder+"sp6_partitioned_data_sublbls_{}_{}.bin".format(set, tr_f), "rb"))
-            for sp_t in data.values():
-                sptye2count[sp_t[3]] += 1
+    for _, row in get_seq_index(data_folder).items():
+        sptye2count[row["sp_type"]] += 1
     min_count = min(sptye2count.values())
     return {k:min_count/v for k,v in sptye2count.items()}
 
@@ -762,13 +888,9 @@ def get_residue_label_loss_weights():
     data_folder = get_data_folder()
     aalbl2count = {'S': 0, 'O': 0, 'M': 0, 'I': 0} #,
 
-    for tr_f in [0, 1, 2]:
-        for set in ["train", "test"]:
-            data = pickle.load(open(data_folder + "sp6_partitioned_data_sublbls_{}_{}.bin".format(set, tr_f), "rb"))
-            for seq in data.values():
-                seq_ = seq[1]
-                for r in seq_:
-                    aalbl2count[r] += 1
+    for _, row in get_seq_index(data_folder).items():
+        for r in row["sublbls"]:
+            aalbl2count[r] += 1
     min_count = min(aalbl2count.values())
     #'PD': 4, 'BS': 5, 'ES': 6}
     lbl2weights = {k:min_count/v for k,v in aalbl2count.items()}
@@ -0,0 +1,153 @@
+import os
+import json
+import pickle
+import shutil
+import threading
+import queue
+
+import torch
+from tqdm import tqdm
+
+from utils.residue_tokenizer import ResidueTokenizer
+from sp_data.columnar_partitions import load_partition
+
+
+def has_precomputed_embeddings(data):
+    """
+    :param data: partition dictionary (or ColumnarPartition) sequence -> [embedding, labels, organism group, SP type]
+    :return bool: false if the partition only holds "dummy" embeddings (an int/single value, used when ProtBERT is
+            tuned along with TSignal)
+    """
+    first_emb = next(iter(data.values()))[0]
+    return not (type(first_emb) == int or len(first_emb) == 1)
+
+
+def token_budget_batches(seq_lens, max_tokens):
+    """
+    :param list seq_lens: lengths of the (length-sorted) sequences
+    :param int max_tokens: maximum number of padded residues of a batch
+    :return list: batches of indices of consecutive sequences
+    """
+    batches, batch = [], []
+    for ind, seq_len in enumerate(seq_lens):
+        if batch and (len(batch) + 1) * seq_len > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(ind)
+    return batches + [batch] if batch else batches
+
+
+class EmbeddingShardWriter:
+    def __init__(self, work_dir):
+        """
+        Writes the computed embeddings of a partition as shards (pickled dictionaries of <shard_size> sequences) and
+        records the finished shards in a manifest.json. Shards and manifest are first written to temporary files and
+        then renamed, so an interrupted run leaves only complete shards, and the next run only computes the sequences
+        that are not in them.
+
+        :param str work_dir: directory of the shards and manifest
+        """
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self.manifest_f = os.path.join(work_dir, "manifest.json")
+        self.manifest = json.load(open(self.manifest_f)) if os.path.exists(self.manifest_f) else {"shards": []}
+
+    def done_seqs(self):
+        done = set()
+        for shard_f in self.manifest["shards"]:
+            done.update(pickle.load(open(os.path.join(self.work_dir, shard_f), "rb")).keys())
+        return done
+
+    def write_shard(self, shard):
+        shard_f = "shard_{:05d}.bin".format(len(self.manifest["shards"]))
+        pickle.dump(shard, open(os.path.join(self.work_dir, shard_f + ".tmp"), "wb"))
+        os.replace(os.path.join(self.work_dir, shard_f + ".tmp"), os.path.join(self.work_dir, shard_f))
+        self.manifest["shards"].append(shard_f)
+        json.dump(self.manifest, open(self.manifest_f + ".tmp", "w"))
+        os.replace(self.manifest_f + ".tmp", self.manifest_f)
+
+    def read_all(self):
+        all_embs = {}
+        for shard_f in self.manifest["shards"]:
+            all_embs.update(pickle.load(open(os.path.join(self.work_dir, shard_f), "rb")))
+        return all_embs
+
+
+def prefetch_batches(tokenizer, seqs, batches, pin_memory=False, prefetch=4):
+    """
+    Tokenizes the <batches> of <seqs> in a background thread, while the previous batches run through ProtBERT.
+
+    :return generator: (batch indices, tokenized inputs) pairs
+    """
+    batch_queue = queue.Queue(maxsize=prefetch)
+
+    def tokenize_batches():
+        try:
+            for batch in batches:
+                inputs = tokenizer([seqs[i] for i in batch])
+                if pin_memory:
+                    inputs = {k: t.pin_memory() for k, t in inputs.items()}
+                batch_queue.put((batch, inputs))
+            batch_queue.put(None)
+        except Exception as e:
+            # re-raised in the main thread
+            batch_queue.put(e)
+
+    threading.Thread(target=tokenize_batches, daemon=True).start()
+    while True:
+        item = batch_queue.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def precompute_partition_embeddings(model, partition_f, out_f=None, max_tokens=8192, shard_size=2000, fp16=False):
+    """
+    Computes the ProtBERT residue embeddings of all sequences of a partition and writes the partition dictionary
+    sequence -> (embedding, labels, organism group, SP type) to <out_f>. Sequences are sorted by length and batched
+    under a token budget, tokenized by a prefetching thread and run without gradients; the results are written in
+    shards (see EmbeddingShardWriter) in <out_f>_emb_shards/, s.t. an interrupted run resumes from the last shard.
+
+    :param ProtBertClassifier model: the (pretrained) ProtBERT model
+    :param str partition_f: path of the partition (e.g. sp_data/sp6_partitioned_data_train_0.bin)
+    :param str out_f: path of the partition with embeddings (default: <partition_f> is replaced once all embeddings
+            are computed)
+    :param int max_tokens: maximum number of padded residues of a ProtBERT batch
+    :param int shard_size: number of sequences of a shard
+    :param bool fp16: store the embeddings as float16
+    """
+    out_f = partition_f if out_f is None else out_f
+    data = load_partition(partition_f)
+    writer = EmbeddingShardWriter(out_f + "_emb_shards/")
+    done = writer.done_seqs()
+    seqs = sorted((s for s in data if s not in done), key=len)
+    if done:
+        print("Resuming the embeddings of {}: {} sequences already computed".format(partition_f, len(done)))
+    tokenizer = ResidueTokenizer(model.tokenizer.get_vocab(), special_tokens=False,
+                                 max_length=model.hparams.max_length)
+    batches = token_budget_batches([len(s) for s in seqs], max_tokens)
+    model.eval()
+    shard = {}
+    with torch.no_grad(), tqdm(total=len(seqs), desc="computing embeddings for {}".format(partition_f)) as progress:
+        for batch, inputs in prefetch_batches(tokenizer, seqs, batches, pin_memory=torch.cuda.is_available()):
+            embeddings = model.bert_forward(inputs['input_ids'].to(model.device, non_blocking=True),
+                                            inputs['attention_mask'].to(model.device, non_blocking=True))
+            embeddings = embeddings.half() if fp16 else embeddings
+            embeddings = embeddings.cpu().numpy()
+            for emb, ind in zip(embeddings, batch):
+                s = seqs[ind]
+                v = data[s]
+                shard[s] = (emb[:len(s)], v[1], v[2], v[3])
+            progress.update(len(batch))
+            if len(shard) >= shard_size:
+                writer.write_shard(shard)
+                shard = {}
+    if shard:
+        writer.write_shard(shard)
+    all_embs = writer.read_all()
+    # the original order of the partition is kept
+    pickle.dump({s: all_embs[s] for s in data}, open(out_f + ".tmp", "wb"))
+    os.replace(out_f + ".tmp", out_f)
+    shutil.rmtree(writer.work_dir)
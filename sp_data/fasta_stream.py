@@ -0,0 +1,35 @@
+import gzip
+
+from Bio import SeqIO
+
+
+def read_fasta(fasta_f):
+    """
+    Reads the records of a (plain or gzipped) FASTA file one at a time.
+
+    :param str fasta_f: path of the FASTA file (gzipped if it ends with .gz)
+    :return generator: (record id, amino acid sequence) pairs
+    """
+    with (gzip.open(fasta_f, "rt") if fasta_f.endswith(".gz") else open(fasta_f)) as handle:
+        for record in SeqIO.parse(handle, "fasta"):
+            yield record.id, str(record.seq)
+
+
+def stream_fasta_batches(fasta_f, batch_size=64, window=70):
+    """
+    Batches of the N-terminal windows of the FASTA records, formed while the file is read (only one batch is held in
+    memory).
+
+    :param str fasta_f: path of the FASTA file
+    :param int batch_size: number of records of a batch
+    :param int window: number of N-terminal residues kept (TSignal predicts the first 70 residues)
+    :return generator: lists of (record id, sequence window) pairs
+    """
+    batch = []
+    for record_id, seq in read_fasta(fasta_f):
+        batch.append((record_id, seq[:window]))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
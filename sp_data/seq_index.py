@@ -0,0 +1,106 @@
+import os
+import pickle
+
+from Bio import SeqIO
+
+from sp_data.columnar_partitions import load_partition, get_columnar_dir
+from sp_data.sp6_data.read_extract_sp6_data import select_unique_records
+
+SEQ_INDEX_F = "sp6_seq_index.bin"
+# seq_index per data folder, loaded once per process
+_loaded_indices = {}
+
+
+def get_index_sources(data_folder):
+    """
+    :return list: the files the index of <data_folder> is built from (the raw SignalP 6.0 fasta, if found, and the
+            sp6_partitioned_data_[sublbls_]<train/test>_<fold> partitions)
+    """
+    sources = [f for f in [data_folder + "sp6_data/train_set.fasta", data_folder + "train_set.fasta"]
+               if os.path.exists(f)][:1]
+    for prefix in ["sp6_partitioned_data_", "sp6_partitioned_data_sublbls_"]:
+        sources.extend(data_folder + prefix + "{}_{}.bin".format(t, p) for p in [0, 1, 2] for t in ["train", "test"])
+    return sources
+
+
+def get_mtime(f):
+    # (partitions may only exist in the columnar format)
+    if os.path.exists(f):
+        return os.path.getmtime(f)
+    meta_f = os.path.join(get_columnar_dir(f), "meta.json")
+    return os.path.getmtime(meta_f) if os.path.exists(meta_f) else None
+
+
+class SequenceIndex:
+    def __init__(self, rows, source_mtimes):
+        """
+        One row per unique sequence of the SP6 data: sequence -> {"id", "partition", "set", "og", "sp_type", "lbls",
+        "sublbls"} ("id" is None if the raw fasta was not found, "sublbls" if the sublbls partitions do not exist).
+        The rows follow the order of the raw fasta.
+
+        :param dict rows: sequence -> row
+        :param dict source_mtimes: modification times of the source files, used to detect a stale index
+        """
+        self.rows = rows
+        self.source_mtimes = source_mtimes
+
+    def __contains__(self, seq):
+        return seq in self.rows
+
+    def __getitem__(self, seq):
+        return self.rows[seq]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def items(self, partitions=None, sets=None):
+        """ :return generator: (sequence, row) pairs of the <partitions> and <sets> (default: all) """
+        return ((seq, row) for seq, row in self.rows.items()
+                if (partitions is None or row["partition"] in partitions) and (sets is None or row["set"] in sets))
+
+
+def build_seq_index(data_folder):
+    """
+    Builds the SequenceIndex of <data_folder> in a single pass over the raw fasta (deduplicated as in
+    extract_raw_data) and the partitions.
+
+    :param str data_folder: folder of the sp6_partitioned_data_* partitions
+    :return SequenceIndex: the index
+    """
+    sources = get_index_sources(data_folder)
+    seq2record = {}
+    if sources[0].endswith(".fasta"):
+        seq2record = {str(seq): record for seq, record in select_unique_records(SeqIO.parse(sources[0], "fasta")).items()}
+    rows = {}
+    for p in [0, 1, 2]:
+        for t in ["train", "test"]:
+            for seq, (_, lbls, og, sp_type) in load_partition(data_folder + "sp6_partitioned_data_{}_{}.bin".format(t, p)).items():
+                record = seq2record.get(seq)
+                rows[seq] = {"id": record.id.split("|")[0] if record is not None else None, "partition": p, "set": t,
+                             "og": og, "sp_type": sp_type, "lbls": lbls, "sublbls": None}
+            sublbls_f = data_folder + "sp6_partitioned_data_sublbls_{}_{}.bin".format(t, p)
+            if get_mtime(sublbls_f) is not None:
+                for seq, v in load_partition(sublbls_f).items():
+                    rows[seq]["sublbls"] = v[1]
+    # the rows of the sequences found in the fasta follow its order
+    fasta_order = {seq: ind for ind, seq in enumerate(seq2record)}
+    rows = dict(sorted(rows.items(), key=lambda r: fasta_order.get(r[0], len(fasta_order))))
+    return SequenceIndex(rows, {f: get_mtime(f) for f in sources})
+
+
+def get_seq_index(data_folder):
+    """
+    :param str data_folder: folder of the sp6_partitioned_data_* partitions
+    :return SequenceIndex: the index of <data_folder>, read from <data_folder>/sp6_seq_index.bin (built and saved there
+            the first time, or when one of its sources was modified)
+    """
+    if data_folder in _loaded_indices:
+        return _loaded_indices[data_folder]
+    index_f = data_folder + SEQ_INDEX_F
+    seq_index = pickle.load(open(index_f, "rb")) if os.path.exists(index_f) else None
+    if seq_index is None or seq_index.source_mtimes != {f: get_mtime(f) for f in get_index_sources(data_folder)}:
+        print("Building the sequence index {}".format(index_f))
+        seq_index = build_seq_index(data_folder)
+        pickle.dump(seq_index, open(index_f, "wb"))
+    _loaded_indices[data_folder] = seq_index
+    return seq_index
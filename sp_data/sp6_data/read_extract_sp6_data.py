@@ -153,22 +153,24 @@ def check_already_added(seq_rec, added_seqs):
 
 
 
-def extract_raw_data(folder):
-    # Manually chosen sequences (some sequences have been relabeled; choose the most recent sequence out of the
-    # duplicates)
-    decided_ids = ['B3GZ85', 'B0R5Y3', 'Q0T616', 'Q7CI09', 'P33937', 'P63883', 'P33937', 'Q9P121', 'C1CTN0', 'Q8FAX0',
-                   'P9WK51', 'Q5GZP1', 'P0AD45', 'P0DC88', 'Q8E6W4', 'Q5HMD1', 'Q2FWG4', 'Q5HLG6', 'Q8Y7A9', 'P65631',
-                   'B1AIC4', 'Q2FZJ9', ' P0ABJ2', 'P0AD46', 'P0ABJ2', 'Q99V36', 'Q7A698', 'Q5HH23', 'Q6GI23', 'Q7A181',
-                   'Q2YX14', 'Q6GAF2', 'P65628', 'P65629', 'P65630', 'Q5HEA9', 'P0DC86', 'Q2YUI9', 'Q5XDY9', 'Q2FF36',
-                   'Q1R3H8', 'P0DC87', 'A5IUN6', 'A6QIT4', 'A7X4S6', 'Q6G7M0', 'Q1CHD5']
+# Manually chosen sequences (some sequences have been relabeled; choose the most recent sequence out of the
+# duplicates)
+DECIDED_IDS = ['B3GZ85', 'B0R5Y3', 'Q0T616', 'Q7CI09', 'P33937', 'P63883', 'P33937', 'Q9P121', 'C1CTN0', 'Q8FAX0',
+               'P9WK51', 'Q5GZP1', 'P0AD45', 'P0DC88', 'Q8E6W4', 'Q5HMD1', 'Q2FWG4', 'Q5HLG6', 'Q8Y7A9', 'P65631',
+               'B1AIC4', 'Q2FZJ9', ' P0ABJ2', 'P0AD46', 'P0ABJ2', 'Q99V36', 'Q7A698', 'Q5HH23', 'Q6GI23', 'Q7A181',
+               'Q2YX14', 'Q6GAF2', 'P65628', 'P65629', 'P65630', 'Q5HEA9', 'P0DC86', 'Q2YUI9', 'Q5XDY9', 'Q2FF36',
+               'Q1R3H8', 'P0DC87', 'A5IUN6', 'A6QIT4', 'A7X4S6', 'Q6G7M0', 'Q1CHD5']
+
+
+def select_unique_records(parse_items, decided_ids=DECIDED_IDS):
+    """
+    Keeps one record of each sequence of the SignalP 6.0 fasta (records hold the sequence followed by its labels): a
+    record whose id is in <decided_ids> is kept once added, otherwise the last record of the sequence replaces it.
+
+    :return dict: sequence -> record
+    """
     seq2all_info = {}
     added_seqs = set()
-    try:
-        parse_items = SeqIO.parse(folder+"train_set.fasta", "fasta")
-    except:
-        print("!!!ERROR!!! from extract_raw_data function in sp_data/sp6_data/read_extract_sp6_data.py: Please add the train_set.fasta file from SignalP 6.0 website or retrieve our pre-computed "
-              "folds from the dropbox link (refer to README, Section 2 Data)")
-        exit(1)
     for seq_record in parse_items:
         current_seq = seq_record.seq[:len(seq_record) // 2]
         if check_already_added(seq_record, added_seqs):
@@ -181,6 +183,17 @@ def extract_raw_data(folder):
         else:
             added_seqs.add(current_seq)
             seq2all_info[current_seq] = seq_record
+    return seq2all_info
+
+
+def extract_raw_data(folder):
+    try:
+        parse_items = SeqIO.parse(folder+"train_set.fasta", "fasta")
+    except:
+        print("!!!ERROR!!! from extract_raw_data function in sp_data/sp6_data/read_extract_sp6_data.py: Please add the train_set.fasta file from SignalP 6.0 website or retrieve our pre-computed "
+              "folds from the dropbox link (refer to README, Section 2 Data)")
+        exit(1)
+    seq2all_info = select_unique_records(parse_items)
     seqs, lbls, ids = [], [], []
     for seq_rec in seq2all_info.values():
         seqs.append(seq_rec.seq[:len(seq_rec.seq) // 2])
@@ -1,5 +1,7 @@
 from copy import deepcopy
 from utils.swa_bn_update import update_bn
+from utils.protbert_emb_cache import ProtBertEmbeddingCache, FrozenEncoderOutputCache, LowerLayerActivationCache
+from utils.mixed_precision import get_autocast, get_grad_scaler, keep_modules_in_fp32
 from torch.optim.swa_utils import AveragedModel, SWALR
 from torch.optim.lr_scheduler import ExponentialLR, StepLR, CosineAnnealingWarmRestarts
 from tqdm import tqdm
@@ -8,17 +10,24 @@ import sys
 
 logging.getLogger('some_logger')
 from sp_data.bert_tuning import ProtBertClassifier, parse_arguments_and_retrieve_logger
+from transformers import BertModel
 import os
 import numpy as np
 import random
 import pickle
+import time
 import torch.nn as nn
 import torch.optim as optim
 import torch
 sys.path.append(os.path.abspath(".."))
 from misc.visualize_cs_pred_results import get_cs_and_sp_pred_results, get_summary_sp_acc, get_summary_cs_acc, get_pred_perf_sptype, get_cs_perf
-from sp_data.data_utils import SPbinaryData, BinarySPDataset, SPCSpredictionData, CSPredsDataset, collate_fn, get_sp_type_loss_weights, get_residue_label_loss_weights, create_binary_test_file_from_fasta
-from models.transformer_nmt import TransformerModel
+from sp_data.data_utils import SPbinaryData, BinarySPDataset, SPCSpredictionData, CSPredsDataset, collate_fn, TensorCollate, TensorBatch, get_cs_dataset_loader, get_sp_type_loss_weights, get_residue_label_loss_weights, create_binary_test_file_from_fasta
+from models.transformer_nmt import TransformerModel, StackedDecoders
+from sp_data.fasta_stream import stream_fasta_batches
+from models.tsignal_script import TSignalScriptPredictor
+from models.tsignal_onnx import export_onnx_mdl, OnnxTSignalBackend
+from models.lora import add_lora_adapters, lora_state_dict, SharedLoRAEncoder, get_lora_layer_inds, \
+    is_lora_base_model
 from models.binary_sp_classifier import BinarySPClassifier, CNN3, CNN4
 
 def init_sptype_classifier(args, glbl_lbls,deep_mdl, is_cnn2=False, no_of_layers=4, no_of_layers_conv_resnets=4):
@@ -80,6 +89,18 @@ def padd_add_eos_tkn(lbl_seqs, lbl2ind):
     return torch.vstack(label_outpus_tensors)
 
 
+def tensor_batch_inputs(batch, device):
+    """
+    :param TensorBatch batch: batch of TensorCollate
+    :return (dict, torch.tensor): ProtBertClassifier inputs (the label tensor as its targets) and the ES/PD padded
+            targets of the loss
+    """
+    tensors = batch.to(device)
+    inputs = {k: tensors[k] for k in ["input_ids", "token_type_ids", "attention_mask"]}
+    inputs.update({"targets": tensors["labels"], "seq_lengths": tensors["seq_lengths"], "sequences": batch.seqs})
+    return inputs, tensors["targets"]
+
+
 def generate_square_subsequent_mask(sz):
     mask = (torch.triu(torch.ones((sz, sz))) == 1).transpose(0, 1)
     mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
@@ -96,14 +117,63 @@ def set_mdl_device(model):
     model.classification_head.pos_encoder.device = device
     return model
 
+def compute_decoder_memory(model, src, tune_bert=False, emb_cache=None, memory_bfd=None):
+    """
+    Computes the memory (encoder outputs) the decoder attends to when predicting the labels of the sequences <src>.
+
+    :param model: ProtBertClassifier (tune_bert=True) or TransformerModel
+    :param list src: amino acid sequences
+    :param bool tune_bert: <model> is a ProtBertClassifier
+    :param ProtBertEmbeddingCache emb_cache: when given (and tune_bert), the ProtBERT embeddings are read from/stored
+            in this cache instead of always running ProtBERT
+    :param torch.tensor memory_bfd: already computed ProtBERT embeddings of <src> (e.g. by SharedLoRAEncoder)
+    :return (torch.tensor, torch.tensor, torch.tensor): the memory, its padding mask (only computed for
+            train_only_decoder models, None otherwise) and the ProtBERT embeddings (None when not tune_bert)
+    """
+    padding_mask_src = None
+    if memory_bfd is not None:
+        pass
+    elif tune_bert and emb_cache is not None:
+        memory_bfd = emb_cache.get_embeddings(model, src)
+    elif tune_bert:
+        inputs = model.tokenize(src)
+        memory_bfd = model.bert_forward(inputs['input_ids'], inputs['attention_mask'])
+        # memory_bfd = model(input_ids=input_ids, attention_mask=attention_mask,
+        #                    token_type_ids=inputs['token_type_ids'],return_embeddings=True)[0]
+    if tune_bert:
+        if not model.classification_head.train_only_decoder:
+            memory = model.classification_head.encode(memory_bfd, inp_seqs=src)
+        else:
+            _, _, padding_mask_src, _, memory = model.classification_head.input_encoder(memory_bfd,inp_seqs=[s.replace(" ", "") for s in src])
+            memory = torch.nn.utils.rnn.pad_sequence(memory, batch_first=True)
+    else:
+        memory = model.encode(src)
+    return memory, padding_mask_src, memory_bfd
+
+
 def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=False, second_model=None,
                   test_only_cs=False, glbl_lbls=None, tune_bert=False, train_oh=False, saliency_map=False,
-                  hook_layer="bert", sptype_preds=None,glbl_lbl_2ind=None, remove_eos_from_inference=True):
+                  hook_layer="bert", sptype_preds=None,glbl_lbl_2ind=None, remove_eos_from_inference=True,
+                  use_kv_cache=True, cs_only=False, emb_cache=None, backend=None):
     """
         the simplest and fastest way of predicting labels for sequences; alternatively, use beam_decode.
         **NOTE** here, we set the probability of the eos index to 0 (through softmax, -inf will be 0), s.t. it is impossible
         to output EOS before the sequence ends. On the flip side, the labels that are outputed after the sequence
         has eneded (e.g. in the case where varying sequence length batches exist in test), are irrelevant anyways
+        When use_kv_cache is true (and no saliency maps are computed), the decoder keys/values of the already predicted
+        labels and the projected memory are cached, s.t. each step only runs the decoder for the newest label (the
+        predictions are the same as the ones of the full decoder pass, which is used when use_kv_cache=False). Rows
+        whose residues are all labelled are then also dropped from the decoded batch (and from the cache); their
+        remaining label predictions are <PD>
+        With cs_only=True, a sequence stops being decoded as soon as a non-SP label is predicted (the first label of a
+        NO_SP sequence, or the label ending the SP run) and its remaining labels are set to that label. The SP type and
+        cleavage site (and their probabilities) are the same as with the full decoding, as long as the model does not
+        predict SP labels again after the SP run has ended
+        A <backend> (e.g. OnnxTSignalBackend, for tune_bert --train_only_decoder models) with the decoding-cache interface
+        of TransformerModel replaces ProtBERT and the decoder: it computes the memory itself in init_decoder_cache
+        and is always used with the cached decoding
+        ProtBERT packs several short sequences per row when the model's pack_length is set (see
+        ProtBertClassifier.bert_forward); the saliency maps are always computed on the unpacked batch
     """
 
 
@@ -160,15 +230,8 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
         # model.ProtBertBFD.embeddings.word_embeddings.register_forward_hook(hook_)
         if tune_bert:
             seq_lengths = [len(s) for s in src]
-            seqs = [" ".join(r_ for r_ in s) for s in src]
-            inputs = model.tokenizer.batch_encode_plus(seqs,
-                                                       add_special_tokens=model.hparams.special_tokens,
-                                                       padding=True,
-                                                       truncation=True,
-                                                       max_length=model.hparams.max_length)
-            input_ids = torch.tensor(inputs['input_ids'], device=model.device)
-            attention_mask = torch.tensor(inputs['attention_mask'], device=model.device)
-            memory_bfd = model.ProtBertBFD(input_ids=input_ids, attention_mask=attention_mask)[0]
+            inputs = model.tokenize(src)
+            memory_bfd = model.ProtBertBFD(input_ids=inputs['input_ids'], attention_mask=inputs['attention_mask'])[0]
             seqs = src
             if not model.classification_head.train_only_decoder:
                 memory = model.classification_head.encode(memory_bfd, inp_seqs=src)
@@ -179,7 +242,7 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
         else:
             memory = model.encode(src)
         if second_model is not None:
-            memory_2nd_mdl = model.encode(src)
+            memory_2nd_mdl = second_model.encode(src)
         else:
             memory_2nd_mdl = None
         if tune_bert and model.classification_head.glbl_lbl_version and model.classification_head.use_glbl_lbls or \
@@ -202,26 +265,14 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
         # compute the encoder embeddings before hand __without__ retaining gradients wrt. input_embeddings+pos_enc
         # (this is done separately as the encoded embeddings only need to be computed once)
         with torch.no_grad():
-            if tune_bert:
-                seq_lengths = [len(s) for s in src]
-                seqs = [" ".join(r_ for r_ in s) for s in src]
-                inputs = model.tokenizer.batch_encode_plus(seqs,add_special_tokens=model.hparams.special_tokens,
-                                                           padding=True,truncation=True,max_length=model.hparams.max_length)
-                input_ids = torch.tensor(inputs['input_ids'], device=model.device)
-                attention_mask = torch.tensor(inputs['attention_mask'], device=model.device)
-                memory_bfd = model.ProtBertBFD(input_ids=input_ids, attention_mask=attention_mask)[0]
-                seqs = src
-                # memory_bfd = model(input_ids=input_ids, attention_mask=attention_mask,
-                #                    token_type_ids=inputs['token_type_ids'],return_embeddings=True)[0]
-                if not model.classification_head.train_only_decoder:
-                    memory = model.classification_head.encode(memory_bfd, inp_seqs=src)
-                else:
-                    _, _, padding_mask_src, _, memory = model.classification_head.input_encoder(memory_bfd,inp_seqs=[s.replace(" ", "") for s in seqs])
-                    memory = torch.nn.utils.rnn.pad_sequence(memory, batch_first=True)
+            if backend is None:
+                memory, padding_mask_src, memory_bfd = compute_decoder_memory(model, src, tune_bert=tune_bert,
+                                                                              emb_cache=emb_cache)
             else:
-                memory = model.encode(src)
+                memory, padding_mask_src, memory_bfd = None, None, None
+            seqs = src
             if second_model is not None:
-                memory_2nd_mdl = model.encode(src)
+                memory_2nd_mdl = second_model.encode(src)
             else:
                 memory_2nd_mdl = None
             if tune_bert and model.classification_head.glbl_lbl_version and model.classification_head.use_glbl_lbls or \
@@ -241,12 +292,13 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
                         glbl_labels = model.get_v3_glbl_lbls(src)
                         _, glbl_preds = torch.max(glbl_labels, dim=1)
 
-    # ys = torch.ones(1, 1).fill_(start_symbol).type(torch.long).to(device)
-    # initialize empty prediction lists
-    ys = []
-    if not ys:
-        for _ in range(len(src)):
-            ys.append([])
+    # the predicted labels are kept on the device in a preallocated tensor: column 0 holds <BOS> (needed by the cached
+    # decoder steps) and ys_len labels are predicted so far. The label sequences are only transferred to the host
+    # once, after the whole batch has been decoded
+    batch_size = len(src)
+    ys = torch.full((batch_size, max(seq_lens) + 2), lbl2ind['PD'], dtype=torch.long, device=device)
+    ys[:, 0] = start_symbol
+    ys_len = 0
 
     # when using a separate SP type classifier (not the default/model in the paper), extract the sp types with
     # that classifier first and continue predicting from there
@@ -259,18 +311,18 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
         start_ind = 0
     else:
         glbl_lbl_2_start_letter = {0: 'I', 1: 'S', 2: 'W', 3: 'L', 4: 'T', 5: 'P'}
-        for ind, seq_ in enumerate(src):
-            ys[ind].append(lbl2ind[glbl_lbl_2_start_letter[sptype_preds[seq_]]])
+        ys[:, 1] = torch.tensor([lbl2ind[glbl_lbl_2_start_letter[sptype_preds[seq_]]] for seq_ in src], device=device)
+        ys_len = 1
         start_ind = 1
     if glbl_labels is not None:
-        tgt_mask = (generate_square_subsequent_mask(1))
+        tgt_mask = (generate_square_subsequent_mask(ys_len + 1))
         if tune_bert:
             if model.classification_head.train_only_decoder:
-                out = model.classification_head.forward_only_decoder(ys, memory.to(device), tgt_mask.to(device), padding_mask_src=padding_mask_src)
+                out = model.classification_head.forward_only_decoder(ys[:, 1:ys_len + 1], memory.to(device), tgt_mask.to(device), padding_mask_src=padding_mask_src)
             else:
-                out = model.classification_head.decode(ys, memory.to(device), tgt_mask.to(device))
+                out = model.classification_head.decode(ys[:, 1:ys_len + 1], memory.to(device), tgt_mask.to(device))
         else:
-            out = model.decode(ys, memory.to(device), tgt_mask.to(device), padding_mask_src=padding_mask_src)
+            out = model.decode(ys[:, 1:ys_len + 1], memory.to(device), tgt_mask.to(device), padding_mask_src=padding_mask_src)
 
         if tune_bert:
             if model.classification_head.train_only_decoder:
@@ -283,36 +335,69 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
             prob = model.generator(out[:, -1])
         prob[:, eos_index] += float('-inf')
         _, next_words = torch.max(prob, dim=1)
-        next_word = [nw.item() for nw in next_words]
-        current_ys = []
         # ordered indices of no-sp aa labels O, M, I
-        ordered_no_sp = [lbl2ind['O'], lbl2ind['M'], lbl2ind['I']]
-        for bach_ind in range(len(src)):
-            if ind2glbl_lbl[glbl_preds[bach_ind].item()] == "NO_SP" and ind2lbl[next_word[bach_ind]] == "S":
-                max_no_sp = np.argmax([prob[bach_ind][lbl2ind['O']].item(), prob[bach_ind][lbl2ind['M']].item(), prob[bach_ind][lbl2ind['I']].item()])
-                current_ys.append(ys[bach_ind])
-                current_ys[-1].append(ordered_no_sp[max_no_sp])
-            elif ind2glbl_lbl[glbl_preds[bach_ind].item()] in ['SP', 'TATLIPO', 'LIPO', 'TAT', 'PILIN'] \
-                    and ind2lbl[next_word[bach_ind]] != "S":
-                current_ys.append(ys[bach_ind])
-                current_ys[-1].append(lbl2ind["S"])
-            else:
-                current_ys.append(ys[bach_ind])
-                current_ys[-1].append(next_word[bach_ind])
-        ys = current_ys
+        ordered_no_sp = torch.tensor([lbl2ind['O'], lbl2ind['M'], lbl2ind['I']], device=device)
+        glbl_preds = glbl_preds.to(device)
+        # NO_SP predicted by the SP type classifier, but S by the sequence model: take the most likely of O, M, I
+        no_sp_disagreement = (glbl_preds == 0) & (next_words == lbl2ind['S'])
+        # some SP type predicted by the SP type classifier, but no S by the sequence model: force S
+        sp_disagreement = (glbl_preds != 0) & (next_words != lbl2ind['S'])
+        next_words = torch.where(no_sp_disagreement, ordered_no_sp[torch.argmax(prob[:, ordered_no_sp], dim=1)],
+                                 next_words)
+        next_words = torch.where(sp_disagreement, torch.full_like(next_words, lbl2ind['S']), next_words)
+        ys[:, ys_len + 1] = next_words
+        ys_len += 1
         start_ind = 1
     if not tune_bert and not train_oh:
         model.glbl_generator.eval()
     all_probs = []
 
-    # NOTE: ys are missing <BOS> token because that is added in the model's pipeline (see e.g.  TokenEmbedding inside
-    # TransformerModel)
+    # NOTE: the full decoder passes get ys[:, 1:ys_len + 1], without the <BOS> token, because that is added in the
+    # model's pipeline (see e.g.  TokenEmbedding inside TransformerModel)
+
+    use_kv_cache = (use_kv_cache or backend is not None) and not saliency_map
+    if use_kv_cache and backend is not None:
+        decoder = backend
+        dec_cache = backend.init_decoder_cache(src)
+        dec_cache_2nd_mdl = None
+    elif use_kv_cache:
+        decoder = model.classification_head if tune_bert else model
+        with torch.no_grad():
+            # forward_only_decoder recomputes the memory padding mask from the input_encoder; do the same when caching
+            dec_cache = decoder.init_decoder_cache(memory.to(device), inp_seqs=seqs if tune_bert else src,
+                                                   padding_mask_src=None if decoder.train_only_decoder else padding_mask_src)
+            dec_cache_2nd_mdl = second_model.init_decoder_cache(memory_2nd_mdl.to(device)) \
+                if second_model is not None else None
+    # batch rows that are still decoded. A row is finished after <seq_len> + 1 labels (the same number of labels the
+    # longest sequence gets); the outputs of form_sp_reg_data are aggregated over all steps, so no rows are dropped then
+    compact_batch = use_kv_cache and not form_sp_reg_data
+    active_rows = list(range(batch_size))
+    active = torch.arange(batch_size, device=device)
+    # labels of the rows that are not decoded anymore (<PD> or, for cs_only, the label that ended the SP prediction)
+    fill_lbls = torch.full((batch_size,), lbl2ind['PD'], dtype=torch.long, device=device)
+    cs_only = cs_only and not form_sp_reg_data and not saliency_map
+    if cs_only:
+        sp_lbl_inds = torch.tensor([lbl2ind[l] for l in ['S', 'T', 'L', 'P', 'W'] if l in lbl2ind], device=device)
+        cs_done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    def fill_label_logits(ntoken):
+        # logits putting all the probability mass of each row on its fill label
+        fill_ = torch.full((batch_size, ntoken), float('-inf'), device=device)
+        fill_[torch.arange(batch_size, device=device), fill_lbls] = 0
+        return fill_
+
+    def scatter_active_rows(active_prob):
+        if len(active_rows) == batch_size:
+            return active_prob
+        prob_ = fill_label_logits(active_prob.shape[1])
+        prob_[active] = active_prob
+        return prob_
 
     for i in range(start_ind, max(seq_lens) + 1):
         if saliency_map:
-            tgt_mask = (generate_square_subsequent_mask(len(ys[0]) + 1))
+            tgt_mask = (generate_square_subsequent_mask(ys_len + 1))
             if second_model is not None:
-                out_2nd_mdl = second_model.decode(ys, memory_2nd_mdl.to(device), tgt_mask.to(device))
+                out_2nd_mdl = second_model.decode(ys[:, 1:ys_len + 1], memory_2nd_mdl.to(device), tgt_mask.to(device))
                 out_2nd_mdl = out_2nd_mdl.transpose(0, 1)
                 prob_2nd_mdl = second_model.generator(out_2nd_mdl[:, -1])
                 all_outs_2nd_mdl.append(out_2nd_mdl[:, -1])
@@ -323,11 +408,11 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
 
                 # memory.requires_grad=True
                 if model.classification_head.train_only_decoder:
-                    prob = model.classification_head.forward_only_decoder(memory.to(device), ys, seqs,
+                    prob = model.classification_head.forward_only_decoder(memory.to(device), ys[:, 1:ys_len + 1], seqs,
                                                                           tgt_mask.to(device))
                     prob = prob[-1]
                 else:
-                    out = model.classification_head.decode(ys, memory.to(device), tgt_mask.to(device))
+                    out = model.classification_head.decode(ys[:, 1:ys_len + 1], memory.to(device), tgt_mask.to(device))
                     out = out.transpose(0, 1)
                     prob = model.classification_head.generator(out[:, -1])
                     all_outs.append(out[:, -1])
@@ -361,52 +446,59 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
                 if i == start_ind:
                     print("!!WARNING!! You have tried to compute saliency maps for a model that does not tune bert. This"
                           " will most likely give a desired result.")
-                out = model.decode(ys, memory.to(device), tgt_mask.to(device))
+                out = model.decode(ys[:, 1:ys_len + 1], memory.to(device), tgt_mask.to(device))
                 out = out.transpose(0, 1)
                 prob[:, eos_index] += float('-inf') if i != max(seq_lens) else prob[:, eos_index]
                 prob = model.generator(out[:, -1])
                 all_outs.append(out[:, -1])
+        elif use_kv_cache:
+            with torch.no_grad():
+                # only feed the labels that are not in the cache yet (all of them, with <BOS>, at the first step)
+                new_tokens = ys[active, dec_cache['step']:ys_len + 1]
+                if second_model is not None:
+                    prob_2nd_mdl, out_2nd_mdl = second_model.decode_step(new_tokens, dec_cache_2nd_mdl)
+                    prob_2nd_mdl = scatter_active_rows(prob_2nd_mdl[-1])
+                    all_outs_2nd_mdl.append(out_2nd_mdl[-1])
+                prob, out = decoder.decode_step(new_tokens, dec_cache)
+                prob = scatter_active_rows(prob[-1])
+                if tune_bert and decoder.train_only_decoder:
+                    all_seq_label_probs.append(prob)
+                else:
+                    all_outs.append(out[-1])
         else:
             with torch.no_grad():
-                tgt_mask = (generate_square_subsequent_mask(len(ys[0]) + 1))
+                tgt_mask = (generate_square_subsequent_mask(ys_len + 1))
                 if second_model is not None:
-                    out_2nd_mdl = second_model.decode(ys, memory_2nd_mdl.to(device), tgt_mask.to(device))
+                    out_2nd_mdl = second_model.decode(ys[:, 1:ys_len + 1], memory_2nd_mdl.to(device), tgt_mask.to(device))
                     out_2nd_mdl = out_2nd_mdl.transpose(0, 1)
                     prob_2nd_mdl = second_model.generator(out_2nd_mdl[:, -1])
                     all_outs_2nd_mdl.append(out_2nd_mdl[:, -1])
                 if tune_bert:
                     if model.classification_head.train_only_decoder:
-                        prob = model.classification_head.forward_only_decoder(memory.to(device), ys, seqs, tgt_mask.to(device))
+                        prob = model.classification_head.forward_only_decoder(memory.to(device), ys[:, 1:ys_len + 1], seqs, tgt_mask.to(device))
                         prob = prob[-1]
                         all_seq_label_probs.append(prob)
                     else:
                         # def decode(self, tgt, memory, tgt_mask, padding_mask_src):
 
-                        out = model.classification_head.decode(ys, memory.to(device), tgt_mask.to(device),
+                        out = model.classification_head.decode(ys[:, 1:ys_len + 1], memory.to(device), tgt_mask.to(device),
                                                                padding_mask_src=padding_mask_src)
                         out = out.transpose(0, 1)
                         prob = model.classification_head.generator(out[:, -1])
                         all_outs.append(out[:, -1])
                 else:
-                    out = model.decode(ys, memory.to(device), tgt_mask.to(device), padding_mask_src=padding_mask_src)
+                    out = model.decode(ys[:, 1:ys_len + 1], memory.to(device), tgt_mask.to(device), padding_mask_src=padding_mask_src)
                     out = out.transpose(0, 1)
                     prob = model.generator(out[:, -1])
                     all_outs.append(out[:, -1])
 
-        if i == 0 and not form_sp_reg_data:
-            # extract the sp-presence probabilities
-            sp_probs = [sp_prb.item() for sp_prb in torch.nn.functional.softmax(prob, dim=-1)[:, lbl2ind['S']]]
-            all_seq_sp_probs = [[sp_prob.item()] for sp_prob in
-                                torch.nn.functional.softmax(prob, dim=-1)[:, lbl2ind['S']]]
-            all_seq_sp_logits = [[sp_prob.item()] for sp_prob in prob[:, lbl2ind['S']]]
-        elif not form_sp_reg_data:
-            # used to update the sequences of probabilities
-            softmax_probs = torch.nn.functional.softmax(prob, dim=-1)
-            next_sp_probs = softmax_probs[:, lbl2ind['S']]
-            next_sp_logits = prob[:, lbl2ind['S']]
-            for seq_prb_ind in range(len(all_seq_sp_probs)):
-                all_seq_sp_probs[seq_prb_ind].append(next_sp_probs[seq_prb_ind].item())
-                all_seq_sp_logits[seq_prb_ind].append(next_sp_logits[seq_prb_ind].item())
+        if cs_only and not compact_batch:
+            # without the cache, rows that are done are still decoded; keep their fill labels
+            prob[cs_done] = fill_label_logits(prob.shape[1])[cs_done]
+        if start_ind == 0 and not form_sp_reg_data:
+            # keep the sp-presence probabilities/logits of each step on the device (moved to host after decoding)
+            all_seq_sp_probs.append(torch.nn.functional.softmax(prob, dim=-1)[:, lbl2ind['S']])
+            all_seq_sp_logits.append(prob[:, lbl2ind['S']])
         all_probs.append(prob)
         if second_model is not None:
             prob[:, eos_index] += float('-inf') if i != max(seq_lens) else prob[:, eos_index]
@@ -420,12 +512,46 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
         else:
             prob[:, eos_index] += float('-inf') if i != max(seq_lens) else prob[:, eos_index]
             _, next_words = torch.max(prob, dim=1)
-        next_word = [nw.item() for nw in next_words]
-        current_ys = []
-        for bach_ind in range(len(src)):
-            current_ys.append(ys[bach_ind])
-            current_ys[-1].append(next_word[bach_ind])
-        ys = current_ys
+        if cs_only:
+            next_words = torch.where(cs_done, fill_lbls, next_words)
+            # a row is done once a non-SP label is predicted (the first label of NO_SP rows or the end of the SP run)
+            newly_done = ~cs_done & (next_words.unsqueeze(1) != sp_lbl_inds.unsqueeze(0)).all(dim=1)
+            fill_lbls = torch.where(newly_done, next_words, fill_lbls)
+            cs_done = cs_done | newly_done
+        ys[:, ys_len + 1] = next_words
+        ys_len += 1
+        if compact_batch or cs_only:
+            # sequence lengths are known on the host, so no device synchronization is needed to find rows finished
+            # because of their length (cs_only needs one per step, to retrieve the rows whose SP prediction ended)
+            cs_done_rows = cs_done.tolist() if cs_only else [False] * batch_size
+            still_active = [ind for ind, row in enumerate(active_rows)
+                            if seq_lens[row] >= ys_len and not cs_done_rows[row]]
+            if not still_active:
+                break
+            if compact_batch and len(still_active) < len(active_rows):
+                decoder.select_decoder_cache(dec_cache, still_active)
+                if second_model is not None:
+                    second_model.select_decoder_cache(dec_cache_2nd_mdl, still_active)
+                active_rows = [active_rows[ind] for ind in still_active]
+                active = torch.tensor(active_rows, device=device)
+    if ys_len < max(seq_lens) + 1:
+        # all rows were done early (cs_only); the labels/probabilities of the remaining steps are the fill labels
+        ys[:, ys_len + 1:] = fill_lbls.unsqueeze(1)
+        fill_prob = fill_label_logits(all_probs[-1].shape[1])
+        for _ in range(ys_len, max(seq_lens) + 1):
+            all_probs.append(fill_prob)
+            if all_seq_label_probs:
+                all_seq_label_probs.append(fill_prob)
+            if all_seq_sp_probs:
+                all_seq_sp_probs.append(torch.nn.functional.softmax(fill_prob, dim=-1)[:, lbl2ind['S']])
+                all_seq_sp_logits.append(fill_prob[:, lbl2ind['S']])
+        ys_len = max(seq_lens) + 1
+    # single host transfer of the predicted labels (and of the sp probabilities of each step)
+    ys = ys[:, 1:ys_len + 1].tolist()
+    if all_seq_sp_probs:
+        all_seq_sp_probs = torch.stack(all_seq_sp_probs, dim=1).tolist()
+        all_seq_sp_logits = torch.stack(all_seq_sp_logits, dim=1).tolist()
+        sp_probs = [seq_sp_probs[0] for seq_sp_probs in all_seq_sp_probs]
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     if form_sp_reg_data:
         glbl_lbl_version, use_glbl_lbls = (model.glbl_lbl_version, model.use_glbl_lbls) if not tune_bert else \
@@ -471,176 +597,286 @@ def greedy_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=
     return ys, torch.stack(all_probs).transpose(0, 1), sp_probs, all_seq_sp_probs, all_seq_sp_logits, all_seq_label_probs
 
 
-def beam_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=False, second_model=None,
-                  test_only_cs=False, glbl_lbls=None, tune_bert=False, beam_width=2):
+def structured_cs_decode(model, src, start_symbol, lbl2ind, tune_bert=False, train_oh=False, emb_cache=None):
+    """
+        Alternative to greedy_decode, scoring the label sequences of the form X^k Y^(n-k) instead of decoding them one
+        label at a time. For every SP label X, one teacher-forced decoder pass over <BOS> X X ... X gives the
+        probabilities of all the (SP type, cleavage site) hypotheses of a sequence:
+            log p(X^k Y) = sum_{t<k} log p(X | <BOS> X^t) + log p(Y | <BOS> X^k)
+        with Y the most likely non-SP label after the SP (or X^n when the whole sequence is predicted as SP). NO_SP
+        hypotheses are scored by the first (non-SP) label. All passes are computed in a single batched decoder call
+        and the most likely hypothesis is returned, with the labels after the cleavage site set to Y. The outputs have
+        the same format as the ones of greedy_decode (the probabilities after the cleavage site are the ones of Y).
+    """
+    model = set_mdl_device(model)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    decoder = model.classification_head if tune_bert else model
+    if not tune_bert and not train_oh:
+        model.glbl_generator.eval()
     ind2lbl = {v: k for k, v in lbl2ind.items()}
-    ind2glbl_lbl = {0: 'NO_SP', 1: 'SP', 2: 'TATLIPO', 3: 'LIPO', 4: 'TAT', 5: 'PILIN'}
+    sp_lbls = [lbl2ind[l] for l in ['S', 'T', 'L', 'P', 'W'] if l in lbl2ind]
+    non_sp_lbls = [ind for ind, l in ind2lbl.items() if ind not in sp_lbls and l not in ['PD', 'BS', 'ES']]
+    batch_size, no_sp_types = len(src), len(sp_lbls)
+    seq_lens = torch.tensor([len(s) for s in src], device=device)
+    # same number of labels as greedy_decode
+    no_steps = max(len(s) for s in src) + 1
+    with torch.no_grad():
+        memory, padding_mask_src, _ = compute_decoder_memory(model, src, tune_bert=tune_bert, emb_cache=emb_cache)
+        dec_cache = decoder.init_decoder_cache(memory.to(device), inp_seqs=src,
+                                               padding_mask_src=None if decoder.train_only_decoder else padding_mask_src)
+        # rows [x * batch_size: (x + 1) * batch_size] are teacher-forced with the x'th SP label
+        decoder.select_decoder_cache(dec_cache, list(range(batch_size)) * no_sp_types)
+        sp_lbls_ = torch.tensor(sp_lbls, device=device)
+        tgt = sp_lbls_.repeat_interleave(batch_size).unsqueeze(1).repeat(1, no_steps)
+        tgt[:, 0] = start_symbol
+        logits, _ = decoder.decode_step(tgt, dec_cache)
+        # [no_sp_types, batch_size, no_steps, ntoken]
+        logits = logits.transpose(0, 1).reshape(no_sp_types, batch_size, no_steps, -1)
+        # as in greedy_decode, EOS can only be predicted at the last step
+        logits[:, :, :-1, lbl2ind['ES']] = float('-inf')
+        log_probs = torch.nn.functional.log_softmax(logits, dim=-1)
+
+        stay_log_probs = log_probs.gather(3, sp_lbls_.view(-1, 1, 1, 1).expand(-1, batch_size, no_steps, 1)).squeeze(3)
+        # prefix_log_probs[x, b, k] = log p(X^k) (k=0...no_steps)
+        prefix_log_probs = torch.cat([torch.zeros(no_sp_types, batch_size, 1, device=device),
+                                      torch.cumsum(stay_log_probs, dim=2)], dim=2)
+        exit_log_probs, exit_lbls = log_probs[:, :, :, non_sp_lbls].max(dim=3)
+        exit_lbls = torch.tensor(non_sp_lbls, device=device)[exit_lbls]
+        # X^k Y, with the cleavage site k inside the sequence
+        positions = torch.arange(no_steps, device=device)
+        valid_cs = (positions.unsqueeze(0) >= 1) & (positions.unsqueeze(0) < seq_lens.unsqueeze(1))
+        cs_scores = (prefix_log_probs[:, :, :-1] + exit_log_probs).masked_fill(~valid_cs.unsqueeze(0), float('-inf'))
+        # X^n (the whole sequence is labeled as SP) and NO_SP (the first label is already a non-SP one)
+        full_sp_scores = prefix_log_probs.gather(2, seq_lens.view(1, -1, 1).expand(no_sp_types, -1, 1)).squeeze(2)
+        no_sp_scores = exit_log_probs[0, :, 0]
+        all_scores = torch.cat([cs_scores.transpose(0, 1).reshape(batch_size, -1), full_sp_scores.t(),
+                                no_sp_scores.unsqueeze(1)], dim=1)
+        best = torch.argmax(all_scores, dim=1)
+
+        rows = torch.arange(batch_size, device=device)
+        is_cs, is_no_sp = best < no_sp_types * no_steps, best == no_sp_types * (no_steps + 1)
+        is_full_sp = ~is_cs & ~is_no_sp
+        sp_type_ind = torch.where(is_cs, best // no_steps, best - no_sp_types * no_steps).clamp(max=no_sp_types - 1)
+        sp_type_ind = torch.where(is_cs | is_full_sp, sp_type_ind, torch.zeros_like(sp_type_ind))
+        cs = torch.where(is_cs, best % no_steps, torch.where(is_full_sp, torch.full_like(best, no_steps),
+                                                                 torch.zeros_like(best)))
+        x_lbls = sp_lbls_[sp_type_ind]
+        y_lbls = torch.where(is_full_sp, x_lbls, exit_lbls[sp_type_ind, rows, cs.clamp(max=no_steps - 1)])
+        before_cs = positions.unsqueeze(0) < cs.unsqueeze(1)
+        ys = torch.where(before_cs, x_lbls.unsqueeze(1), y_lbls.unsqueeze(1))
+        # the predicted probabilities up to (and including) the cleavage site are the ones of the teacher-forced pass;
+        # afterwards, all the probability mass is on Y
+        probs = logits[sp_type_ind, rows]
+        fill_probs = torch.full_like(probs, float('-inf'))
+        fill_probs[rows, :, y_lbls] = 0
+        probs = torch.where((positions.unsqueeze(0) <= cs.unsqueeze(1)).unsqueeze(2), probs, fill_probs)
+        sp_logits = probs[:, :, lbl2ind['S']]
+        sp_softmax = torch.nn.functional.softmax(probs, dim=-1)[:, :, lbl2ind['S']]
+    all_seq_sp_probs, all_seq_sp_logits = sp_softmax.tolist(), sp_logits.tolist()
+    sp_probs = [seq_sp_probs[0] for seq_sp_probs in all_seq_sp_probs]
+    all_seq_label_probs = list(probs.transpose(0, 1)) if decoder.train_only_decoder else []
+    return ys.tolist(), probs, sp_probs, all_seq_sp_probs, all_seq_sp_logits, all_seq_label_probs
+
+
+def get_shared_encoder(models):
+    """
+    :param list models: ProtBertClassifiers of an ensemble
+    :return SharedLoRAEncoder: the shared ProtBERT pass of the models if they are compatible (see
+            SharedLoRAEncoder.can_share, which compares all base ProtBERT weights and is thus only checked once per
+            ensemble), else None
+    """
+    if len(models) < 2 or not SharedLoRAEncoder.can_share(models):
+        return None
+    # (the stacked adapters are created on the device the models are decoded on)
+    return SharedLoRAEncoder([set_mdl_device(m) for m in models])
+
+
+def ensemble_decode(models, src, start_symbol, lbl2ind, tune_bert=False, aggregation="avg", train_oh=False,
+                    emb_cache=None, shared_encoder=None):
+    """
+        Greedy decoding with an ensemble of N models (e.g. the models of the different cross-validation folds). The
+        memory (ProtBERT embeddings/encoder outputs) of each model is computed once, by that model (or, for LoRA-tuned
+        models of the same base ProtBERT, by one batched <shared_encoder> pass, see get_shared_encoder), and when the
+        models have the same architecture their decoder steps are computed together (see StackedDecoders). The label
+        distributions of the models are combined with
+            aggregation="avg": the average of the models' probabilities
+            aggregation="max": each sequence follows the model that is the most confident in its first label (the same
+                               voting second_model uses in greedy_decode)
+        The outputs have the same format as the ones of greedy_decode (the returned "logits" are the log-probabilities
+        of the ensemble).
+    """
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    src = src
-    all_outs = []
-    model.eval()
-    seq_lens = [len(src_) for src_ in src]
+    models = [set_mdl_device(m) for m in models]
+    decoders = [m.classification_head if tune_bert else m for m in models]
+    for m in models:
+        m.eval()
+        if not tune_bert and not train_oh:
+            m.glbl_generator.eval()
+    batch_size = len(src)
+    no_steps = max(len(s) for s in src) + 1
+    ys = torch.full((batch_size, no_steps + 1), start_symbol, dtype=torch.long, device=device)
+    all_probs, all_seq_sp_probs = [], []
     with torch.no_grad():
-        if tune_bert:
-            seq_lengths = [len(s) for s in src]
-            seqs = [" ".join(r_ for r_ in s) for s in src]
-            inputs = model.tokenizer.batch_encode_plus(seqs,
-                                                       add_special_tokens=model.hparams.special_tokens,
-                                                       padding=True,
-                                                       truncation=True,
-                                                       max_length=model.hparams.max_length)
-            input_ids = torch.tensor(inputs['input_ids'], device=model.device)
-            attention_mask = torch.tensor(inputs['attention_mask'], device=model.device)
-            memory_bfd = model.ProtBertBFD(input_ids=input_ids, attention_mask=attention_mask)[0]
-            memory = model.classification_head.encode(memory_bfd, inp_seqs=src)
-        else:
-            memory = model.encode(src)
-        if second_model is not None:
-            memory_2nd_mdl = model.encode(src)
-        else:
-            memory_2nd_mdl = None
-        if tune_bert and model.classification_head.glbl_lbl_version and model.classification_head.use_glbl_lbls or \
-                not tune_bert and model.glbl_lbl_version == 3 and model.use_glbl_lbls:
-            if test_only_cs:
-                batch_size = len(src)
-                glbl_labels = torch.zeros(batch_size, 6)
-                glbl_labels[list(range(batch_size)), glbl_lbls] = 1
-                _, glbl_preds = torch.max(glbl_labels, dim=1)
+        caches = []
+        # LoRA-tuned models of the same base ProtBERT share a single (batched) ProtBERT forward pass
+        shared_memory_bfd = [None] * len(models)
+        if tune_bert and shared_encoder is not None:
+            inputs = models[0].tokenize(src)
+            shared_memory_bfd = shared_encoder(inputs['input_ids'], inputs['attention_mask'])
+        for m, decoder, memory_bfd in zip(models, decoders, shared_memory_bfd):
+            memory, padding_mask_src, _ = compute_decoder_memory(m, src, tune_bert=tune_bert, emb_cache=emb_cache,
+                                                                 memory_bfd=memory_bfd)
+            caches.append(decoder.init_decoder_cache(memory.to(device), inp_seqs=src,
+                                                     padding_mask_src=None if decoder.train_only_decoder
+                                                     else padding_mask_src))
+        stacked_decoders = StackedDecoders(decoders) if StackedDecoders.can_stack(decoders, caches) else None
+        stacked_cache = stacked_decoders.stack_caches(caches) if stacked_decoders is not None else None
+        for t in range(no_steps):
+            if stacked_decoders is not None:
+                logits = stacked_decoders.decode_step(ys[:, stacked_cache['step']:t + 1], stacked_cache)[0][:, -1]
             else:
-                if tune_bert:
-                    glbl_labels = model.classification_head.get_v3_glbl_lbls(memory_bfd, inp_seqs=src)
-                    _, glbl_preds = torch.max(glbl_labels, dim=1)
-                else:
-                    glbl_labels = model.get_v3_glbl_lbls(src)
-                    _, glbl_preds = torch.max(glbl_labels, dim=1)
-    # ys = torch.ones(1, 1).fill_(start_symbol).type(torch.long).to(device)
-    ys = []
-    if not ys:
-        for _ in range(len(src)):
-            ys.append([])
-    start_ind = 0
-    all_probs, sp_probs, sp_logits = [], [], []
-    current_batch_size = len(src)
-    log_probs = torch.zeros(current_batch_size, beam_width)
-    for i in range(start_ind, max(seq_lens) + 1):
-        with torch.no_grad():
-            tgt_mask = (generate_square_subsequent_mask(len(ys[0]) + 1))
-            # seq len, batch size, emb dimensions
-            # 5,5,3 -> 5,15,3 -> 5,3,15 ->
-            if i == 1:
-                memory = memory.repeat(1, 1, beam_width).reshape(memory.shape[0], current_batch_size * beam_width, -1)
-            if tune_bert:
-                out = model.classification_head.decode(ys, memory.to(device), tgt_mask.to(device))
-                out = out.transpose(0, 1)
-                prob = model.classification_head.generator(out[:, -1])
-                all_outs.append(out[:, -1])
-            else:
-                out = model.decode(ys, memory.to(device), tgt_mask.to(device))
-                out = out.transpose(0, 1)
-                prob = model.generator(out[:, -1])
-                all_outs.append(out[:, -1])
-        softmax_probs = torch.nn.functional.softmax(prob, dim=-1)
-        beam_probs, next_words = torch.topk(torch.nn.functional.softmax(prob, dim=-1), beam_width, dim=1)
-        if i == 0:
-            # will be used to determine cs prediction probabilities
-            # all_probs = beam_probs.reshape(-1)
-            # # will be used to visualize and calibrate probabilities of sp-presence predictions
-            # sp_probs = [softmax_probs[bi, lbl2ind['S']].item() for bi in range(current_batch_size)]
-            # sp_logits = [[prob[bi, bwi].item() for bwi in range(beam_width)] for bi in range(current_batch_size)]
-            log_probs = torch.log(beam_probs).reshape(current_batch_size, beam_width)
-        else:
-            # correctly broadcast (e.g. second element prediction for each sequence)
-            # [[s1_pred_1 + s1_pred_1.1, s1_pred_1 + s1_pred_1.2... ] [s1_pred_2 + s1_pred_2.1 s1_pred_2+ s1_pred_2.2 ...], ... ]]
-            log_probs = log_probs.reshape(*log_probs.shape, 1)
-            log_probs = log_probs + torch.log(beam_probs.reshape(current_batch_size, beam_width, beam_width))
-            log_probs = log_probs.reshape(current_batch_size, beam_width * beam_width)
-            if i == max(seq_lens):
-                log_probs, next_word_seq_col_indices = torch.topk(log_probs, 1, dim=1)
-                next_word_col_indices = next_word_seq_col_indices.reshape(-1)
+                logits = torch.stack([decoder.decode_step(ys[:, cache['step']:t + 1], cache)[0][-1]
+                                      for decoder, cache in zip(decoders, caches)])
+            # [no_models, batch_size, ntoken]
+            if t != no_steps - 1:
+                logits[:, :, lbl2ind['ES']] = float('-inf')
+            probs = torch.nn.functional.softmax(logits, dim=-1)
+            if aggregation == "avg":
+                ensemble_probs = probs.mean(dim=0)
             else:
-                log_probs, next_word_seq_col_indices = torch.topk(log_probs, beam_width, dim=1)
-                next_word_col_indices = next_word_seq_col_indices.reshape(-1)
-                # current_probs = []
-                # if 0 < i < max(seq_lens):
-                #     for seq_ind in range(len(src)):
-                #         for j in range(beam_width):
-                #             next_prob_chosen = next_word_col_indices[seq_ind * beam_width + j]
-                #             # choose the prev sequence to which this maximal probability corresponds
-                #             previous_prob_seq = all_probs[seq_ind * beam_width + next_prob_chosen // beam_width]
-                #             chosen_seq_probs = torch.cat([previous_prob_seq.reshape(-1),
-                #                                           beam_probs.reshape(-1, beam_width*beam_width)
-                #                                           [seq_ind, next_prob_chosen].reshape(-1) ] )
-                #             current_probs.append(chosen_seq_probs)
-                #     all_probs = torch.vstack(current_probs)
-                # elif i == max(seq_lens):
-                #     for seq_ind in range(len(src)):
-                #         next_prob_chosen = next_word_col_indices[seq_ind]
-                #         previous_prob_seq = all_probs[seq_ind * beam_width + next_prob_chosen // beam_width]
-                #         chosen_seq_probs = torch.cat([previous_prob_seq.reshape(-1),
-                #                                       beam_probs[seq_ind, next_prob_chosen].reshape(-1)])
-                #         current_probs.append(chosen_seq_probs)
-                #     all_probs = torch.vstack(current_probs).reshape(-1)
-
-        current_ys = []
-        if i == 0:
-            next_word = [nw.item() for nw in next_words.reshape(-1)]
-            for _ in range(len(src) * (beam_width - 1)):
-                ys.append([])
-            for bach_ind in range(len(src) * beam_width):
-                current_ys.append(ys[bach_ind])
-                current_ys[-1].append(next_word[bach_ind])
-        elif i == max(seq_lens):
-            for seq_ind in range(len(src)):
-                next_chosen_seq = next_word_col_indices[seq_ind]
-                previous_word_seq = ys[seq_ind * beam_width + next_chosen_seq // beam_width].copy()
-                current_ys.append(previous_word_seq)
-                current_ys[-1].append(next_words[
-                                          seq_ind * beam_width + next_chosen_seq // beam_width, next_chosen_seq % beam_width].item())
-        else:
-            for seq_ind in range(len(src)):
-                for j in range(beam_width):
-                    next_chosen_seq = next_word_col_indices[seq_ind * beam_width + j]
-                    # choose the prev sequence to which this maximal probability corresponds
-                    previous_word_seq = ys[seq_ind * beam_width + next_chosen_seq // beam_width].copy()
-                    current_ys.append(previous_word_seq)
-                    current_ys[-1].append(next_words[
-                                              seq_ind * beam_width + next_chosen_seq // beam_width, next_chosen_seq % beam_width].item())
-        ys = current_ys
+                if t == 0:
+                    chosen_models = torch.argmax(probs.max(dim=-1)[0], dim=0)
+                ensemble_probs = probs[chosen_models, torch.arange(batch_size, device=device)]
+            ys[:, t + 1] = torch.argmax(ensemble_probs, dim=-1)
+            all_probs.append(torch.log(ensemble_probs))
+            all_seq_sp_probs.append(ensemble_probs[:, lbl2ind['S']])
+        all_probs = torch.stack(all_probs).transpose(0, 1)
+    all_seq_sp_probs = torch.stack(all_seq_sp_probs, dim=1).tolist()
+    all_seq_sp_logits = all_probs[:, :, lbl2ind['S']].tolist()
+    sp_probs = [seq_sp_probs[0] for seq_sp_probs in all_seq_sp_probs]
+    all_seq_label_probs = list(all_probs.transpose(0, 1)) if decoders[0].train_only_decoder else []
+    return ys[:, 1:].tolist(), all_probs, sp_probs, all_seq_sp_probs, all_seq_sp_logits, all_seq_label_probs
+
+
+def beam_decode(model, src, start_symbol, lbl2ind, tgt=None, form_sp_reg_data=False, second_model=None,
+                  test_only_cs=False, glbl_lbls=None, tune_bert=False, beam_width=3, train_oh=False, emb_cache=None):
+    """
+        Beam search over the label sequences of a batch: the batch_size x beam_width hypotheses are decoded together
+        as rows of the cached incremental decoder (the memory keys/values are computed once per sequence and shared
+        by its beams; only the self-attention state is reordered when the beams change). A sequence stops extending
+        its beams after <seq_len> + 1 labels (the same number of labels greedy_decode predicts), and its remaining
+        labels are <PD>. The outputs have the same format as the ones of greedy_decode (for the best beam).
+        (form_sp_reg_data, second_model and separately predicted SP types are only supported by greedy_decode)
+    """
+    model = set_mdl_device(model)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    decoder = model.classification_head if tune_bert else model
+    if not tune_bert and not train_oh:
+        model.glbl_generator.eval()
+    batch_size = len(src)
+    no_steps = max(len(s) for s in src) + 1
+    seq_lens = torch.tensor([len(s) for s in src], device=device).repeat_interleave(beam_width)
+    with torch.no_grad():
+        memory, padding_mask_src, _ = compute_decoder_memory(model, src, tune_bert=tune_bert, emb_cache=emb_cache)
+        dec_cache = decoder.init_decoder_cache(memory.to(device), inp_seqs=src,
+                                               padding_mask_src=None if decoder.train_only_decoder else padding_mask_src)
+        # row b * beam_width + w holds the w'th beam of the b'th sequence
+        decoder.select_decoder_cache(dec_cache, [b for b in range(batch_size) for _ in range(beam_width)])
+        ys = torch.full((batch_size * beam_width, no_steps + 1), lbl2ind['PD'], dtype=torch.long, device=device)
+        ys[:, 0] = start_symbol
+        # only the first beam is "alive" at the beginning, s.t. the first step does not select the same label W times
+        beam_scores = torch.full((batch_size, beam_width), float('-inf'), device=device)
+        beam_scores[:, 0] = 0
+        beam_logits = None
+        beam_offsets = (torch.arange(batch_size, device=device) * beam_width).unsqueeze(1)
+        for t in range(no_steps):
+            logits, _ = decoder.decode_step(ys[:, dec_cache['step']:t + 1], dec_cache)
+            logits = logits[-1]
+            if t != no_steps - 1:
+                logits[:, lbl2ind['ES']] = float('-inf')
+            if beam_logits is None:
+                ntoken = logits.shape[1]
+                beam_logits = torch.zeros(batch_size * beam_width, no_steps, ntoken, device=device)
+                pd_logits = torch.full((ntoken,), float('-inf'), device=device)
+                pd_logits[lbl2ind['PD']] = 0
+            # beams of sequences that are already fully labeled may only be extended with <PD> (at no cost)
+            finished = (t > seq_lens).unsqueeze(1)
+            logits = torch.where(finished, pd_logits.unsqueeze(0), logits)
+            candidate_scores = beam_scores.reshape(-1, 1) + torch.nn.functional.log_softmax(logits, dim=-1)
+            beam_scores, candidates = torch.topk(candidate_scores.reshape(batch_size, -1), beam_width, dim=1)
+            rows = (beam_offsets + candidates // ntoken).reshape(-1)
+            ys = ys[rows]
+            ys[:, t + 1] = (candidates % ntoken).reshape(-1)
+            beam_logits = beam_logits[rows]
+            beam_logits[:, t] = logits[rows]
+            decoder.select_decoder_cache(dec_cache, rows, reorder_beams=True)
+        # topk sorts the beams, so the first beam of each sequence is the best one
+        probs = beam_logits[beam_offsets.reshape(-1)]
+        ys = ys[beam_offsets.reshape(-1), 1:]
+        sp_softmax = torch.nn.functional.softmax(probs, dim=-1)[:, :, lbl2ind['S']]
+        sp_logits = probs[:, :, lbl2ind['S']]
+    all_seq_sp_probs, all_seq_sp_logits = sp_softmax.tolist(), sp_logits.tolist()
+    sp_probs = [seq_sp_probs[0] for seq_sp_probs in all_seq_sp_probs]
+    all_seq_label_probs = list(probs.transpose(0, 1)) if decoder.train_only_decoder else []
+    return ys.tolist(), probs, sp_probs, all_seq_sp_probs, all_seq_sp_logits, all_seq_label_probs
+
+
+def get_sptype_and_cs(predicted_lbls, seq_len):
+    """
+    Retrieves the SP type label and cleavage site from the predicted labels (list of label strings) of a sequence of
+    length <seq_len>. Used to compare the predictions of different decoding methods.
 
-    return ys, torch.tensor([0.1]), sp_probs, torch.tensor([1])
+    :return (str, int): the SP label (or NO_SP) and the cleavage site (None for NO_SP predictions)
+    """
+    predicted_lbls = predicted_lbls[:seq_len]
+    if predicted_lbls[0] not in ['S', 'T', 'L', 'P', 'W']:
+        return "NO_SP", None
+    cs = 0
+    while cs < len(predicted_lbls) and predicted_lbls[cs] == predicted_lbls[0]:
+        cs += 1
+    return predicted_lbls[0], cs
 
 
 def translate(model: torch.nn.Module, src: str, bos_id, lbl2ind, tgt=None, use_beams_search=False,
               form_sp_reg_data=False, second_model=None, test_only_cs=False, glbl_lbls=None,
-              tune_bert=False, train_oh=False,sptype_preds=None,glbl_lbl_2ind=None):
+              tune_bert=False, train_oh=False,sptype_preds=None,glbl_lbl_2ind=None, use_kv_cache=True, cs_only=False,
+              use_structured_cs=False, beam_width=3, ensemble_models=None, ensemble_aggregation="avg",
+              emb_cache=None, precision="fp32", shared_encoder=None):
     model.eval()
-    if form_sp_reg_data:
-        tgt_tokens, probs, sp_probs, \
-        all_sp_probs, all_seq_sp_logits, sp_type_probs = greedy_decode(model, src, start_symbol=bos_id, lbl2ind=lbl2ind,
-                                                                       tgt=tgt, form_sp_reg_data=form_sp_reg_data,
-                                                                       second_model=second_model, test_only_cs=test_only_cs,
-                                                                       glbl_lbls=glbl_lbls, tune_bert=tune_bert, train_oh=train_oh,
-                                                                       sptype_preds=sptype_preds,glbl_lbl_2ind=glbl_lbl_2ind)
-        return tgt_tokens, probs, sp_probs, \
-               all_sp_probs, all_seq_sp_logits, sp_type_probs
-    if use_beams_search:
-        tgt_tokens, probs, sp_probs, all_sp_probs = beam_decode(model, src, start_symbol=bos_id, lbl2ind=lbl2ind,
-                                           tgt=tgt, form_sp_reg_data=form_sp_reg_data,
-                                           second_model=second_model, test_only_cs=test_only_cs,
-                                           glbl_lbls=glbl_lbls, tune_bert=tune_bert, beam_width=3,
-                                                                sptype_preds=sptype_preds,glbl_lbl_2ind=glbl_lbl_2ind)
-        all_seq_sp_logits = None, None, None
-    else:
-        tgt_tokens, probs, sp_probs, all_sp_probs, all_seq_sp_logits, all_seq_label_probs = greedy_decode(model, src, start_symbol=bos_id,
-                                                                                     lbl2ind=lbl2ind, tgt=tgt, tune_bert=tune_bert,
-                                                                                     train_oh=train_oh,sptype_preds=sptype_preds,glbl_lbl_2ind=glbl_lbl_2ind)
-        return tgt_tokens, probs, sp_probs, all_sp_probs, all_seq_sp_logits, all_seq_label_probs
-    return tgt_tokens, probs, sp_probs, all_sp_probs, all_seq_sp_logits
+    with get_autocast(precision):
+        if form_sp_reg_data:
+            tgt_tokens, probs, sp_probs, \
+            all_sp_probs, all_seq_sp_logits, sp_type_probs = greedy_decode(model, src, start_symbol=bos_id, lbl2ind=lbl2ind,
+                                                                           tgt=tgt, form_sp_reg_data=form_sp_reg_data,
+                                                                           second_model=second_model, test_only_cs=test_only_cs,
+                                                                           glbl_lbls=glbl_lbls, tune_bert=tune_bert, train_oh=train_oh,
+                                                                           sptype_preds=sptype_preds,glbl_lbl_2ind=glbl_lbl_2ind,
+                                                                           use_kv_cache=use_kv_cache, cs_only=cs_only, emb_cache=emb_cache)
+            return tgt_tokens, probs, sp_probs, \
+                   all_sp_probs, all_seq_sp_logits, sp_type_probs
+        if ensemble_models and sptype_preds is None:
+            return ensemble_decode([model] + list(ensemble_models), src, start_symbol=bos_id, lbl2ind=lbl2ind,
+                                   tune_bert=tune_bert, aggregation=ensemble_aggregation, train_oh=train_oh,
+                                   emb_cache=emb_cache, shared_encoder=shared_encoder)
+        if use_beams_search and sptype_preds is None:
+            return beam_decode(model, src, start_symbol=bos_id, lbl2ind=lbl2ind, tgt=tgt, tune_bert=tune_bert,
+                               beam_width=beam_width, train_oh=train_oh, emb_cache=emb_cache)
+        elif use_structured_cs and sptype_preds is None:
+            # (SP types predicted beforehand are only supported by greedy_decode)
+            return structured_cs_decode(model, src, start_symbol=bos_id, lbl2ind=lbl2ind, tune_bert=tune_bert,
+                                        train_oh=train_oh, emb_cache=emb_cache)
+        else:
+            tgt_tokens, probs, sp_probs, all_sp_probs, all_seq_sp_logits, all_seq_label_probs = greedy_decode(model, src, start_symbol=bos_id,
+                                                                                         lbl2ind=lbl2ind, tgt=tgt, tune_bert=tune_bert,
+                                                                                         train_oh=train_oh,sptype_preds=sptype_preds,glbl_lbl_2ind=glbl_lbl_2ind,
+                                                                                         use_kv_cache=use_kv_cache, cs_only=cs_only, emb_cache=emb_cache)
+            return tgt_tokens, probs, sp_probs, all_sp_probs, all_seq_sp_logits, all_seq_label_probs
 
 
 def eval_trainlike_loss(model, lbl2ind, run_name="", test_batch_size=50, partitions=[0, 1], sets=["train"],
                         form_sp_reg_data=False, simplified=False, very_simplified=False, tuned_bert_embs_prefix="",
-                        tune_bert=False,extended_sublbls=False, random_folds_prefix="",lipbobox_predictions=False):
+                        tune_bert=False,extended_sublbls=False, random_folds_prefix="",lipbobox_predictions=False,
+                        precision="fp32", length_buckets=False, max_tokens=0):
     loss_fn = torch.nn.CrossEntropyLoss(ignore_index=lbl2ind["PD"])
     model.eval()
     sp_data = SPCSpredictionData(form_sp_reg_data=form_sp_reg_data, simplified=simplified, very_simplified=very_simplified,
@@ -650,21 +886,16 @@ def eval_trainlike_loss(model, lbl2ind, run_name="", test_batch_size=50, partiti
                                 glbl_lbl_2ind=sp_data.glbl_lbl_2ind, sets=sets, form_sp_reg_data=form_sp_reg_data,
                                 tuned_bert_embs_prefix=tuned_bert_embs_prefix, extended_sublbls=extended_sublbls,
                                 random_folds_prefix=random_folds_prefix, lipbobox_predictions=lipbobox_predictions)
-    dataset_loader = torch.utils.data.DataLoader(sp_dataset,
-                                                 batch_size=test_batch_size, shuffle=False,
-                                                 num_workers=4, collate_fn=collate_fn)
+    dataset_loader = get_cs_dataset_loader(sp_dataset, test_batch_size, False,
+                                           length_buckets=length_buckets, max_tokens=max_tokens)
     ind2lbl = {v: k for k, v in lbl2ind.items()}
     total_loss = 0
     for ind, (src, tgt, _, _) in enumerate(dataset_loader):
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(precision):
             if tune_bert:
                 seq_lengths = [len(s) for s in src]
-                src = [" ".join(r_ for r_ in s) for s in src]
-                inputs = model.tokenizer.batch_encode_plus(src,
-                                                           add_special_tokens=model.hparams.special_tokens,
-                                                           padding=True,
-                                                           truncation=True,
-                                                           max_length=model.hparams.max_length)
+                inputs = model.tokenize(src)
+                inputs['sequences'] = src
                 inputs['targets'] = tgt
                 inputs['seq_lengths'] = seq_lengths
                 if model.classification_head.use_glbl_lbls:
@@ -759,7 +990,9 @@ def evaluate(model, lbl2ind, run_name="", test_batch_size=50, partitions=[0, 1],
              dataset_loader=None,use_beams_search=False, form_sp_reg_data=False, simplified=False, second_model=None,
              very_simplified=False, test_only_cs=False, glbl_lbl_2ind=None, account_lipos=False,
              tuned_bert_embs_prefix="", tune_bert=False, extended_sublbls=False, random_folds_prefix="",
-             train_oh=False,lipbobox_predictions=False, sptype_preds="none"):
+             train_oh=False,lipbobox_predictions=False, sptype_preds="none", use_kv_cache=True, cs_only=False,
+             use_structured_cs=False, report_greedy_agreement=False, beam_width=3, ensemble_models=None,
+             ensemble_aggregation="avg", emb_cache=None, precision="fp32", length_buckets=False, max_tokens=0):
     if sptype_preds != "none" and len(sets) == 2:
         sp_dict = {}
         for folds in [[0,1],[0,2],[1,2]]:
@@ -788,6 +1021,10 @@ def evaluate(model, lbl2ind, run_name="", test_batch_size=50, partitions=[0, 1],
     model.eval()
     if second_model is not None:
         second_model.eval()
+        if ensemble_models is None and not (use_beams_search or use_structured_cs or cs_only):
+            # the other fold's model votes as in greedy_decode, decoded together with <model> (see ensemble_decode)
+            ensemble_models, ensemble_aggregation = [second_model], "max"
+    shared_encoder = get_shared_encoder([model] + list(ensemble_models)) if tune_bert and ensemble_models else None
     val_or_test = "test" if len(sets) == 2 else "validation"
     if dataset_loader is None:
         sp_data = SPCSpredictionData(form_sp_reg_data=form_sp_reg_data, simplified=simplified,
@@ -799,12 +1036,12 @@ def evaluate(model, lbl2ind, run_name="", test_batch_size=50, partitions=[0, 1],
                                     tuned_bert_embs_prefix=tuned_bert_embs_prefix, extended_sublbls=extended_sublbls,
                                     random_folds_prefix=random_folds_prefix, lipbobox_predictions=lipbobox_predictions)
 
-        dataset_loader = torch.utils.data.DataLoader(sp_dataset,
-                                                     batch_size=test_batch_size, shuffle=False,
-                                                     num_workers=4, collate_fn=collate_fn)
+        dataset_loader = get_cs_dataset_loader(sp_dataset, test_batch_size, False,
+                                               length_buckets=length_buckets, max_tokens=max_tokens)
 
     ind2lbl = {v: k for k, v in lbl2ind.items()}
     total_loss = 0
+    no_agreeing_w_greedy, no_compared_w_greedy = 0, 0
     for ind, (src, tgt, _, glbl_lbls) in tqdm(enumerate(dataset_loader), "Epoch {} {}".format(epoch, val_or_test),
                                               total=len(dataset_loader)):
         # print("Number of sequences tested: {}".format(ind * test_batch_size))
@@ -815,14 +1052,27 @@ def evaluate(model, lbl2ind, run_name="", test_batch_size=50, partitions=[0, 1],
                 translate(model, src, lbl2ind['BS'], lbl2ind, tgt=tgt, use_beams_search=use_beams_search,
                           form_sp_reg_data=form_sp_reg_data if not extended_sublbls else False, second_model=second_model,
                           test_only_cs=test_only_cs, glbl_lbls=glbl_lbls, tune_bert=tune_bert, train_oh=train_oh,
-                          sptype_preds=sptype_preds, glbl_lbl_2ind=glbl_lbl_2ind)
+                          sptype_preds=sptype_preds, glbl_lbl_2ind=glbl_lbl_2ind, use_kv_cache=use_kv_cache, cs_only=cs_only,
+                          emb_cache=emb_cache, precision=precision)
         else:
             predicted_tokens, probs, sp_probs, all_sp_probs, all_seq_sp_logits, all_seq_label_probs = \
                 translate(model, src, lbl2ind['BS'], lbl2ind, tgt=tgt, use_beams_search=use_beams_search,
                           form_sp_reg_data=form_sp_reg_data if not extended_sublbls else False,
                           second_model=second_model, tune_bert=tune_bert, train_oh=train_oh,sptype_preds=sptype_preds,
-                          glbl_lbl_2ind=glbl_lbl_2ind)
+                          glbl_lbl_2ind=glbl_lbl_2ind, use_kv_cache=use_kv_cache, cs_only=cs_only,
+                          use_structured_cs=use_structured_cs, beam_width=beam_width,
+                          ensemble_models=ensemble_models, ensemble_aggregation=ensemble_aggregation,
+                          emb_cache=emb_cache, precision=precision, shared_encoder=shared_encoder)
             sp_type_probs = [""] * len(predicted_tokens)
+            if use_structured_cs and report_greedy_agreement:
+                greedy_tokens = translate(model, src, lbl2ind['BS'], lbl2ind, tgt=tgt, tune_bert=tune_bert,
+                                          train_oh=train_oh, sptype_preds=sptype_preds, glbl_lbl_2ind=glbl_lbl_2ind,
+                                          use_kv_cache=use_kv_cache, cs_only=True, emb_cache=emb_cache,
+                                          precision=precision)[0]
+                for s, pt, gt in zip(src, predicted_tokens, greedy_tokens):
+                    no_agreeing_w_greedy += get_sptype_and_cs([ind2lbl[i] for i in pt], len(s)) == \
+                                            get_sptype_and_cs([ind2lbl[i] for i in gt], len(s))
+                no_compared_w_greedy += len(src)
         true_targets = padd_add_eos_tkn(tgt, lbl2ind)
         # if not use_beams_search:
         #     total_loss += loss_fn(probs.reshape(-1, 10), true_targets.reshape(-1)).item()
@@ -875,6 +1125,11 @@ def evaluate(model, lbl2ind, run_name="", test_batch_size=50, partitions=[0, 1],
         if sp_probs is not None:
             for s, sp_prob, all_sp_probs, all_sp_logits in zip(src, sp_probs, all_sp_probs, all_seq_sp_logits):
                 seqs2probs[s] = (sp_prob, all_sp_probs, all_sp_logits)
+    if no_compared_w_greedy:
+        print("Structured CS decoding agrees with greedy decoding (SP type and CS) on {}/{} sequences".format(
+            no_agreeing_w_greedy, no_compared_w_greedy))
+        logging.info("Structured CS decoding agrees with greedy decoding (SP type and CS) on {}/{} sequences".format(
+            no_agreeing_w_greedy, no_compared_w_greedy))
     pickle.dump(eval_dict, open(run_name + ".bin", "wb"))
     pickle.dump(sp_type_dict, open(run_name + "_sptype.bin", "wb"))
     if sp_probs is not None and len(sets) > 1:
@@ -899,6 +1154,9 @@ def load_model(model_path, dict_file=None, tuned_bert_embs_prefix="", tune_bert=
         model = torch.load(folder + model_path)
     else:
         model = torch.load(folder + model_path, map_location=torch.device('cpu'))
+    if tune_bert and getattr(model, "lora_config", None) is not None and model.ProtBertBFD is None:
+        # LoRA checkpoints only hold the adapters: rebuild ProtBERT from the base model
+        load_lora_protbert(model)
     if not tune_bert:
         model.input_encoder.update(emb_f_name=dict_file,tuned_bert_embs_prefix=tuned_bert_embs_prefix)
     elif tune_bert and testing:
@@ -912,13 +1170,40 @@ def load_model(model_path, dict_file=None, tuned_bert_embs_prefix="", tune_bert=
         return model, optimizer_
     return model
 
+def load_lora_protbert(model):
+    """
+    Restores the ProtBERT model of a LoRA checkpoint (see save_model): the base ProtBERT weights are loaded from
+    the pretrained model and the saved adapters are added to them
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    config = model.lora_config
+    bert_model = BertModel.from_pretrained(model.modelFolderPath)
+    # (the layers kept from the base model, e.g. by removing the top layers or by distillation)
+    layer_inds = get_lora_layer_inds(config)
+    bert_model.encoder.layer = nn.ModuleList([bert_model.encoder.layer[i] for i in layer_inds])
+    bert_model.config.num_hidden_layers = len(layer_inds)
+    add_lora_adapters(bert_model, rank=config["rank"], alpha=config["alpha"], dropout=config["dropout"])
+    bert_model.load_state_dict(model.lora_state, strict=False)
+    model.ProtBertBFD = bert_model.to(device)
+    model.lora_state = None
+    return model
+
 def save_model(model, model_name="", tuned_bert_embs_prefix="", tune_bert=False, optimizer=None):
     folder = get_data_folder()
-    if not tune_bert:
-        model.input_encoder.seq2emb = {}
+    if tune_bert:
+        # the cached ProtBERT outputs/activations are not saved with the model
+        frozen_output_cache, model.frozen_output_cache = getattr(model, "frozen_output_cache", None), None
+        lower_layer_cache, model.lower_layer_cache = getattr(model, "lower_layer_cache", None), None
+        bert_model = model.ProtBertBFD
+        if getattr(model, "lora_config", None) is not None and is_lora_base_model(bert_model, model.lora_config):
+            # only the adapters of LoRA-tuned models are saved (see load_lora_protbert); models whose ProtBERT was
+            # modified otherwise (e.g. quantized) are saved entirely
+            model.lora_state, model.ProtBertBFD = lora_state_dict(bert_model), None
+    # (the precomputed embeddings of non-tune_bert models are not saved, see PartitionEmbeddingProvider)
     torch.save(model, folder + model_name + "_best_eval.pth")
-    if not tune_bert:
-        model.input_encoder.update(tuned_bert_embs_prefix=tuned_bert_embs_prefix)
+    if tune_bert:
+        model.frozen_output_cache, model.lower_layer_cache = frozen_output_cache, lower_layer_cache
+        model.ProtBertBFD, model.lora_state = bert_model, None
     if optimizer is not None:
         if type(optimizer) == list:
             torch.save(optimizer[0].state_dict(), folder + model_name + "_best_eval_only_opt_state_dict_cls_head.pth")
@@ -926,6 +1211,34 @@ def save_model(model, model_name="", tuned_bert_embs_prefix="", tune_bert=False,
         else:
             torch.save(optimizer.state_dict(), folder + model_name + "_best_eval_only_opt_state_dict.pth")
 
+def quantize_model(model, tune_bert=False):
+    """
+    Dynamic int8 quantization of the nn.Linear layers of ProtBERT and of the TSignal decoder/generator (their weights
+    are stored as int8 and the activations are quantized on the fly), for CPU inference. The model is modified
+    in-place; quantized models can be saved with save_model and loaded with load_model as any other model.
+
+    :param model: ProtBertClassifier (tune_bert=True) or TransformerModel
+    :param bool tune_bert: <model> is a ProtBertClassifier
+    :return: the quantized model
+    """
+    if torch.cuda.is_available():
+        raise RuntimeError("int8 quantized models can only be run on CPU (e.g. set CUDA_VISIBLE_DEVICES=\"\")")
+    model = model.cpu().eval()
+    head = model.classification_head if tune_bert else model
+    if tune_bert:
+        model.ProtBertBFD = torch.quantization.quantize_dynamic(model.ProtBertBFD, {nn.Linear}, dtype=torch.qint8,
+                                                                inplace=True)
+        # the quantized ProtBERT is no longer the base model + adapters: it is saved entirely and its adapters are not
+        # shared with other models (see SharedLoRAEncoder)
+        model.lora_config = None
+    # quantize_dynamic only swaps the children of the module it is given, so the (bare nn.Linear) generator is
+    # quantized through its parent
+    torch.quantization.quantize_dynamic(head, {"transformer": torch.quantization.default_dynamic_qconfig,
+                                               "generator": torch.quantization.default_dynamic_qconfig},
+                                        dtype=torch.qint8, inplace=True)
+    return model
+
+
 def save_sptype_model(model, model_name="", best=False, optimizer=None):
     folder = get_data_folder()
     if os.path.exists(folder + model_name + "_best_sptye_eval.pth"):
@@ -1025,9 +1338,8 @@ def test_mcc_sptype_clasifier(args, model, val_or_test="validate", epoch=-1):
                                 tuned_bert_embs_prefix=tuned_bert_embs_prefix, extended_sublbls=args.extended_sublbls,
                                 random_folds_prefix=random_folds_prefix, train_on_subset=args.train_on_subset,
                                 lipbobox_predictions=args.lipbobox_predictions)
-    dataset_loader = torch.utils.data.DataLoader(sp_dataset,
-                                                 batch_size=args.batch_size, shuffle=True,
-                                                 num_workers=4, collate_fn=collate_fn)
+    dataset_loader = get_cs_dataset_loader(sp_dataset, args.batch_size, True,
+                                           length_buckets=args.length_buckets, max_tokens=args.max_tokens)
     pred_lbl_2_glbl_lbl = {0:5, 1:1, 2:0, 3:0, 4:3, 5:0, 6:4, 7:2, 8:0, 9:0, 10:0}
     ind2lbl = {v:k for k,v in sp_data.lbl2ind.items()}
     life_grp, all_seqs, true_lbls, pred_lbls, seq2sptype = [], [], [], [], {}
@@ -1037,12 +1349,8 @@ def test_mcc_sptype_clasifier(args, model, val_or_test="validate", epoch=-1):
             life_grp.append(o+"|"+g)
         if args.tune_bert:
             seq_lengths = [len(s) for s in seqs]
-            seqs_ = [" ".join(r_ for r_ in s) for s in seqs]
-            inputs = model.tokenizer.batch_encode_plus(seqs_,
-                                                       add_special_tokens=model.hparams.special_tokens,
-                                                       padding=True,
-                                                       truncation=True,
-                                                       max_length=model.hparams.max_length)
+            inputs = model.tokenize(seqs)
+            inputs['sequences'] = seqs
             inputs['targets'] = lbl_seqs
             inputs['seq_lengths'] = seq_lengths
             logits = model(**inputs)
@@ -1079,9 +1387,8 @@ def train_sp_type_predictor(args):
                                 random_folds_prefix=random_folds_prefix, train_on_subset=args.train_on_subset,
                                 lipbobox_predictions=args.lipbobox_predictions)
 
-    dataset_loader = torch.utils.data.DataLoader(sp_dataset,
-                                                 batch_size=args.batch_size, shuffle=True,
-                                                 num_workers=4, collate_fn=collate_fn)
+    dataset_loader = get_cs_dataset_loader(sp_dataset, args.batch_size, True,
+                                           length_buckets=args.length_buckets, max_tokens=args.max_tokens)
     hparams, logger = parse_arguments_and_retrieve_logger(save_dir="experiments")
     hparams.train_enc_dec_sp6 = True
     # form_sp_reg_data=form_sp_reg_data if not extended_sublbls else False
@@ -1094,12 +1401,14 @@ def train_sp_type_predictor(args):
         if args.remove_bert_layers != 0:
             model.ProtBertBFD.encoder.layer = model.ProtBertBFD.encoder.layer[:-args.remove_bert_layers]
         model.classification_head = classification_head
+        model.pack_length = args.pack_length
         model.to(device)
         if args.frozen_epochs > 0:
             model.freeze_encoder()
     else:
         model = load_model(args.load_model, tune_bert=True)
         model.classification_head = classification_head
+        model.pack_length = args.pack_length
         model.to(device)
         if args.frozen_epochs > 0:
             model.freeze_encoder()
@@ -1196,12 +1505,8 @@ def train_sp_type_predictor(args):
         for ind, batch in tqdm(enumerate(dataset_loader), "Epoch {} train:".format(e), total=len(dataset_loader)):
             seqs, lbl_seqs, lg_maybe, glbl_lbls = batch
             seq_lengths = [len(s) for s in seqs]
-            seqs = [" ".join(r_ for r_ in s) for s in seqs]
-            inputs = model.tokenizer.batch_encode_plus(seqs,
-                                                       add_special_tokens=model.hparams.special_tokens,
-                                                       padding=True,
-                                                       truncation=True,
-                                                       max_length=model.hparams.max_length)
+            inputs = model.tokenize(seqs)
+            inputs['sequences'] = seqs
             inputs['targets'] = lbl_seqs
             inputs['seq_lengths'] = seq_lengths
             logits = model(**inputs)
@@ -1266,9 +1571,8 @@ def train_sp_type_predictor(args):
             swa_model.module.to("cpu")
             if args.add_val_data_on_swa:
                 sp_dataset.add_test_seqs()
-                dataset_loader = torch.utils.data.DataLoader(sp_dataset,
-                                                             batch_size=args.batch_size, shuffle=True,
-                                                             num_workers=4, collate_fn=collate_fn)
+                dataset_loader = get_cs_dataset_loader(sp_dataset, args.batch_size, True,
+                                                       length_buckets=args.length_buckets, max_tokens=args.max_tokens)
         # if patience <= 10:
         #     anneal_scheduler.step()
         #     print("After 5 epochs without improvement, learning rate dropped to :"
@@ -1301,6 +1605,10 @@ def train_cs_predictors(args):
         test_partition = set() if args.deployment_model else {0, 1, 2} - set(args.train_folds)
     args.train_folds = [0, 1, 2] if args.deployment_model else args.train_folds
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # ProtBERT embeddings computed during evaluation are cached per ProtBERT weights (only reused while the weights
+    # stay the same, e.g. when evaluating the best model on the validation and test sets)
+    emb_cache = ProtBertEmbeddingCache(args.emb_cache_dir, max_disk_gb=args.emb_cache_max_gb,
+                                       max_memory_entries=args.emb_cache_mem_entries) if args.emb_cache_dir else None
     sp_data = SPCSpredictionData(form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified, very_simplified=args.very_simplified,
                                  extended_sublbls=args.extended_sublbls, tune_bert=args.tune_bert)
     sp_data.lbl2ind = {'P': 0, 'S': 1, 'O': 2, 'M': 3, 'L': 4, 'I': 5, 'T': 6, 'PD': 7, 'BS': 8, 'ES': 9} if args.lipbobox_predictions else sp_data.lbl2ind
@@ -1316,9 +1624,9 @@ def train_cs_predictors(args):
                                 tuned_bert_embs_prefix=tuned_bert_embs_prefix, extended_sublbls=args.extended_sublbls,
                                 random_folds_prefix=random_folds_prefix, train_on_subset=args.train_on_subset,
                                 lipbobox_predictions=args.lipbobox_predictions)
-    dataset_loader = torch.utils.data.DataLoader(sp_dataset,
-                                                 batch_size=args.batch_size, shuffle=True,
-                                                 num_workers=4, collate_fn=collate_fn)
+    dataset_loader = get_cs_dataset_loader(sp_dataset, args.batch_size, True,
+                                           length_buckets=args.length_buckets, max_tokens=args.max_tokens)
+    collate = collate_fn
     swa_start = args.swa_start
     if len(sp_data.og2ind.keys()) <= 1 or not args.add_og_info:
         og2ind = None
@@ -1347,9 +1655,33 @@ def train_cs_predictors(args):
         if args.remove_bert_layers != 0:
             model.ProtBertBFD.encoder.layer = model.ProtBertBFD.encoder.layer[:-args.remove_bert_layers]
         model.classification_head = classification_head
+        model.pack_length = args.pack_length
+        if args.lora_rank > 0:
+            # only the low-rank adapters of ProtBERT are tuned (and saved)
+            add_lora_adapters(model.ProtBertBFD, rank=args.lora_rank, alpha=args.lora_alpha, dropout=args.lora_dropout)
+            model.lora_config = {"rank": args.lora_rank, "alpha": args.lora_alpha, "dropout": args.lora_dropout,
+                                 "no_layers": len(model.ProtBertBFD.encoder.layer)}
         model.to(device)
+        if args.tune_top_bert_layers > 0:
+            # partial fine-tuning: the layers below the top --tune_top_bert_layers are frozen and their outputs cached
+            no_frozen_layers = len(model.ProtBertBFD.encoder.layer) - args.tune_top_bert_layers
+            model.set_lower_layer_cache(LowerLayerActivationCache(model.ProtBertBFD, no_frozen_layers,
+                                                                  cache_dir=args.lower_layer_cache_dir))
+            for seqs, _, _, _ in tqdm(dataset_loader, "Caching ProtBERT layer {} activations".format(no_frozen_layers)):
+                inputs = model.tokenize(seqs)
+                model.lower_layer_cache.get_hidden_states(model.ProtBertBFD, inputs['input_ids'],
+                                                          inputs['attention_mask'])
         if args.frozen_epochs > 0:
             model.freeze_encoder()
+            if args.cache_frozen_outputs:
+                # ProtBERT outputs are computed once (first frozen epoch) and dropped by unfreeze_encoder
+                model.frozen_output_cache = FrozenEncoderOutputCache(args.frozen_cache_dir)
+        if args.tensor_batches and not args.augment_trimmed_seqs:
+            # sequences/labels are encoded once; the batch tensors are built by the DataLoader workers
+            collate = TensorCollate(sp_dataset, model.get_residue_tokenizer(), sp_data.lbl2ind)
+            dataset_loader = get_cs_dataset_loader(sp_dataset, args.batch_size, True, collate=collate,
+                                                   length_buckets=args.length_buckets, max_tokens=args.max_tokens,
+                                                   pin_memory=args.pin_memory)
     else:
         model = init_model(len(sp_data.lbl2ind.keys()), lbl2ind=sp_data.lbl2ind, og2ind=og2ind,
                            dropout=args.dropout, use_glbl_lbls=args.use_glbl_lbls, no_glbl_lbls=len(sp_data.glbl_lbl_2ind.keys()),
@@ -1380,7 +1712,8 @@ def train_cs_predictors(args):
 
     loss_fn_tune = torch.nn.CrossEntropyLoss(ignore_index=sp_data.lbl2ind["PD"], reduction='none')
 
-
+    # the ProtBERT parameters of LoRA-tuned models are the low-rank adapters, tuned with a larger lr
+    bert_lr = args.lora_lr if args.tune_bert and args.lora_rank > 0 else 0.00001
     if args.tune_bert:
         if args.use_swa:
             # in this case, we will use a cyclic scheduler on the best model found based on early stopping. few problems:
@@ -1404,7 +1737,7 @@ def train_cs_predictors(args):
                 },
             ]
             classification_head_optimizer = optim.Adam(parameters, lr=args.lr,  eps=1e-9, weight_decay=args.wd, betas=(0.9, 0.98),)
-            bert_optimizer = optim.Adam(model.ProtBertBFD.parameters(),  lr=0.00001,  eps=1e-9, weight_decay=args.wd, betas=(0.9, 0.98),)
+            bert_optimizer = optim.Adam(model.ProtBertBFD.parameters(),  lr=bert_lr,  eps=1e-9, weight_decay=args.wd, betas=(0.9, 0.98),)
             optimizer = [classification_head_optimizer, bert_optimizer]
         else:
             # BERT model always has this LR, as any higher lr worsens the results
@@ -1412,7 +1745,7 @@ def train_cs_predictors(args):
                 {"params": model.classification_head.parameters()},
                 {
                     "params": model.ProtBertBFD.parameters(),
-                    "lr": 0.00001,
+                    "lr": bert_lr,
                 },
             ]
             # optimizer = Lamb(parameters, lr=self.hparams.learning_rate, weight_decay=0.01)
@@ -1436,6 +1769,10 @@ def train_cs_predictors(args):
     #     warmup_scheduler, scheduler = get_lr_scheduler_swa(optimizer, lr_scheduler_swa, lr_sched_warmup, use_swa)
     # else:
     warmup_scheduler = None
+    # autocast regions (and loss scaling for fp16) for --precision fp16/bf16, with the --fp32_modules kept in fp32
+    scaler = get_grad_scaler(args.precision)
+    if args.precision != "fp32":
+        keep_modules_in_fp32(model, args.fp32_modules)
 
     best_valid_loss = 5 ** 10
     best_valid_mcc_and_recall = -1
@@ -1483,6 +1820,7 @@ def train_cs_predictors(args):
                     swa_model.to("cpu")
                 iter_no += 1
             seqs, lbl_seqs, _, glbl_lbls = batch
+            targets = None
             # if augment_trimmed_seqs:
             cuts = np.random.randint(0,10,len(seqs))
             if args.augment_trimmed_seqs:
@@ -1490,106 +1828,105 @@ def train_cs_predictors(args):
                 lbl_seqs = [l[:-cuts[cut_ind]] if cut_ind != 0  else l for cut_ind, l in enumerate(lbl_seqs)]
             else:
                 cut_seqs = None
-            if args.use_glbl_lbls:
-                if args.tune_bert:
-                    seq_lengths = [len(s) for s in seqs]
-                    seqs = [" ".join(r_ for r_ in s) for s in seqs]
-                    inputs = model.tokenizer.batch_encode_plus(seqs,
-                                                               add_special_tokens=model.hparams.special_tokens,
-                                                               padding=True,
-                                                               truncation=True,
-                                                               max_length=model.hparams.max_length)
-                    inputs['targets'] = lbl_seqs
-                    inputs['seq_lengths'] = seq_lengths
-                    logits, glbl_logits = model(**inputs)
-                else:
+            with get_autocast(args.precision):
+                if args.use_glbl_lbls:
+                    if args.tune_bert and isinstance(batch, TensorBatch):
+                        inputs, targets = tensor_batch_inputs(batch, device)
+                        logits, glbl_logits = model(**inputs)
+                    elif args.tune_bert:
+                        seq_lengths = [len(s) for s in seqs]
+                        inputs = model.tokenize(seqs)
+                        inputs['sequences'] = seqs
+                        inputs['targets'] = lbl_seqs
+                        inputs['seq_lengths'] = seq_lengths
+                        logits, glbl_logits = model(**inputs)
+                    else:
+                        logits, glbl_logits = model(seqs, lbl_seqs)
+                    if type(optimizer) == list:
+                        # for separate classification_head/BERT optimizers
+                        optimizer[0].zero_grad()
+                        optimizer[1].zero_grad()
+                    else:
+                        optimizer.zero_grad()
+                    if targets is None:
+                        targets = padd_add_eos_tkn(lbl_seqs, sp_data.lbl2ind)
+                    if args.tune_cs > 0 and e > 35:
+                        seq_indices = []
+                        seq_dim = logits.shape[0]
+                        for ind_, (gl, t) in enumerate(zip(glbl_lbls, targets)):
+                            if gl != 0:
+                                t = list(t.cpu().numpy())
+                                t.reverse()
+                                last_sp_ind = len(t) - t.index(0) - 1
+                                sp_inds = list(range(last_sp_ind - args.tune_cs, last_sp_ind + args.tune_cs))
+                                seq_indices.extend([si + seq_dim * ind_ for si in sp_inds])
+
+                        loss = loss_fn_tune(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
+                        loss *= 0.1
+                        loss[seq_indices] *= 10
+                        loss = torch.mean(loss)
+                        losses += loss.item()
+
+                        loss_glbl = loss_fn_glbl(glbl_logits, torch.tensor(glbl_lbls, device=device))
+                        losses_glbl += loss_glbl.item()
+                        loss += loss_glbl * args.glbl_lbl_weight
+                    else:
+                        # if "MKIFFAVLVILVLFSMLIWTAYGTPYPVNCKTDRDCVMCGLGISCKNGYCQGCTR" in seqs:
+                        #     datruind = -1
+                        #     for ind__, s in enumerate(seqs):
+                        #         if s == "MKIFFAVLVILVLFSMLIWTAYGTPYPVNCKTDRDCVMCGLGISCKNGYCQGCTR":
+                        #             datruind = ind__
+                        #     print(lbl_seqs[datruind])
+                        #     print(targets[datruind])
+                        loss = loss_fn(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
+                        losses += loss.item()
+                        loss_glbl = loss_fn_glbl(glbl_logits, torch.tensor([sp_data.glbl_lbl_2ind[gl] for gl in glbl_lbls], device=device))
+                        losses_glbl += loss_glbl.item()
+                        loss += loss_glbl * args.glbl_lbl_weight
+                elif args.form_sp_reg_data and not args.extended_sublbls:
                     logits, glbl_logits = model(seqs, lbl_seqs)
-                if type(optimizer) == list:
-                    # for separate classification_head/BERT optimizers
-                    optimizer[0].zero_grad()
-                    optimizer[1].zero_grad()
-                else:
-                    optimizer.zero_grad()
-                targets = padd_add_eos_tkn(lbl_seqs, sp_data.lbl2ind)
-                if args.tune_cs > 0 and e > 35:
-                    seq_indices = []
-                    seq_dim = logits.shape[0]
-                    for ind_, (gl, t) in enumerate(zip(glbl_lbls, targets)):
-                        if gl != 0:
-                            t = list(t.cpu().numpy())
-                            t.reverse()
-                            last_sp_ind = len(t) - t.index(0) - 1
-                            sp_inds = list(range(last_sp_ind - args.tune_cs, last_sp_ind + args.tune_cs))
-                            seq_indices.extend([si + seq_dim * ind_ for si in sp_inds])
-
-                    loss = loss_fn_tune(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
-                    loss *= 0.1
-                    loss[seq_indices] *= 10
-                    loss = torch.mean(loss)
+                    if type(optimizer) == "list":
+                        optimizer[0].zero_grad()
+                        optimizer[1].zero_grad()
+                    else:
+                        optimizer.zero_grad()
+                    targets = padd_add_eos_tkn(lbl_seqs, sp_data.lbl2ind)
+                    loss = loss_fn(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
                     losses += loss.item()
 
                     loss_glbl = loss_fn_glbl(glbl_logits, torch.tensor(glbl_lbls, device=device))
                     losses_glbl += loss_glbl.item()
                     loss += loss_glbl * args.glbl_lbl_weight
                 else:
-                    # if "MKIFFAVLVILVLFSMLIWTAYGTPYPVNCKTDRDCVMCGLGISCKNGYCQGCTR" in seqs:
-                    #     datruind = -1
-                    #     for ind__, s in enumerate(seqs):
-                    #         if s == "MKIFFAVLVILVLFSMLIWTAYGTPYPVNCKTDRDCVMCGLGISCKNGYCQGCTR":
-                    #             datruind = ind__
-                    #     print(lbl_seqs[datruind])
-                    #     print(targets[datruind])
+                    if args.tune_bert and isinstance(batch, TensorBatch):
+                        inputs, targets = tensor_batch_inputs(batch, device)
+                        logits = model(**inputs)
+                    elif args.tune_bert:
+                        seq_lengths = [len(s) for s in seqs]
+                        inputs = model.tokenize(cut_seqs if args.augment_trimmed_seqs else seqs)
+                        inputs['targets'] = lbl_seqs
+                        inputs['seq_lengths'] = seq_lengths
+                        inputs['sequences'] = seqs
+                        logits = model(**inputs)
+                    else:
+                        logits = model(seqs, lbl_seqs)
+                    if type(optimizer) == list:
+                        optimizer[0].zero_grad()
+                        optimizer[1].zero_grad()
+                    else:
+                        optimizer.zero_grad()
+                    if targets is None:
+                        targets = padd_add_eos_tkn(lbl_seqs, sp_data.lbl2ind)
                     loss = loss_fn(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
                     losses += loss.item()
-                    loss_glbl = loss_fn_glbl(glbl_logits, torch.tensor([sp_data.glbl_lbl_2ind[gl] for gl in glbl_lbls], device=device))
-                    losses_glbl += loss_glbl.item()
-                    loss += loss_glbl * args.glbl_lbl_weight
-            elif args.form_sp_reg_data and not args.extended_sublbls:
-                logits, glbl_logits = model(seqs, lbl_seqs)
-                if type(optimizer) == "list":
-                    optimizer[0].zero_grad()
-                    optimizer[1].zero_grad()
-                else:
-                    optimizer.zero_grad()
-                targets = padd_add_eos_tkn(lbl_seqs, sp_data.lbl2ind)
-                loss = loss_fn(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
-                losses += loss.item()
-
-                loss_glbl = loss_fn_glbl(glbl_logits, torch.tensor(glbl_lbls, device=device))
-                losses_glbl += loss_glbl.item()
-                loss += loss_glbl * args.glbl_lbl_weight
-            else:
-                if args.tune_bert:
-                    seq_lengths = [len(s) for s in seqs]
-                    seqs = [" ".join(r_ for r_ in s) for s in seqs]
-                    cut_seqs = [" ".join(r_ for r_ in s) for s in cut_seqs] if cut_seqs is not None else None
-                    inputs = model.tokenizer.batch_encode_plus(cut_seqs if args.augment_trimmed_seqs else seqs,
-                                                               add_special_tokens=model.hparams.special_tokens,
-                                                               padding=True,
-                                                               truncation=True,
-                                                               max_length=model.hparams.max_length)
-                    inputs['targets'] = lbl_seqs
-                    inputs['seq_lengths'] = seq_lengths
-                    if  args.augment_trimmed_seqs:
-                        inputs['sequences'] = seqs
-                    logits = model(**inputs)
-                else:
-                    logits = model(seqs, lbl_seqs)
-                if type(optimizer) == list:
-                    optimizer[0].zero_grad()
-                    optimizer[1].zero_grad()
-                else:
-                    optimizer.zero_grad()
-                targets = padd_add_eos_tkn(lbl_seqs, sp_data.lbl2ind)
-                loss = loss_fn(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
-                losses += loss.item()
 
-            loss.backward()
+            scaler.scale(loss).backward()
             if type(optimizer) == list:
-                optimizer[0].step()
-                optimizer[1].step()
+                scaler.step(optimizer[0])
+                scaler.step(optimizer[1])
             else:
-                optimizer.step()
+                scaler.step(optimizer)
+            scaler.update()
         if args.use_swa and e >= swa_start and args.lr_scheduler_swa == "none":
             swa_model.to("cuda:0")
             swa_model.update_parameters(model)
@@ -1600,7 +1937,12 @@ def train_cs_predictors(args):
             _ = evaluate(swa_model.module.to(device) if args.use_swa and e + 1>= swa_start else model , sp_data.lbl2ind, run_name=args.run_name, partitions=validate_partitions, sets=["test"],
                          epoch=e, form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified,very_simplified=args.very_simplified, glbl_lbl_2ind=sp_data.glbl_lbl_2ind,
                          tuned_bert_embs_prefix=tuned_bert_embs_prefix, extended_sublbls=args.extended_sublbls, random_folds_prefix=random_folds_prefix, train_oh=args.train_oh,
-                         lipbobox_predictions=args.lipbobox_predictions, sptype_preds=args.test_sptype_preds)
+                         lipbobox_predictions=args.lipbobox_predictions, sptype_preds=args.test_sptype_preds,
+                         use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision,
+                         length_buckets=args.length_buckets, max_tokens=args.max_tokens)
             sp_pred_mccs, sp_pred_mccs2, lipo_pred_mccs, lipo_pred_mccs2, tat_pred_mccs, tat_pred_mccs2, \
             all_recalls_lipo, all_precisions_lipo, all_recalls_tat, all_precisions_tat, all_f1_scores_lipo, all_f1_scores_tat, \
             all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
@@ -1608,7 +1950,9 @@ def train_cs_predictors(args):
             valid_loss = eval_trainlike_loss(model, sp_data.lbl2ind, run_name=args.run_name, partitions=validate_partitions,
                                              sets=["test"], form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified,
                                              very_simplified=args.very_simplified, tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,
-                                             random_folds_prefix=random_folds_prefix,lipbobox_predictions=args.lipbobox_predictions)
+                                             random_folds_prefix=random_folds_prefix,lipbobox_predictions=args.lipbobox_predictions,
+                                             precision=args.precision,
+                                             length_buckets=args.length_buckets, max_tokens=args.max_tokens)
             # revert valid_loss to not change the loss condition next ( this won't be a loss
             # but it's the quickest way to test performance when validation with the test set
         else:
@@ -1617,12 +1961,18 @@ def train_cs_predictors(args):
             valid_loss = eval_trainlike_loss(model, sp_data.lbl2ind, run_name=args.run_name, partitions=validate_partitions,
                                              sets=valid_sets, form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified,
                                              very_simplified=args.very_simplified, tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,
-                                             random_folds_prefix=random_folds_prefix,lipbobox_predictions=args.lipbobox_predictions)
+                                             random_folds_prefix=random_folds_prefix,lipbobox_predictions=args.lipbobox_predictions,
+                                             precision=args.precision,
+                                             length_buckets=args.length_buckets, max_tokens=args.max_tokens)
             _ = evaluate(swa_model.module.to(device) if args.use_swa and e >= swa_start else model, sp_data.lbl2ind, run_name=args.run_name,
                          partitions=validate_partitions, sets=valid_sets, epoch=e, form_sp_reg_data=args.form_sp_reg_data,
                          simplified=args.simplified, very_simplified=args.very_simplified, glbl_lbl_2ind=sp_data.glbl_lbl_2ind,
                          tuned_bert_embs_prefix=tuned_bert_embs_prefix, tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,
-                         random_folds_prefix=random_folds_prefix, train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions, sptype_preds=args.test_sptype_preds)
+                         random_folds_prefix=random_folds_prefix, train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions, sptype_preds=args.test_sptype_preds, use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision,
+                         length_buckets=args.length_buckets, max_tokens=args.max_tokens)
             sp_pred_mccs, sp_pred_mccs2, lipo_pred_mccs, lipo_pred_mccs2, tat_pred_mccs, tat_pred_mccs2, \
             all_recalls_lipo, all_precisions_lipo, all_recalls_tat, all_precisions_tat, all_f1_scores_lipo, all_f1_scores_tat, \
             all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
@@ -1685,7 +2035,11 @@ def train_cs_predictors(args):
                          simplified=args.simplified, very_simplified=args.very_simplified, glbl_lbl_2ind=sp_data.glbl_lbl_2ind,
                          tuned_bert_embs_prefix=tuned_bert_embs_prefix, tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,
                          random_folds_prefix=random_folds_prefix, train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions,
-                         sptype_preds=args.test_sptype_preds)
+                         sptype_preds=args.test_sptype_preds, use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision,
+                         length_buckets=args.length_buckets, max_tokens=args.max_tokens)
             sp_pred_mccs, sp_pred_mccs2, lipo_pred_mccs, lipo_pred_mccs2, tat_pred_mccs, tat_pred_mccs2, \
             all_recalls_lipo, all_precisions_lipo, all_recalls_tat, all_precisions_tat, all_f1_scores_lipo, all_f1_scores_tat, \
             all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
@@ -1794,9 +2148,9 @@ def train_cs_predictors(args):
             # since we dont use early stopping anymore, add these seqs
             if args.add_val_data_on_swa:
                 sp_dataset.add_test_seqs()
-                dataset_loader = torch.utils.data.DataLoader(sp_dataset,
-                                                             batch_size=args.batch_size, shuffle=True,
-                                                             num_workers=4, collate_fn=collate_fn)
+                dataset_loader = get_cs_dataset_loader(sp_dataset, args.batch_size, True, collate=collate,
+                                                       length_buckets=args.length_buckets, max_tokens=args.max_tokens,
+                                                       pin_memory=args.pin_memory and collate != collate_fn)
     if args.use_swa:
         update_bn(dataset_loader, swa_model.to(device))
         save_model(swa_model.module, args.run_name, tuned_bert_embs_prefix=tuned_bert_embs_prefix, tune_bert=args.tune_bert)
@@ -1813,7 +2167,11 @@ def train_cs_predictors(args):
                  form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified, second_model=second_model, very_simplified=args.very_simplified,
                  glbl_lbl_2ind=sp_data.glbl_lbl_2ind, tuned_bert_embs_prefix=tuned_bert_embs_prefix,
                  tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,random_folds_prefix=random_folds_prefix,
-                 train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions,sptype_preds=args.test_sptype_preds)
+                 train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions,sptype_preds=args.test_sptype_preds, use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision,
+                         length_buckets=args.length_buckets, max_tokens=args.max_tokens)
         sp_pred_mccs, all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
             get_cs_and_sp_pred_results(filename=args.run_name + "_best.bin".format(e), v=False, return_class_prec_rec=True)
         all_recalls, all_precisions, total_positives = list(np.array(all_recalls).flatten()), list(
@@ -1828,14 +2186,22 @@ def train_cs_predictors(args):
                      very_simplified=args.very_simplified, glbl_lbl_2ind=sp_data.glbl_lbl_2ind, account_lipos=args.account_lipos,
                      tuned_bert_embs_prefix=tuned_bert_embs_prefix, tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,
                      random_folds_prefix=random_folds_prefix, train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions,
-                     sptype_preds=args.test_sptype_preds)
+                     sptype_preds=args.test_sptype_preds, use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision,
+                         length_buckets=args.length_buckets, max_tokens=args.max_tokens)
         if args.test_only_cs:
             evaluate(model, sp_data.lbl2ind, run_name=args.run_name + "_onlycs_best", partitions=test_partition,
                      sets=["train", "test"], form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified,
                      second_model=second_model, very_simplified=args.very_simplified, test_only_cs=args.test_only_cs, glbl_lbl_2ind=sp_data.glbl_lbl_2ind,
                      tuned_bert_embs_prefix=tuned_bert_embs_prefix, tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,
                      random_folds_prefix=random_folds_prefix, train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions,
-                     sptype_preds=args.test_sptype_preds)
+                     sptype_preds=args.test_sptype_preds, use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision,
+                         length_buckets=args.length_buckets, max_tokens=args.max_tokens)
             sp_pred_mccs, all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
                 get_cs_and_sp_pred_results(filename=args.run_name + "_onlycs_best.bin".format(e), v=False,
                                            return_class_prec_rec=True)
@@ -1851,8 +2217,12 @@ def train_cs_predictors(args):
                      form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified, second_model=second_model,
                      very_simplified=args.very_simplified,
                      glbl_lbl_2ind=sp_data.glbl_lbl_2ind, tuned_bert_embs_prefix=tuned_bert_embs_prefix,
-                     tune_bert=args.tune_bert,use_beams_search=True, random_folds_prefix=random_folds_prefix,
-                     train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions,sptype_preds=args.test_sptype_preds)
+                     tune_bert=args.tune_bert,use_beams_search=True, beam_width=args.beam_width, random_folds_prefix=random_folds_prefix,
+                     train_oh=args.train_oh,lipbobox_predictions=args.lipbobox_predictions,sptype_preds=args.test_sptype_preds, use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision,
+                         length_buckets=args.length_buckets, max_tokens=args.max_tokens)
             sp_pred_mccs, all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores = \
                 get_cs_and_sp_pred_results(filename="best_beam_" + args.run_name + ".bin".format(e), v=False)
             all_recalls, all_precisions, total_positives = list(np.array(all_recalls).flatten()), list(
@@ -1863,7 +2233,12 @@ def train_cs_predictors(args):
             pos_fp_info.extend(false_positives)
 
 def test_seqs_w_pretrained_mdl(model_f_name="", test_file="", verbouse=True, tune_bert=False, saliency_map_save_fn="save.bin",hook_layer="bert",
-                               lipbobox_predictions=False, compute_saliency=False):
+                               lipbobox_predictions=False, compute_saliency=False, use_kv_cache=True, cs_only=False,
+                               use_structured_cs=False, report_greedy_agreement=False, use_beam_search=False,
+                               beam_width=3, ensemble_mdls=None, ensemble_aggregation="avg", emb_cache_dir="",
+                               emb_cache_max_gb=10., emb_cache_mem_entries=20000, quantize="none", precision="fp32",
+                               fp32_modules=("generator", "LayerNorm"), onnx_mdl="", onnx_threads=0,
+                               pack_length=0):
     folder = get_data_folder()
     sp_data = SPCSpredictionData(form_sp_reg_data=False, tune_bert=tune_bert)
     # hard-code this for now to check some sequences
@@ -1899,11 +2274,28 @@ def test_seqs_w_pretrained_mdl(model_f_name="", test_file="", verbouse=True, tun
     # the form_sp_reg_data param is used to both denote teh RR/C... usage and usually had a mandatory glbl label
     # in the SP-cs. The current experiment however tests no-glbl-cs tuning
     model = load_model(model_f_name, dict_file=test_file, tune_bert=True, testing=True)
+    # the other models of the ensemble (e.g. the models of the other cross-validation folds), if any
+    ensemble_models = [load_model(mdl_f_name, dict_file=test_file, tune_bert=True, testing=True)
+                       for mdl_f_name in ensemble_mdls] if ensemble_mdls else []
+    if quantize == "int8":
+        model = quantize_model(model, tune_bert=True)
+        ensemble_models = [quantize_model(m, tune_bert=True) for m in ensemble_models]
+    if precision != "fp32":
+        for m in [model] + ensemble_models:
+            keep_modules_in_fp32(m, fp32_modules)
+    for m in [model] + ensemble_models:
+        m.pack_length = pack_length
+    shared_encoder = get_shared_encoder([model] + ensemble_models) if tune_bert and ensemble_models else None
     if not tune_bert:
         # if the loaded model did not tune ProtBERT, load the initial ProtBERT to retrieve embeddigns
         model_ = ProtBertClassifier(hparams)
         model_.classification_head = model
 
+    # ProtBERT embeddings of the sequences tested before (with the same ProtBERT weights) are read from the cache
+    emb_cache = ProtBertEmbeddingCache(emb_cache_dir, max_disk_gb=emb_cache_max_gb,
+                                       max_memory_entries=emb_cache_mem_entries) if emb_cache_dir else None
+    # the greedy predictions are computed by the exported ONNX graphs (see export_onnx_mdl) with onnxruntime
+    backend = OnnxTSignalBackend(model, folder + onnx_mdl, intra_op_threads=onnx_threads) if onnx_mdl else None
     dataset_loader = torch.utils.data.DataLoader(sp_dataset,
                                                  batch_size=10, shuffle=False,
                                                  num_workers=4, collate_fn=collate_fn)
@@ -1912,60 +2304,157 @@ def test_seqs_w_pretrained_mdl(model_f_name="", test_file="", verbouse=True, tun
     all_outs = []
     all_seqs = []
     all_lbls = []
+    no_agreeing_w_greedy, no_compared_w_greedy = 0, 0
     for ind, batch in enumerate(dataset_loader):
         print("{} number of seqs out of {} tested".format(ind * len(batch), len(dataset_loader)))
         seqs, lbl_seqs, _, glbl_lbls = batch
-        if compute_saliency:
-            some_output, input_gradients, sp_pred_inds_CS_spType= greedy_decode(model, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tgt=None,
-                                                form_sp_reg_data=False, second_model=None, test_only_cs=False,
-                                                         glbl_lbls=None, tune_bert=True, saliency_map=compute_saliency,
-                                                                                hook_layer=hook_layer)
-            all_seq_preds_grad_CSgrad.extend(
-                visualize_importance(some_output, input_gradients, seqs, ind2lbl, ind, sp_pred_inds_CS_spType))
-            all_outs.extend(some_output[1])
-            all_seqs.extend(seqs)
-            all_lbls.extend(lbl_seqs)
-        else:
-            some_output = greedy_decode(model, seqs, sp_data.lbl2ind['BS'],
-                                                 sp_data.lbl2ind, tgt=None,
-                                                 form_sp_reg_data=False,
-                                                 second_model=None, test_only_cs=False,
-                                                 glbl_lbls=None, tune_bert=tune_bert,
-                                                 saliency_map=False,
-                                                 hook_layer=hook_layer)
-            # ys, torch.stack(all_probs).transpose(0,1), sp_probs, all_seq_sp_probs, all_seq_sp_logits, all_seq_label_probs
-            all_outs.extend(some_output[1])
-            all_seqs.extend(seqs)
-            all_lbls.extend(lbl_seqs)
+        # (saliency maps are computed in fp32)
+        with get_autocast("fp32" if compute_saliency else precision):
+            if compute_saliency:
+                some_output, input_gradients, sp_pred_inds_CS_spType= greedy_decode(model, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tgt=None,
+                                                    form_sp_reg_data=False, second_model=None, test_only_cs=False,
+                                                             glbl_lbls=None, tune_bert=True, saliency_map=compute_saliency,
+                                                                                    hook_layer=hook_layer)
+                all_seq_preds_grad_CSgrad.extend(
+                    visualize_importance(some_output, input_gradients, seqs, ind2lbl, ind, sp_pred_inds_CS_spType))
+                all_outs.extend(some_output[1])
+                all_seqs.extend(seqs)
+                all_lbls.extend(lbl_seqs)
+            elif ensemble_models:
+                some_output = ensemble_decode([model] + ensemble_models, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind,
+                                              tune_bert=tune_bert, aggregation=ensemble_aggregation, emb_cache=emb_cache,
+                                              shared_encoder=shared_encoder)
+                all_outs.extend(some_output[1])
+                all_seqs.extend(seqs)
+                all_lbls.extend(lbl_seqs)
+            elif use_beam_search:
+                some_output = beam_decode(model, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tune_bert=tune_bert,
+                                          beam_width=beam_width, emb_cache=emb_cache)
+                all_outs.extend(some_output[1])
+                all_seqs.extend(seqs)
+                all_lbls.extend(lbl_seqs)
+            elif use_structured_cs:
+                some_output = structured_cs_decode(model, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tune_bert=tune_bert,
+                                                   emb_cache=emb_cache)
+                if report_greedy_agreement:
+                    greedy_tokens = greedy_decode(model, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tune_bert=tune_bert,
+                                                  use_kv_cache=use_kv_cache, cs_only=True, emb_cache=emb_cache)[0]
+                    for seq_, pt, gt in zip(seqs, some_output[0], greedy_tokens):
+                        no_agreeing_w_greedy += get_sptype_and_cs([ind2lbl[i] for i in pt], len(seq_)) == \
+                                                get_sptype_and_cs([ind2lbl[i] for i in gt], len(seq_))
+                    no_compared_w_greedy += len(seqs)
+                all_outs.extend(some_output[1])
+                all_seqs.extend(seqs)
+                all_lbls.extend(lbl_seqs)
+            else:
+                some_output = greedy_decode(model, seqs, sp_data.lbl2ind['BS'],
+                                                     sp_data.lbl2ind, tgt=None,
+                                                     form_sp_reg_data=False,
+                                                     second_model=None, test_only_cs=False,
+                                                     glbl_lbls=None, tune_bert=tune_bert,
+                                                     saliency_map=False,
+                                                     hook_layer=hook_layer, use_kv_cache=use_kv_cache, cs_only=cs_only,
+                                                     emb_cache=emb_cache, backend=backend)
+                # ys, torch.stack(all_probs).transpose(0,1), sp_probs, all_seq_sp_probs, all_seq_sp_logits, all_seq_label_probs
+                all_outs.extend(some_output[1])
+                all_seqs.extend(seqs)
+                all_lbls.extend(lbl_seqs)
     pred_lbls = []
     true_lbls = []
+    if no_compared_w_greedy:
+        print("Structured CS decoding agrees with greedy decoding (SP type and CS) on {}/{} sequences".format(
+            no_agreeing_w_greedy, no_compared_w_greedy))
     if compute_saliency:
         pickle.dump(all_seq_preds_grad_CSgrad,
                 open(folder+saliency_map_save_fn, "wb"))
     for seq, pred, lbl in zip(all_seqs, all_outs,all_lbls):
         if lbl[0] == "#": true_lbls.append(lbl) # if it's a placeholder (testing new sequences), don't do anything
         else: true_lbls.append("".join([ind2lbl[i] for i in lbl])[:70])
-        pred_lbls.append("".join([ind2lbl[torch.argmax(out_wrd).item()] for out_wrd in pred if out_wrd != "ES"]))
-        pred_probs = torch.softmax(pred, dim=-1)
-        pred_probs = torch.max(pred_probs, dim=-1)[0].detach().cpu().numpy()
-        # W = Tat/SPase II, T= Tat/SPase I, P=Sec/SPase IV, L=Sec/SPase II, S = Sec/SPase I
-        if pred_lbls[-1][0] in ['S', 'T', 'L', 'W', 'P']: # if SP is predicted
-            # get first non-SP index (cleavage site)
-            sp_type_ = pred_lbls[-1][0]
-            cs_index = pred_lbls[-1].replace("ES","").rfind(sp_type_)
-            cs_prob = pred_probs[cs_index+1]
-        else:
-            cs_prob = "N/A (no SP predicted)"
+        pred_lbl, type_prob, cs_prob = get_pred_lbls_and_probs(seq, pred, ind2lbl)
+        pred_lbls.append(pred_lbl)
 
         print("TRUE:", true_lbls[-1])
         print("PRED:", pred_lbls[-1])
-        print("TYPE PROB:{}; CS PROB:{}".format(pred_probs[0], cs_prob))
+        print("TYPE PROB:{}; CS PROB:{}".format(type_prob, cs_prob))
         print()
 
+
+def get_pred_lbls_and_probs(seq, pred, ind2lbl):
+    """
+    :param str seq: the tested sequence
+    :param torch.tensor pred: decoder outputs of the sequence [no_decoded_labels, ntoken]
+    :param dict ind2lbl: index -> label dictionary
+    :return (str, float, float_or_str): predicted labels, probability of the first label (SP type) and of the cleavage
+            site
+    """
+    # labels past the end of the sequence are not decoded (see greedy_decode)
+    pred = pred[:len(seq)]
+    pred_lbls = "".join([ind2lbl[torch.argmax(out_wrd).item()] for out_wrd in pred if out_wrd != "ES"])
+    pred_probs = torch.softmax(pred, dim=-1)
+    pred_probs = torch.max(pred_probs, dim=-1)[0].detach().cpu().numpy()
+    # W = Tat/SPase II, T= Tat/SPase I, P=Sec/SPase IV, L=Sec/SPase II, S = Sec/SPase I
+    if pred_lbls[0] in ['S', 'T', 'L', 'W', 'P']: # if SP is predicted
+        # get first non-SP index (cleavage site)
+        sp_type_ = pred_lbls[0]
+        cs_index = pred_lbls.replace("ES","").rfind(sp_type_)
+        cs_prob = pred_probs[cs_index+1]
+    else:
+        cs_prob = "N/A (no SP predicted)"
+    return pred_lbls, pred_probs[0], cs_prob
+
+
+def predict_fasta_stream(model_f_name, fasta_f, out_f, batch_size=64, window=70, og="EUKARYA", use_kv_cache=True,
+                         cs_only=False, precision="fp32", fp32_modules=("generator", "LayerNorm"), pack_length=0):
+    """
+    Streaming prediction of the sequences of a (plain or gzipped) FASTA file with a tuned ProtBERT (--tune_bert) model.
+    Records are read and batched on the fly (see stream_fasta_batches) and the greedy predictions of each batch are
+    appended to <out_f>, so memory use does not depend on the size of the file.
+
+    :param str model_f_name: the tested model (in the data folder)
+    :param str fasta_f: path of the FASTA file
+    :param str out_f: tab-separated output file (record id, sequence window, predicted labels, SP type probability,
+            cleavage site probability)
+    :param int batch_size: number of sequences decoded at once
+    :param int window: number of N-terminal residues of each record that are tested
+    :param str og: organism group of the sequences (used by models trained with organism group information)
+    """
+    sp_data = SPCSpredictionData(form_sp_reg_data=False, tune_bert=True)
+    ind2lbl = {v: k for k, v in sp_data.lbl2ind.items()}
+    model = load_model(model_f_name, tune_bert=True)
+    if precision != "fp32":
+        keep_modules_in_fp32(model, fp32_modules)
+    model.pack_length = pack_length
+    model.eval()
+    input_encoder = model.classification_head.input_encoder
+    no_tested = 0
+    with open(out_f, "w") as out:
+        out.write("\t".join(["id", "sequence", "prediction", "sp_type_prob", "cs_prob"]) + "\n")
+        for batch in stream_fasta_batches(fasta_f, batch_size=batch_size, window=window):
+            record_ids, seqs = [b[0] for b in batch], [b[1] for b in batch]
+            # organism groups are only kept for the current batch
+            input_encoder.seq2lg = {s: input_encoder.og2ind[og] for s in seqs}
+            with torch.no_grad(), get_autocast(precision):
+                outs = greedy_decode(model, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tgt=None,
+                                     form_sp_reg_data=False, second_model=None, test_only_cs=False, glbl_lbls=None,
+                                     tune_bert=True, saliency_map=False, use_kv_cache=use_kv_cache, cs_only=cs_only)[1]
+            for record_id, seq, pred in zip(record_ids, seqs, outs):
+                pred_lbl, type_prob, cs_prob = get_pred_lbls_and_probs(seq, pred, ind2lbl)
+                out.write("\t".join([record_id, seq, pred_lbl, str(type_prob), str(cs_prob)]) + "\n")
+            out.flush()
+            no_tested += len(seqs)
+            print("{} sequences tested".format(no_tested))
+            logging.info("{} sequences tested".format(no_tested))
+
 def test_w_precomputed_sptypes(args):
     partitions = [int(f) for f in args.train_folds]
     test_partition = list({0,1,2} - set(partitions))
     model = load_model(args.test_mdl, tune_bert=args.tune_bert)
+    if args.quantize == "int8":
+        model = quantize_model(model, tune_bert=args.tune_bert)
+    if args.precision != "fp32":
+        keep_modules_in_fp32(model, args.fp32_modules)
+    emb_cache = ProtBertEmbeddingCache(args.emb_cache_dir, max_disk_gb=args.emb_cache_max_gb,
+                                       max_memory_entries=args.emb_cache_mem_entries) if args.emb_cache_dir else None
     sp_data = SPCSpredictionData(form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified,
                                  very_simplified=args.very_simplified,
                                  extended_sublbls=args.extended_sublbls, tune_bert=args.tune_bert)
@@ -1975,10 +2464,269 @@ def test_w_precomputed_sptypes(args):
              form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified, second_model=None,
              very_simplified=args.very_simplified, glbl_lbl_2ind=sp_data.glbl_lbl_2ind, tuned_bert_embs_prefix="",
              tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls, random_folds_prefix="",
-             train_oh=args.train_oh, lipbobox_predictions=args.lipbobox_predictions, sptype_preds=args.test_sptype_preds)
+             train_oh=args.train_oh, lipbobox_predictions=args.lipbobox_predictions, sptype_preds=args.test_sptype_preds, use_kv_cache=not args.no_kv_cache,
+                         cs_only=args.cs_only_decoding, use_structured_cs=args.structured_cs_decoding,
+                         report_greedy_agreement=args.report_greedy_agreement, emb_cache=emb_cache,
+                         precision=args.precision)
     sp_pred_mccs, all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
         get_cs_and_sp_pred_results(filename="sptype_tested_"+args.run_name + "_best.bin", v=False,
                                    return_class_prec_rec=True)
     all_recalls, all_precisions, total_positives = list(np.array(all_recalls).flatten()), list(
         np.array(all_precisions).flatten()), list(np.array(total_positives).flatten())
-    print(all_recalls, all_precisions)
\ No newline at end of file
+    print(all_recalls, all_precisions)
+
+
+def test_quantized_mdl(args):
+    """
+    Accuracy report of the int8 quantized (see quantize_model) args.test_mdl: the SP-type MCCs and CS F1 scores of the
+    fp32 and of the quantized model are computed on the held-out fold (the one not in args.train_folds). The quantized
+    model is saved as <args.test_mdl>_int8_best_eval.pth, s.t. it can be used with --test_mdl.
+    """
+    test_partition = list({0, 1, 2} - set([int(f) for f in args.train_folds]))
+    sp_data = SPCSpredictionData(form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified,
+                                 very_simplified=args.very_simplified,
+                                 extended_sublbls=args.extended_sublbls, tune_bert=args.tune_bert)
+    sp_data.lbl2ind = {'P': 0, 'S': 1, 'O': 2, 'M': 3, 'L': 4, 'I': 5, 'T': 6, 'PD': 7, 'BS': 8,
+                       'ES': 9} if args.lipbobox_predictions else sp_data.lbl2ind
+    results = {}
+    for precision in ["fp32", "int8"]:
+        model = load_model(args.test_mdl, tune_bert=args.tune_bert)
+        if precision == "int8":
+            model = quantize_model(model, tune_bert=args.tune_bert)
+        start_time = time.time()
+        evaluate(model, sp_data.lbl2ind, run_name=precision + "_tested_" + args.run_name, partitions=test_partition,
+                 sets=["train", "test"], form_sp_reg_data=args.form_sp_reg_data, simplified=args.simplified,
+                 second_model=None, very_simplified=args.very_simplified, glbl_lbl_2ind=sp_data.glbl_lbl_2ind,
+                 tuned_bert_embs_prefix="", tune_bert=args.tune_bert, extended_sublbls=args.extended_sublbls,
+                 random_folds_prefix="", train_oh=args.train_oh, lipbobox_predictions=args.lipbobox_predictions,
+                 use_kv_cache=not args.no_kv_cache, cs_only=args.cs_only_decoding,
+                 use_structured_cs=args.structured_cs_decoding)
+        eval_time = time.time() - start_time
+        sp_pred_mccs, all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
+            get_cs_and_sp_pred_results(filename=precision + "_tested_" + args.run_name + ".bin", v=False,
+                                       return_class_prec_rec=True)
+        all_recalls, all_precisions = list(np.array(all_recalls).flatten()), list(np.array(all_precisions).flatten())
+        log_and_print_mcc_and_cs_results(sp_pred_mccs, all_recalls, all_precisions, test_on="TEST",
+                                         beam_txt=precision.upper(), all_f1_scores=all_f1_scores, sptype_f1=sptype_f1)
+        results[precision] = (sp_pred_mccs, np.mean(np.concatenate(all_f1_scores)), eval_time)
+    save_model(model, model_name=args.test_mdl.replace("_best_eval.pth", "") + "_int8", tune_bert=args.tune_bert)
+    fp32_size = os.path.getsize(get_data_folder() + args.test_mdl) / 1024 ** 2
+    int8_size = os.path.getsize(get_data_folder() + args.test_mdl.replace("_best_eval.pth", "") + "_int8_best_eval.pth") / 1024 ** 2
+    summary = "INT8 vs FP32: sp-type mccs {} vs {}, mean CS F1 {:.4f} vs {:.4f}, evaluation time {:.1f}s vs {:.1f}s, " \
+              "model size {:.0f}MB vs {:.0f}MB".format(results["int8"][0], results["fp32"][0], results["int8"][1],
+                                                     results["fp32"][1], results["int8"][2], results["fp32"][2],
+                                                     int8_size, fp32_size)
+    print(summary)
+    logging.info(summary)
+
+
+def export_script_mdl(model_f_name, script_f_name, test_file="test_seqs.bin", no_parity_seqs=50):
+    """
+    Exports the (--tune_bert --train_only_decoder) model <model_f_name> as a single TorchScript artifact
+    <script_f_name> (see TSignalScriptPredictor), which can be used for predictions with only torch installed. The
+    predictions of the artifact are then compared to the greedy predictions of the original model on the first
+    <no_parity_seqs> sequences of <test_file>.
+    """
+    folder = get_data_folder()
+    sp_data = SPCSpredictionData(form_sp_reg_data=False, tune_bert=True)
+    test_file = create_binary_test_file_from_fasta(data_path=folder + test_file)
+    model = load_model(model_f_name, dict_file=test_file, tune_bert=True, testing=True).cpu()
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad = False
+    example_ids = torch.randint(5, 25, (1, 72))
+    bert = torch.jit.trace(model.ProtBertBFD, (example_ids, torch.ones_like(example_ids)))
+    predictor = torch.jit.script(TSignalScriptPredictor(bert, model, sp_data.lbl2ind, sp_data.og2ind))
+    torch.jit.save(predictor, folder + script_f_name)
+    print("Saved the TorchScript predictor to {}".format(folder + script_f_name))
+    logging.info("Saved the TorchScript predictor to {}".format(folder + script_f_name))
+
+    # parity check
+    predictor = torch.jit.load(folder + script_f_name)
+    model.to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+    test_data = pickle.load(open(folder + test_file, "rb"))
+    seqs = list(test_data.keys())[:no_parity_seqs]
+    ogs = [test_data[s][2] for s in seqs]
+    ind2lbl = {v: k for k, v in sp_data.lbl2ind.items()}
+    with torch.no_grad():
+        script_lbls, script_sp_types, script_css, _ = predictor(seqs, ogs)
+        predicted_tokens = translate(model, seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tune_bert=True)[0]
+    no_same_lbls, no_same_sptype_cs = 0, 0
+    for s, s_lbls, s_sp_type, s_cs, pt in zip(seqs, script_lbls, script_sp_types, script_css, predicted_tokens):
+        predicted_lbls = [ind2lbl[i] for i in pt][:len(s)]
+        no_same_lbls += s_lbls == "".join(predicted_lbls)
+        no_same_sptype_cs += (s_sp_type, None if s_cs == -1 else s_cs) == get_sptype_and_cs(predicted_lbls, len(s))
+    parity = "TorchScript vs original model: identical labels for {}/{} sequences, identical SP type and CS for " \
+             "{}/{}".format(no_same_lbls, len(seqs), no_same_sptype_cs, len(seqs))
+    print(parity)
+    logging.info(parity)
+
+
+def export_onnx_and_check(model_f_name, onnx_prefix, test_file="test_seqs.bin", onnx_threads=0, batch_size=10):
+    """
+    Exports the (--tune_bert --train_only_decoder) model <model_f_name> as the ONNX graphs
+    <onnx_prefix>_encoder.onnx and <onnx_prefix>_decoder_step.onnx (see export_onnx_mdl), and compares the greedy
+    predictions and decoding times of the onnxruntime backend and of the PyTorch model on <test_file>.
+    """
+    folder = get_data_folder()
+    sp_data = SPCSpredictionData(form_sp_reg_data=False, tune_bert=True)
+    test_file = create_binary_test_file_from_fasta(data_path=folder + test_file)
+    model = load_model(model_f_name, dict_file=test_file, tune_bert=True, testing=True)
+    model.eval()
+    export_onnx_mdl(model, folder + onnx_prefix)
+    print("Saved the ONNX graphs to {}_encoder.onnx and {}_decoder_step.onnx".format(folder + onnx_prefix,
+                                                                                      folder + onnx_prefix))
+    logging.info("Saved the ONNX graphs to {}_encoder.onnx and {}_decoder_step.onnx".format(folder + onnx_prefix,
+                                                                                             folder + onnx_prefix))
+
+    # parity check
+    backend = OnnxTSignalBackend(model, folder + onnx_prefix, intra_op_threads=onnx_threads)
+    seqs = list(pickle.load(open(folder + test_file, "rb")).keys())
+    ind2lbl = {v: k for k, v in sp_data.lbl2ind.items()}
+    no_same_lbls, no_same_sptype_cs, max_prob_diff, times = 0, 0, 0., {"torch": 0., "onnx": 0.}
+    for ind in range(0, len(seqs), batch_size):
+        batch_seqs = seqs[ind:ind + batch_size]
+        start_time = time.time()
+        torch_outs = greedy_decode(model, batch_seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tune_bert=True)
+        times["torch"] += time.time() - start_time
+        start_time = time.time()
+        onnx_outs = greedy_decode(model, batch_seqs, sp_data.lbl2ind['BS'], sp_data.lbl2ind, tune_bert=True,
+                                  backend=backend)
+        times["onnx"] += time.time() - start_time
+        max_prob_diff = max(max_prob_diff, torch.max(torch.abs(torch.softmax(torch_outs[1], dim=-1) -
+                                                               torch.softmax(onnx_outs[1], dim=-1))).item())
+        for s, pt, ot in zip(batch_seqs, torch_outs[0], onnx_outs[0]):
+            torch_lbls, onnx_lbls = [ind2lbl[i] for i in pt][:len(s)], [ind2lbl[i] for i in ot][:len(s)]
+            no_same_lbls += torch_lbls == onnx_lbls
+            no_same_sptype_cs += get_sptype_and_cs(torch_lbls, len(s)) == get_sptype_and_cs(onnx_lbls, len(s))
+    parity = "ONNX vs PyTorch: identical labels for {}/{} sequences, identical SP type and CS for {}/{}, max label " \
+             "probability difference {:.2e}, decoding time {:.1f}s vs {:.1f}s".format(
+        no_same_lbls, len(seqs), no_same_sptype_cs, len(seqs), max_prob_diff, times["onnx"], times["torch"])
+    print(parity)
+    logging.info(parity)
+
+
+def cache_teacher_lbl_logits(teacher, dataset_loader, emb_cache, logits_f_name):
+    """
+    Label logits of the teacher (teacher-forced with the true labels, as in training) for all the sequences of
+    <dataset_loader>, computed once and stored in <logits_f_name> ({seq: fp16 [len(seq) + 1, ntoken] array}). The
+    teacher's ProtBERT outputs are stored in <emb_cache> while doing so.
+    """
+    if os.path.exists(logits_f_name):
+        return pickle.load(open(logits_f_name, "rb"))
+    seq2logits = {}
+    teacher.eval()
+    with torch.no_grad():
+        for seqs, lbl_seqs, _, _ in tqdm(dataset_loader, "Caching teacher outputs", total=len(dataset_loader)):
+            memory_bfd = emb_cache.get_embeddings(teacher, seqs)
+            logits = teacher.classification_head(memory_bfd, lbl_seqs, inp_seqs=list(seqs))
+            for ind, (s, l) in enumerate(zip(seqs, lbl_seqs)):
+                seq2logits[s] = logits[:len(l) + 1, ind].half().cpu().numpy()
+    pickle.dump(seq2logits, open(logits_f_name, "wb"))
+    return seq2logits
+
+
+def distill_cs_predictor(args):
+    """
+    Knowledge distillation of the trained (--tune_bert) model args.distill_teacher_mdl into a student with
+    args.student_bert_layers ProtBERT layers (initialized with evenly spaced teacher layers, including the last) and
+    the teacher's TSignal head. The student is trained on args.train_folds with the label loss, the KL divergence to
+    the teacher's label distributions (temperature args.distill_temperature) and the MSE to the teacher's ProtBERT
+    outputs (the decoder memory). The teacher outputs are computed once and cached on disk. The best student (on the
+    validation loss) is saved as <args.run_name>_best_eval.pth and can be used with --test_mdl.
+    """
+    folder = get_data_folder()
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    test_partition = set() if args.deployment_model else {0, 1, 2} - set(args.train_folds)
+    args.train_folds = [0, 1, 2] if args.deployment_model else args.train_folds
+    sp_data = SPCSpredictionData(form_sp_reg_data=False, tune_bert=True)
+    sp_dataset = CSPredsDataset(sp_data.lbl2ind, partitions=args.train_folds, data_folder=sp_data.data_folder,
+                                glbl_lbl_2ind=sp_data.glbl_lbl_2ind, sets=['train'])
+    dataset_loader = torch.utils.data.DataLoader(sp_dataset, batch_size=args.batch_size, shuffle=True,
+                                                 num_workers=4, collate_fn=collate_fn)
+    teacher = load_model(args.distill_teacher_mdl, tune_bert=True).to(device)
+    teacher.eval()
+    student = load_model(args.distill_teacher_mdl, tune_bert=True)
+    teacher_layers = student.ProtBertBFD.encoder.layer
+    kept_layers = np.round(np.linspace(0, len(teacher_layers) - 1, args.student_bert_layers)).astype(int)
+    student.ProtBertBFD.encoder.layer = nn.ModuleList([teacher_layers[i] for i in kept_layers])
+    student.ProtBertBFD.config.num_hidden_layers = args.student_bert_layers
+    if getattr(student, "lora_config", None) is not None:
+        # a LoRA student is saved as its adapters and the base layers they were kept from (see load_lora_protbert)
+        teacher_layer_inds = get_lora_layer_inds(student.lora_config)
+        student.lora_config = dict(student.lora_config, no_layers=args.student_bert_layers,
+                                   layer_inds=[teacher_layer_inds[i] for i in kept_layers])
+    student.pack_length = args.pack_length
+    student.to(device)
+    no_params = lambda m: sum(p.numel() for p in m.parameters())
+    print("Distilling {} ProtBERT layers ({:.1f}M parameters) into {} (layers {}, {:.1f}M parameters)".format(
+        len(teacher_layers), no_params(teacher.ProtBertBFD) / 1e6, args.student_bert_layers, list(kept_layers),
+        no_params(student.ProtBertBFD) / 1e6))
+    logging.info("Distilling {} ProtBERT layers ({:.1f}M parameters) into {} (layers {}, {:.1f}M parameters)".format(
+        len(teacher_layers), no_params(teacher.ProtBertBFD) / 1e6, args.student_bert_layers, list(kept_layers),
+        no_params(student.ProtBertBFD) / 1e6))
+
+    # teacher outputs, computed once: ProtBERT outputs in the embedding cache, label logits in a binary
+    emb_cache = ProtBertEmbeddingCache(args.emb_cache_dir or folder + "teacher_emb_cache/",
+                                       max_disk_gb=args.emb_cache_max_gb, max_memory_entries=args.emb_cache_mem_entries)
+    seq2teacher_logits = cache_teacher_lbl_logits(teacher, dataset_loader, emb_cache, folder +
+                                                  args.distill_teacher_mdl.replace("_best_eval.pth", "") +
+                                                  "_teacher_lbl_logits_{}.bin".format("_".join(str(f) for f in args.train_folds)))
+
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=sp_data.lbl2ind["PD"])
+    parameters = [{"params": student.classification_head.parameters()},
+                  {"params": student.ProtBertBFD.parameters(), "lr": 0.00001}]
+    optimizer = optim.Adam(parameters, lr=args.lr, eps=1e-9, weight_decay=args.wd, betas=(0.9, 0.98))
+    t = args.distill_temperature
+    best_valid_loss, patience, e = 5 ** 10, args.patience, -1
+    while patience != 0:
+        e += 1
+        student.train()
+        losses, losses_kd, losses_hidden = 0, 0, 0
+        for seqs, lbl_seqs, _, _ in tqdm(dataset_loader, "Epoch {} distillation:".format(e), total=len(dataset_loader)):
+            inputs = student.tokenize(seqs)
+            attention_mask = inputs['attention_mask']
+            with torch.no_grad():
+                teacher_memory_bfd = emb_cache.get_embeddings(teacher, seqs)
+            memory_bfd = student.bert_forward(inputs['input_ids'], attention_mask)
+            logits = student.classification_head(memory_bfd, lbl_seqs, inp_seqs=list(seqs))
+            targets = padd_add_eos_tkn(lbl_seqs, sp_data.lbl2ind)
+            teacher_logits = torch.zeros_like(logits)
+            for ind, s in enumerate(seqs):
+                teacher_logits[:len(lbl_seqs[ind]) + 1, ind] = torch.tensor(seq2teacher_logits[s], device=device).float()
+            lbl_positions = (targets != sp_data.lbl2ind["PD"]).transpose(0, 1)
+            loss = loss_fn(logits.transpose(0, 1).reshape(-1, logits.shape[-1]), targets.reshape(-1))
+            loss_kd = torch.nn.functional.kl_div(torch.log_softmax(logits[lbl_positions] / t, dim=-1),
+                                                 torch.softmax(teacher_logits[lbl_positions] / t, dim=-1),
+                                                 reduction="batchmean") * t ** 2
+            token_positions = attention_mask.bool()
+            loss_hidden = torch.nn.functional.mse_loss(memory_bfd[token_positions], teacher_memory_bfd[token_positions])
+            losses, losses_kd, losses_hidden = losses + loss.item(), losses_kd + loss_kd.item(), \
+                                               losses_hidden + loss_hidden.item()
+            optimizer.zero_grad()
+            (loss + args.distill_kd_weight * loss_kd + args.distill_hidden_weight * loss_hidden).backward()
+            optimizer.step()
+        valid_loss = eval_trainlike_loss(student, sp_data.lbl2ind, run_name=args.run_name, partitions=args.train_folds,
+                                         sets=["test"], tune_bert=True)
+        print("Epoch {}: label loss {:.4f}, KD loss {:.4f}, hidden state loss {:.4f}, validation loss {:.4f}".format(
+            e, losses / len(dataset_loader), losses_kd / len(dataset_loader), losses_hidden / len(dataset_loader),
+            valid_loss))
+        logging.info("Epoch {}: label loss {:.4f}, KD loss {:.4f}, hidden state loss {:.4f}, validation loss "
+                     "{:.4f}".format(e, losses / len(dataset_loader), losses_kd / len(dataset_loader),
+                                     losses_hidden / len(dataset_loader), valid_loss))
+        if valid_loss < best_valid_loss:
+            best_valid_loss = valid_loss
+            save_model(student, model_name=args.run_name, tune_bert=True)
+        else:
+            patience -= 1
+
+    if test_partition:
+        student = load_model(args.run_name + "_best_eval.pth", tune_bert=True)
+        evaluate(student, sp_data.lbl2ind, run_name="distilled_tested_" + args.run_name, partitions=list(test_partition),
+                 sets=["train", "test"], glbl_lbl_2ind=sp_data.glbl_lbl_2ind, tune_bert=True)
+        sp_pred_mccs, all_recalls, all_precisions, total_positives, false_positives, predictions, all_f1_scores, sptype_f1 = \
+            get_cs_and_sp_pred_results(filename="distilled_tested_" + args.run_name + ".bin", v=False,
+                                       return_class_prec_rec=True)
+        all_recalls, all_precisions = list(np.array(all_recalls).flatten()), list(np.array(all_precisions).flatten())
+        log_and_print_mcc_and_cs_results(sp_pred_mccs, all_recalls, all_precisions, test_on="TEST",
+                                         beam_txt="DISTILLED", all_f1_scores=all_f1_scores, sptype_f1=sptype_f1)
@@ -0,0 +1,53 @@
+from contextlib import nullcontext
+
+import torch
+
+# autocast states of the modules kept in fp32 that are currently running (see keep_modules_in_fp32)
+_autocast_states = []
+
+
+def get_autocast(precision="fp32"):
+    """
+    :param str precision: "fp32" (no autocast), "fp16" or "bf16"
+    :return: the autocast context the forward passes (and losses) are computed in
+    """
+    if precision == "fp16":
+        return torch.cuda.amp.autocast()
+    if precision == "bf16":
+        if not hasattr(torch, "autocast"):
+            raise RuntimeError("bf16 autocast requires torch>=1.10 (fp16 is supported from torch 1.6)")
+        return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def get_grad_scaler(precision="fp32"):
+    """
+    Loss scaling is only needed for fp16 (bf16 has the exponent range of fp32); otherwise, the returned (disabled)
+    scaler leaves the losses unchanged and scaler.step(optimizer) simply calls optimizer.step().
+    """
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+
+
+def _fp32_pre_hook(module, inputs):
+    _autocast_states.append(torch.is_autocast_enabled())
+    torch.set_autocast_enabled(False)
+    return tuple(i.float() if torch.is_tensor(i) and i.is_floating_point() else i for i in inputs)
+
+
+def _fp32_hook(module, inputs, outputs):
+    torch.set_autocast_enabled(_autocast_states.pop())
+
+
+def keep_modules_in_fp32(model, module_names=("generator", "LayerNorm")):
+    """
+    Runs the submodules of <model> whose attribute name or class name is in <module_names> (e.g. "generator",
+    "LayerNorm", "glbl_generator") in fp32 inside the autocast regions: their inputs are cast to fp32 and autocast is
+    disabled during their forward. The hooks are plain functions, s.t. the model can still be saved with torch.save.
+
+    :param torch.nn.Module model: ProtBertClassifier or TransformerModel
+    :param list module_names: attribute (last component of the module name) or class names
+    """
+    for name, module in model.named_modules():
+        if name.split(".")[-1] in module_names or type(module).__name__ in module_names:
+            module.register_forward_pre_hook(_fp32_pre_hook)
+            module.register_forward_hook(_fp32_hook)
@@ -0,0 +1,298 @@
+import os
+import shutil
+import pickle
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class ProtBertEmbeddingCache:
+    def __init__(self, cache_dir="sp_data/protbert_emb_cache/", max_disk_gb=10., max_memory_entries=20000):
+        """
+        Content-addressed cache of ProtBERT last-layer outputs (the <memory_bfd> the decoder uses when tuning
+        ProtBERT together with TSignal). Entries are keyed by (sequence hash, ProtBERT weights fingerprint), so that
+        changing the ProtBERT weights (training/loading another model) automatically invalidates them.
+
+        The embeddings are stored as fp16 in a memory-mapped file (one directory per weights fingerprint), with an LRU
+        in-memory tier on top. When the disk store exceeds <max_disk_gb>, the least recently used fingerprint
+        directories are removed (and if the current one is still too large, no more entries are written to disk).
+
+        :param str cache_dir: directory of the disk store
+        :param float max_disk_gb: size cap of the disk store
+        :param int max_memory_entries: number of sequence embeddings kept in memory
+        """
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = int(max_disk_gb * 1024 ** 3)
+        self.max_memory_entries = max_memory_entries
+        self.memory_tier = OrderedDict()
+        # per ProtBERT module: (parameter versions, fingerprint)
+        self.fingerprints = {}
+        self.stores = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_fingerprint(self, bert_model):
+        """
+        Fingerprint of the ProtBERT weights. It is only recomputed when parameters were modified in-place (optimizer
+        steps, load_state_dict) or replaced (e.g. moved to another device), which is tracked through the parameters'
+        version counters and storage pointers. The packed weights of int8 quantized linear layers (which are not
+        parameters anymore) are hashed as well.
+        """
+        params = list(bert_model.named_parameters())
+        quantized = [(n, m) for n, m in bert_model.named_modules()
+                     if isinstance(m, torch.nn.quantized.dynamic.Linear)]
+        # (set_weight_bias/load_state_dict replace the packed weights of quantized layers)
+        versions = tuple((p._version, p.data_ptr()) for _, p in params) + \
+                   tuple(id(m._packed_params._packed_params) for _, m in quantized)
+        if id(bert_model) in self.fingerprints and self.fingerprints[id(bert_model)][0] == versions:
+            return self.fingerprints[id(bert_model)][1]
+        tensors = list(params)
+        for n, m in quantized:
+            tensors.append((n + ".weight", m.weight().dequantize()))
+            if m.bias() is not None:
+                tensors.append((n + ".bias", m.bias()))
+        with torch.no_grad():
+            stats = torch.stack([torch.stack([t.double().sum(), t.double().abs().sum()]).cpu() for _, t in tensors])
+        module_types = [type(m).__name__ for m in bert_model.modules()]
+        fingerprint = hashlib.sha1(pickle.dumps(([(n, tuple(t.shape)) for n, t in tensors], module_types,
+                                                 stats.numpy().tobytes()))).hexdigest()[:16]
+        self.fingerprints[id(bert_model)] = (versions, fingerprint)
+        return fingerprint
+
+    def get_store(self, fingerprint):
+        if fingerprint not in self.stores:
+            store_dir = os.path.join(self.cache_dir, fingerprint)
+            os.makedirs(store_dir, exist_ok=True)
+            index_f = os.path.join(store_dir, "index.bin")
+            index = pickle.load(open(index_f, "rb")) if os.path.exists(index_f) else {}
+            self.stores[fingerprint] = {"dir": store_dir, "index": index, "emb_f": os.path.join(store_dir, "embs.f16"),
+                                        "memmap": None, "memmap_size": 0}
+        os.utime(self.stores[fingerprint]["dir"])
+        return self.stores[fingerprint]
+
+    def read_from_disk(self, store, key):
+        offset, no_tokens, emb_dim = store["index"][key]
+        if store["memmap"] is None or store["memmap_size"] < offset + no_tokens * emb_dim:
+            store["memmap_size"] = os.path.getsize(store["emb_f"]) // 2
+            store["memmap"] = np.memmap(store["emb_f"], dtype=np.float16, mode="r", shape=(store["memmap_size"],))
+        return store["memmap"][offset:offset + no_tokens * emb_dim].reshape(no_tokens, emb_dim)
+
+    def disk_size(self):
+        return sum(os.path.getsize(os.path.join(dp, f)) for dp, _, fs in os.walk(self.cache_dir) for f in fs)
+
+    def write_to_disk(self, store, new_entries):
+        """ appends the <new_entries> {key: fp16 np.array} to the store, respecting the disk size cap """
+        if not new_entries:
+            return
+        new_bytes = sum(e.nbytes for e in new_entries.values())
+        if self.disk_size() + new_bytes > self.max_disk_bytes:
+            # remove the least recently used stores of other ProtBERT weights
+            other_dirs = sorted([os.path.join(self.cache_dir, d) for d in os.listdir(self.cache_dir)
+                                 if os.path.join(self.cache_dir, d) != store["dir"]], key=os.path.getmtime)
+            for other_dir in other_dirs:
+                shutil.rmtree(other_dir, ignore_errors=True)
+                self.stores = {f: s for f, s in self.stores.items() if s["dir"] != other_dir}
+                if self.disk_size() + new_bytes <= self.max_disk_bytes:
+                    break
+            if self.disk_size() + new_bytes > self.max_disk_bytes:
+                return
+        offset = os.path.getsize(store["emb_f"]) // 2 if os.path.exists(store["emb_f"]) else 0
+        with open(store["emb_f"], "ab") as f:
+            for key, emb in new_entries.items():
+                f.write(emb.tobytes())
+                store["index"][key] = (offset, emb.shape[0], emb.shape[1])
+                offset += emb.size
+        pickle.dump(store["index"], open(os.path.join(store["dir"], "index.bin"), "wb"))
+
+    def add_to_memory(self, key, emb):
+        self.memory_tier[key] = emb
+        self.memory_tier.move_to_end(key)
+        while len(self.memory_tier) > self.max_memory_entries:
+            self.memory_tier.popitem(last=False)
+
+    def get_embeddings(self, model, seqs):
+        """
+        Drop-in replacement of tokenizing <seqs> (model.tokenize) and running model.ProtBertBFD on them: only the sequences that are
+        not cached are run through ProtBERT.
+
+        :param model: ProtBertClassifier
+        :param list seqs: amino acid sequences
+        :return torch.tensor: ProtBERT last layer outputs [batch_size, max_no_tokens, 1024] (zeros at padded positions)
+        """
+        no_special_tkns = 2 if model.hparams.special_tokens else 0
+        no_tokens = [min(len(s) + no_special_tkns, model.hparams.max_length) for s in seqs]
+        fingerprint = self.get_fingerprint(model.ProtBertBFD)
+        store = self.get_store(fingerprint)
+        keys = [fingerprint + "_" + hashlib.sha1(s.encode()).hexdigest() for s in seqs]
+        embs, missing = {}, OrderedDict()
+        for s, key in zip(seqs, keys):
+            if key in self.memory_tier:
+                self.memory_tier.move_to_end(key)
+                embs[key] = self.memory_tier[key]
+            elif key in store["index"]:
+                embs[key] = torch.tensor(np.array(self.read_from_disk(store, key)))
+                self.add_to_memory(key, embs[key])
+            else:
+                missing[key] = s
+        if missing:
+            inputs = model.tokenize(list(missing.values()))
+            with torch.no_grad():
+                memory_bfd = model.bert_forward(inputs['input_ids'], inputs['attention_mask'])
+            memory_bfd = memory_bfd.half().cpu()
+            new_entries = {}
+            for (key, s), emb in zip(missing.items(), memory_bfd):
+                embs[key] = emb[:min(len(s) + no_special_tkns, model.hparams.max_length)].clone()
+                new_entries[key] = embs[key].numpy()
+                self.add_to_memory(key, embs[key])
+            self.write_to_disk(store, new_entries)
+        padded = torch.zeros(len(seqs), max(no_tokens), embs[keys[0]].shape[-1], dtype=torch.float16)
+        for ind, (key, n_t) in enumerate(zip(keys, no_tokens)):
+            padded[ind, :n_t] = embs[key]
+        return padded.to(model.device).float()
+
+
+class FrozenEncoderOutputCache:
+    def __init__(self, cache_dir=""):
+        """
+        ProtBERT outputs of the sequences seen while the encoder is frozen (the --frozen_epochs warm-up), so they are
+        only computed in the first frozen epoch, with ProtBERT in eval mode (see ProtBertClassifier.bert_forward). The
+        frozen encoder is thus run without dropout during the warm-up. Entries are keyed by the token indices of the
+        sequences and stored as fp16, in memory or, when <cache_dir> is given, in a memory-mapped file.
+        The cache is dropped when the encoder is un-frozen (ProtBertClassifier.unfreeze_encoder).
+
+        :param str cache_dir: directory of the memory-mapped store ("": keep the outputs in memory)
+        """
+        self.emb_f = os.path.join(cache_dir, "frozen_encoder_outputs.f16") if cache_dir else ""
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            open(self.emb_f, "wb").close()
+        self.index = {}
+        self.memmap, self.memmap_size, self.file_size = None, 0, 0
+
+    def read(self, key):
+        if not self.emb_f:
+            return self.index[key]
+        offset, no_tokens, emb_dim = self.index[key]
+        if self.memmap is None or self.memmap_size < offset + no_tokens * emb_dim:
+            self.memmap_size = self.file_size
+            self.memmap = np.memmap(self.emb_f, dtype=np.float16, mode="r", shape=(self.memmap_size,))
+        return torch.from_numpy(np.array(self.memmap[offset:offset + no_tokens * emb_dim])).reshape(no_tokens, emb_dim)
+
+    def write(self, new_entries):
+        if not self.emb_f:
+            self.index.update(new_entries)
+            return
+        with open(self.emb_f, "ab") as f:
+            for key, emb in new_entries.items():
+                f.write(emb.numpy().tobytes())
+                self.index[key] = (self.file_size, emb.shape[0], emb.shape[1])
+                self.file_size += emb.numel()
+
+    def __call__(self, bert_forward, input_ids, attention_mask):
+        """
+        :param bert_forward: computes the ProtBERT outputs of (input_ids, attention_mask) batches
+        :param torch.tensor input_ids: padded token indices [batch_size, max_no_tokens]
+        :param torch.tensor attention_mask: [batch_size, max_no_tokens]
+        :return torch.tensor: ProtBERT last layer outputs [batch_size, max_no_tokens, d] (zeros at padded positions)
+        """
+        no_tokens = attention_mask.sum(dim=1).tolist()
+        ids = input_ids.cpu().numpy()
+        keys = [ids[ind, :n_t].tobytes() for ind, n_t in enumerate(no_tokens)]
+        missing = [ind for ind, key in enumerate(keys) if key not in self.index]
+        new_entries = {}
+        if missing:
+            max_missing = max(no_tokens[ind] for ind in missing)
+            with torch.no_grad():
+                outputs = bert_forward(input_ids[missing, :max_missing], attention_mask[missing, :max_missing])
+            outputs = outputs.half().cpu()
+            for ind, output in zip(missing, outputs):
+                new_entries[keys[ind]] = output[:no_tokens[ind]].clone()
+        embs = [new_entries[key] if key in new_entries else self.read(key) for key in keys]
+        self.write(new_entries)
+        padded = torch.zeros(len(keys), input_ids.shape[1], embs[0].shape[-1], dtype=torch.float16)
+        for ind, (emb, n_t) in enumerate(zip(embs, no_tokens)):
+            padded[ind, :n_t] = emb
+        return padded.to(input_ids.device).float()
+
+    def clear(self):
+        self.index, self.memmap = {}, None
+        if self.emb_f and os.path.exists(self.emb_f):
+            os.remove(self.emb_f)
+
+
+class LowerLayerActivationCache(ProtBertEmbeddingCache):
+    def __init__(self, bert_model, no_frozen_layers, cache_dir="sp_data/protbert_lower_layer_cache/", max_disk_gb=50.,
+                 max_memory_entries=0):
+        """
+        Hidden states of ProtBERT's layer <no_frozen_layers> (the outputs of the permanently frozen embeddings and
+        bottom layers), used for partial fine-tuning: only the layers above are run (and tuned) on the cached
+        activations (see ProtBertClassifier.set_lower_layer_cache). Same fp16 memory-mapped store as
+        ProtBertEmbeddingCache, keyed by (token indices hash of the sequence, frozen weights fingerprint).
+
+        :param BertModel bert_model: ProtBERT model
+        :param int no_frozen_layers: number of frozen bottom layers
+        :param str cache_dir: directory of the disk store
+        :param float max_disk_gb: size cap of the disk store
+        :param int max_memory_entries: number of sequence activations kept in memory
+        """
+        super().__init__(cache_dir, max_disk_gb=max_disk_gb, max_memory_entries=max_memory_entries)
+        self.no_frozen_layers = no_frozen_layers
+        self.frozen_modules = torch.nn.ModuleList([bert_model.embeddings] +
+                                                  list(bert_model.encoder.layer[:no_frozen_layers]))
+
+    def compute_hidden_states(self, bert_model, input_ids, attention_mask):
+        # the frozen layers are always run without dropout
+        training = self.frozen_modules.training
+        self.frozen_modules.eval()
+        with torch.no_grad():
+            hidden_states = bert_model.embeddings(input_ids=input_ids)
+            extended_mask = bert_model.get_extended_attention_mask(attention_mask, input_ids.shape, input_ids.device)
+            for layer in bert_model.encoder.layer[:self.no_frozen_layers]:
+                hidden_states = layer(hidden_states, extended_mask)[0]
+        self.frozen_modules.train(training)
+        return hidden_states
+
+    def get_hidden_states(self, bert_model, input_ids, attention_mask):
+        """
+        :return torch.tensor: layer <no_frozen_layers> hidden states [batch_size, max_no_tokens, d] (zeros at padded
+                positions), computed only for the sequences that are not cached yet
+        """
+        fingerprint = self.get_fingerprint(self.frozen_modules)
+        store = self.get_store(fingerprint)
+        no_tokens = attention_mask.sum(dim=1).tolist()
+        ids = input_ids.cpu().numpy()
+        keys = [fingerprint + "_" + hashlib.sha1(ids[ind, :n_t].tobytes()).hexdigest() for ind, n_t in enumerate(no_tokens)]
+        states, missing = {}, OrderedDict()
+        for ind, key in enumerate(keys):
+            if key in self.memory_tier:
+                self.memory_tier.move_to_end(key)
+                states[key] = self.memory_tier[key]
+            elif key in store["index"]:
+                states[key] = torch.tensor(np.array(self.read_from_disk(store, key)))
+                self.add_to_memory(key, states[key])
+            else:
+                missing[key] = ind
+        if missing:
+            rows = list(missing.values())
+            max_missing = max(no_tokens[ind] for ind in rows)
+            hidden_states = self.compute_hidden_states(bert_model, input_ids[rows, :max_missing],
+                                                       attention_mask[rows, :max_missing]).half().cpu()
+            new_entries = {}
+            for (key, ind), hs in zip(missing.items(), hidden_states):
+                states[key] = hs[:no_tokens[ind]].clone()
+                new_entries[key] = states[key].numpy()
+                self.add_to_memory(key, states[key])
+            self.write_to_disk(store, new_entries)
+        padded = torch.zeros(len(keys), input_ids.shape[1], states[keys[0]].shape[-1], dtype=torch.float16)
+        for ind, (key, n_t) in enumerate(zip(keys, no_tokens)):
+            padded[ind, :n_t] = states[key]
+        return padded.to(input_ids.device).float()
+
+    def forward_top_layers(self, bert_model, input_ids, attention_mask):
+        """ ProtBERT last layer outputs, running only the (tuned) layers above the cached activations """
+        hidden_states = self.get_hidden_states(bert_model, input_ids, attention_mask)
+        extended_mask = bert_model.get_extended_attention_mask(attention_mask, input_ids.shape, input_ids.device)
+        for layer in bert_model.encoder.layer[self.no_frozen_layers:]:
+            hidden_states = layer(hidden_states, extended_mask)[0]
+        return hidden_states
@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+
+
+class ResidueTokenizer:
+    def __init__(self, vocab, special_tokens=False, max_length=1536):
+        """
+        Direct-to-tensor tokenizer of amino acid sequences, equivalent to
+        tokenizer.batch_encode_plus([" ".join(s) for s in seqs], add_special_tokens=special_tokens, padding=True,
+        truncation=True, max_length=max_length). Every residue is a single-character token of the ProtBERT vocabulary,
+        so the whole batch is tokenized with one lookup in a byte -> token index table.
+
+        :param dict vocab: ProtBERT vocabulary (tokenizer.get_vocab())
+        :param bool special_tokens: add the [CLS]/[SEP] tokens
+        :param int max_length: maximum number of tokens (longer sequences are truncated)
+        """
+        self.aa2tkn = np.full(256, vocab["[UNK]"], dtype=np.int64)
+        for tkn, ind in vocab.items():
+            if len(tkn) == 1 and ord(tkn) < 256:
+                self.aa2tkn[ord(tkn)] = ind
+        self.cls_id, self.sep_id, self.pad_id = vocab["[CLS]"], vocab["[SEP]"], vocab["[PAD]"]
+        self.special_tokens = special_tokens
+        self.max_length = max_length
+
+    def __call__(self, seqs, device="cpu"):
+        """
+        :param list seqs: amino acid sequences
+        :param device: device of the returned tensors
+        :return dict: input_ids, token_type_ids and attention_mask tensors [batch_size, max_no_tokens]
+        """
+        seq_lens = np.array([len(s) for s in seqs], dtype=np.int64)
+        residues = np.frombuffer("".join(seqs).encode("latin-1", errors="replace"), dtype=np.uint8)
+        codes = np.zeros((len(seqs), seq_lens.max()), dtype=np.uint8)
+        # (row, column) of every residue of the batch
+        rows = np.repeat(np.arange(len(seqs)), seq_lens)
+        cols = np.arange(len(residues)) - np.repeat(np.cumsum(seq_lens) - seq_lens, seq_lens)
+        codes[rows, cols] = residues
+        return self.encode_codes(codes, seq_lens, device=device)
+
+    def encode_codes(self, codes, seq_lens, device="cpu"):
+        """
+        :param np.ndarray codes: [batch_size, max_len] uint8 (latin-1) residue codes, e.g. pre-encoded by
+                CSPredsDataset.pre_encode
+        :param np.ndarray seq_lens: number of residues of each sequence
+        :param device: device of the returned tensors
+        :return dict: input_ids, token_type_ids and attention_mask tensors [batch_size, max_no_tokens]
+        """
+        no_special_tkns = 2 if self.special_tokens else 0
+        seq_lens = np.minimum(seq_lens, self.max_length - no_special_tkns)
+        no_tokens = seq_lens + no_special_tkns
+        max_len, offset = seq_lens.max(), 1 if self.special_tokens else 0
+        input_ids = np.full((len(seq_lens), no_tokens.max()), self.pad_id, dtype=np.int64)
+        residue_positions = np.arange(max_len)[None, :] < seq_lens[:, None]
+        input_ids[:, offset:offset + max_len] = np.where(residue_positions, self.aa2tkn[codes[:, :max_len]], self.pad_id)
+        if self.special_tokens:
+            input_ids[:, 0] = self.cls_id
+            input_ids[np.arange(len(seq_lens)), seq_lens + 1] = self.sep_id
+        attention_mask = np.arange(input_ids.shape[1])[None, :] < no_tokens[:, None]
+        input_ids = torch.from_numpy(input_ids).to(device)
+        return {"input_ids": input_ids, "token_type_ids": torch.zeros_like(input_ids),
+                "attention_mask": torch.from_numpy(attention_mask.astype(np.int64)).to(device)}
@@ -0,0 +1,52 @@
+import torch
+
+
+def pack_rows(no_tokens, pack_length):
+    """
+    First-fit decreasing assignment of sequences (of <no_tokens> tokens) to rows of at most <pack_length> tokens.
+
+    :return (list, list, int): row and offset (position of the first token in the row) of each sequence, number of rows
+    """
+    rows, offsets, row_fills = [0] * len(no_tokens), [0] * len(no_tokens), []
+    for ind in sorted(range(len(no_tokens)), key=lambda i: -no_tokens[i]):
+        row = next((r for r, fill in enumerate(row_fills) if fill + no_tokens[ind] <= pack_length), len(row_fills))
+        if row == len(row_fills):
+            row_fills.append(0)
+        rows[ind], offsets[ind] = row, row_fills[row]
+        row_fills[row] += no_tokens[ind]
+    return rows, offsets, len(row_fills)
+
+
+def packed_bert_forward(bert, input_ids, attention_mask, pack_length=512):
+    """
+    Runs ProtBERT on several (short) sequences per row: the sequences of the padded batch are concatenated into rows of
+    at most <pack_length> tokens, with a block-diagonal attention mask (tokens only attend to the tokens of their own
+    sequence) and position ids restarting at every sequence, so the outputs are the ones of the unpacked forward.
+
+    :param BertModel bert: ProtBERT model
+    :param torch.tensor input_ids: padded token indices [batch_size, max_no_tokens]
+    :param torch.tensor attention_mask: [batch_size, max_no_tokens], 1 at the tokens of the sequences
+    :param int pack_length: maximum number of tokens of a packed row (longer sequences get a row of their own)
+    :return torch.tensor: ProtBERT last layer outputs [batch_size, max_no_tokens, d] (zeros at the padded positions)
+    """
+    device = input_ids.device
+    no_tokens = attention_mask.sum(dim=1)
+    rows, offsets, no_rows = pack_rows(no_tokens.tolist(), max(pack_length, input_ids.shape[1]))
+    # (sequence, token) -> (row, column) in the packed batch
+    seq_inds = torch.repeat_interleave(torch.arange(input_ids.shape[0], device=device), no_tokens)
+    tkn_inds = torch.arange(seq_inds.shape[0], device=device) - \
+               torch.repeat_interleave(torch.cumsum(no_tokens, dim=0) - no_tokens, no_tokens)
+    packed_rows = torch.tensor(rows, device=device)[seq_inds]
+    packed_cols = torch.tensor(offsets, device=device)[seq_inds] + tkn_inds
+    packed_length = int(packed_cols.max().item()) + 1
+    packed_ids = input_ids.new_zeros(no_rows, packed_length)
+    packed_ids[packed_rows, packed_cols] = input_ids[seq_inds, tkn_inds]
+    position_ids = input_ids.new_zeros(no_rows, packed_length)
+    position_ids[packed_rows, packed_cols] = tkn_inds
+    segments = input_ids.new_full((no_rows, packed_length), -1)
+    segments[packed_rows, packed_cols] = seq_inds
+    packed_mask = (segments.unsqueeze(2) == segments.unsqueeze(1)) & (segments.unsqueeze(1) != -1)
+    outputs = bert(input_ids=packed_ids, attention_mask=packed_mask.long(), position_ids=position_ids)[0]
+    unpacked = outputs.new_zeros(input_ids.shape[0], input_ids.shape[1], outputs.shape[-1])
+    unpacked[seq_inds, tkn_inds] = outputs[packed_rows, packed_cols]
+    return unpacked
@@ -45,12 +45,8 @@ def update_bn(loader, model, device=None, tune_bert=False):
         if tune_bert:
             seqs, lbl_seqs, _, glbl_lbls = input
             seq_lengths = [len(s) for s in seqs]
-            seqs = [" ".join(r_ for r_ in s) for s in seqs]
-            inputs = model.module.tokenizer.batch_encode_plus(seqs,
-                                                       add_special_tokens=model.module.hparams.special_tokens,
-                                                       padding=True,
-                                                       truncation=True,
-                                                       max_length=model.module.hparams.max_length)
+            inputs = model.module.tokenize(seqs)
+            inputs['sequences'] = seqs
             inputs['targets'] = lbl_seqs
             inputs['seq_lengths'] = seq_lengths
             model(**inputs)